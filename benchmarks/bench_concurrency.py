@@ -0,0 +1,166 @@
+"""
+Cheap-GET latency while long analyses are in flight.
+
+Runs testapp in process behind httpx.ASGITransport, with the in-memory
+Firestore/GCS fakes from tests/fake_gcp.py (every read or upload sleeps for a
+simulated round-trip) and an upstream model that takes --upstream-seconds to
+answer. It first times GET /get-user-profile on an idle app, then keeps
+issuing the same GET for as long as --analyses synchronous
+POST /postAnalysisDetailsFormData requests are running (plan reservation,
+upload, upstream call, result write), and prints p50/p99/max for both.
+
+--blocking replays the same load with run_io calling the client inline, i.e.
+the way handlers behaved before the I/O executor existed, for comparison.
+
+    python benchmarks/bench_concurrency.py --analyses 32 --blocking
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+import types
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "tests"))
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+import httpx  # noqa: E402
+
+from fake_gcp import FakeBucket, FakeFirestore  # noqa: E402
+
+if "config" not in sys.modules:
+    config = types.ModuleType("config")
+    config.db, config.bucket, config.API_URL = FakeFirestore(), FakeBucket(), "http://upstream.test/"
+    sys.modules["config"] = config
+
+import testapp  # noqa: E402
+
+
+def percentile(samples: list, pct: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+def summarize(samples: list) -> dict:
+    return {
+        "requests": len(samples),
+        "p50_ms": round(percentile(samples, 50) * 1000, 2),
+        "p99_ms": round(percentile(samples, 99) * 1000, 2),
+        "max_ms": round(max(samples) * 1000, 2),
+    }
+
+
+def seed(db, users: int):
+    """One plan, profile and brand per analysing user, so reservations do not contend."""
+    db.collection("userProfileDetails").document("reader").set({"userId": "reader", "email": "reader@example.com"})
+    for n in range(users):
+        user_id = f"user-{n}"
+        db.collection("PlanSelectionDetails").document(user_id).set({
+            "userId": user_id, "planName": "Incivus_Pro", "max_ads_per_month": 1000, "totalAds": 1000,
+        })
+        db.collection("userProfileDetails").document(user_id).set({"userId": user_id})
+        db.collection("brandData").document(f"brand-{n}").set({"userId": user_id, "brandName": f"Brand {n}"})
+
+
+def upstream_client(upstream_seconds: float) -> httpx.AsyncClient:
+    async def handler(request: httpx.Request) -> httpx.Response:
+        await request.aread()
+        await asyncio.sleep(upstream_seconds)
+        return httpx.Response(200, json={"data": {"results": {"score": 1}}})
+
+    return httpx.AsyncClient(transport=httpx.MockTransport(handler))
+
+
+async def time_gets(client: httpx.AsyncClient, concurrency: int, count: int = 0, until: asyncio.Future = None) -> list:
+    """Time GETs from `concurrency` callers: `count` in total, or until `until` is done."""
+    samples = []
+
+    async def caller():
+        while (until is not None and not until.done()) or (until is None and len(samples) < count):
+            started = time.perf_counter()
+            response = await client.get("/get-user-profile/reader")
+            samples.append(time.perf_counter() - started)
+            response.raise_for_status()
+
+    await asyncio.gather(*(caller() for _ in range(concurrency)))
+    return samples
+
+
+async def submit_analysis(client: httpx.AsyncClient, n: int) -> int:
+    response = await client.post(
+        "/postAnalysisDetailsFormData",
+        data={
+            "userId": f"user-{n}", "brandId": f"brand-{n}", "timestamp": f"2026-10-18T00:00:{n % 60:02d}Z",
+            "messageIntent": "launch", "funnelStage": "awareness", "channels": '["facebook"]',
+            "source": "bench", "clientId": "bench", "artifacts": "{}", "asyncMode": "false", "bypassCache": "true",
+        },
+        files={"mediaFile": (f"ad-{n}.png", os.urandom(64 * 1024), "image/png")},
+        timeout=None,
+    )
+    return response.status_code
+
+
+async def run_benchmark(analyses: int = 32, gets: int = 300, get_concurrency: int = 4,
+                        upstream_seconds: float = 2.0, io_latency: float = 0.02, blocking: bool = False) -> dict:
+    """Return idle and under-load latency summaries for the cheap GET."""
+    db, bucket = FakeFirestore(read_latency=io_latency), FakeBucket(upload_latency=io_latency)
+    seed(db, analyses)
+    upstream_host = testapp._upstream_host(testapp.feature_api_config["comprehensive-analysis"]["url"])
+    testapp.upstream_host_stats.pop(upstream_host, None)
+    saved = {name: getattr(testapp, name) for name in ("db", "bucket", "upstream_client", "run_io")}
+    testapp.db, testapp.bucket = db, bucket
+    testapp.upstream_client = upstream_client(upstream_seconds)
+    if blocking:
+        async def run_inline(func, *args, **kwargs):
+            return func(*args, **kwargs)
+        testapp.run_io = run_inline
+    try:
+        transport = httpx.ASGITransport(app=testapp.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+            idle = await time_gets(client, get_concurrency, count=gets)
+
+            submitted = asyncio.gather(*(submit_analysis(client, n) for n in range(analyses)))
+            loaded = await time_gets(client, get_concurrency, until=submitted)
+            statuses = await submitted
+            peak_upstream = testapp.upstream_host_stats[upstream_host]["peak_in_flight"]
+    finally:
+        await testapp.upstream_client.aclose()
+        for name, value in saved.items():
+            setattr(testapp, name, value)
+
+    return {
+        "mode": "blocking" if blocking else "io_executor",
+        "analyses": analyses,
+        "peak_upstream_in_flight": peak_upstream,
+        "analysis_statuses": {str(s): statuses.count(s) for s in sorted(set(statuses))},
+        "idle": summarize(idle),
+        "under_load": summarize(loaded),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--analyses", type=int, default=32, help="long analyses kept in flight")
+    parser.add_argument("--gets", type=int, default=300, help="cheap GETs timed on the idle app")
+    parser.add_argument("--get-concurrency", type=int, default=4)
+    parser.add_argument("--upstream-seconds", type=float, default=2.0, help="simulated model latency")
+    parser.add_argument("--io-latency", type=float, default=0.02, help="simulated Firestore/GCS round-trip")
+    parser.add_argument("--blocking", action="store_true", help="also run with Firestore/GCS calls on the event loop")
+    args = parser.parse_args()
+
+    options = dict(
+        analyses=args.analyses, gets=args.gets, get_concurrency=args.get_concurrency,
+        upstream_seconds=args.upstream_seconds, io_latency=args.io_latency,
+    )
+    runs = [asyncio.run(run_benchmark(**options))]
+    if args.blocking:
+        runs.append(asyncio.run(run_benchmark(blocking=True, **options)))
+    for run in runs:
+        print(json.dumps(run, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+"""
+Analysis latency with and without image preprocessing.
+
+Runs testapp in process behind httpx.ASGITransport, with the in-memory
+Firestore/GCS fakes from tests/fake_gcp.py and an upstream model whose answer
+takes --upstream-seconds plus the time to receive the request body at
+--upstream-mbps. It submits --analyses synchronous
+POST /postAnalysisDetailsFormData requests carrying a camera-sized JPEG
+(--width x --height), --concurrency at a time, once with
+IMAGE_PREPROCESS_ENABLED off and once with it on, and prints bytes sent
+upstream and p50/p99/max end-to-end latency for each. Downsizing is CPU work
+on the I/O executor, so with more concurrent analyses than cores its cost
+queues up; compare at the concurrency a single instance actually serves.
+
+Needs Pillow (see requirements-dev.txt).
+
+    python benchmarks/bench_image_preprocess.py --analyses 20 --width 4032 --height 3024
+"""
+import argparse
+import asyncio
+import io
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import httpx  # noqa: E402
+from PIL import Image  # noqa: E402
+
+from bench_concurrency import seed, summarize, testapp  # noqa: E402
+from fake_gcp import FakeBucket, FakeFirestore  # noqa: E402
+
+
+def camera_jpeg(width: int, height: int) -> bytes:
+    """A photo-like JPEG: a gradient with sensor noise, at high quality."""
+    gradient = Image.linear_gradient("L").resize((width, height))
+    noise = Image.effect_noise((width, height), 24)
+    image = Image.merge("RGB", (gradient, noise, Image.blend(gradient, noise, 0.5)))
+    output = io.BytesIO()
+    image.save(output, format="JPEG", quality=95)
+    return output.getvalue()
+
+
+def upstream_client(upstream_seconds: float, upstream_mbps: float, received: list) -> httpx.AsyncClient:
+    async def handler(request: httpx.Request) -> httpx.Response:
+        body = await request.aread()
+        received.append(len(body))
+        await asyncio.sleep(upstream_seconds + len(body) * 8 / (upstream_mbps * 1_000_000))
+        return httpx.Response(200, json={"data": {"results": {"score": 1}}})
+
+    return httpx.AsyncClient(transport=httpx.MockTransport(handler))
+
+
+async def submit_analysis(client: httpx.AsyncClient, n: int, image: bytes) -> float:
+    started = time.perf_counter()
+    response = await client.post(
+        "/postAnalysisDetailsFormData",
+        data={
+            "userId": f"user-{n}", "brandId": f"brand-{n}", "timestamp": f"2026-10-18T00:00:{n % 60:02d}Z",
+            "messageIntent": "launch", "funnelStage": "awareness", "channels": '["facebook"]',
+            "source": "bench", "clientId": "bench", "artifacts": "{}", "asyncMode": "false", "bypassCache": "true",
+        },
+        files={"mediaFile": (f"ad-{n}.jpg", image, "image/jpeg")},
+        timeout=None,
+    )
+    response.raise_for_status()
+    return time.perf_counter() - started
+
+
+async def run_benchmark(image: bytes, analyses: int = 20, concurrency: int = 1, upstream_seconds: float = 1.0,
+                        upstream_mbps: float = 20.0, preprocess: bool = False) -> dict:
+    """Return bytes sent upstream and end-to-end latency for `analyses` image analyses."""
+    db, bucket = FakeFirestore(), FakeBucket()
+    seed(db, analyses)
+    received = []
+    saved = {name: getattr(testapp, name) for name in ("db", "bucket", "upstream_client", "IMAGE_PREPROCESS_ENABLED")}
+    testapp.db, testapp.bucket = db, bucket
+    testapp.upstream_client = upstream_client(upstream_seconds, upstream_mbps, received)
+    testapp.IMAGE_PREPROCESS_ENABLED = preprocess
+    try:
+        transport = httpx.ASGITransport(app=testapp.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+            slots = asyncio.Semaphore(concurrency)
+
+            async def limited(n):
+                async with slots:
+                    return await submit_analysis(client, n, image)
+
+            samples = await asyncio.gather(*(limited(n) for n in range(analyses)))
+    finally:
+        await testapp.upstream_client.aclose()
+        for name, value in saved.items():
+            setattr(testapp, name, value)
+
+    return {
+        "mode": "preprocessed" if preprocess else "original",
+        "concurrency": concurrency,
+        "image_bytes": len(image),
+        "upstream_bytes_mean": round(sum(received) / len(received)),
+        "latency": summarize(samples),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--analyses", type=int, default=20)
+    parser.add_argument("--concurrency", type=int, default=1, help="analyses in flight at once")
+    parser.add_argument("--width", type=int, default=4032)
+    parser.add_argument("--height", type=int, default=3024)
+    parser.add_argument("--upstream-seconds", type=float, default=1.0, help="simulated model latency")
+    parser.add_argument("--upstream-mbps", type=float, default=20.0, help="simulated upload bandwidth to the model")
+    args = parser.parse_args()
+
+    image = camera_jpeg(args.width, args.height)
+    options = dict(
+        analyses=args.analyses, concurrency=args.concurrency,
+        upstream_seconds=args.upstream_seconds, upstream_mbps=args.upstream_mbps,
+    )
+    for preprocess in (False, True):
+        print(json.dumps(asyncio.run(run_benchmark(image, preprocess=preprocess, **options)), indent=2))
+
+
+if __name__ == "__main__":
+    main()
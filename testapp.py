@@ -1,16 +1,48 @@
 from fastapi import FastAPI, Form, File, Request, UploadFile, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse
+from starlette.routing import Match
 from pydantic import BaseModel
 from typing import Optional
 import uuid
 from config import db, bucket, API_URL
+import video_keyframes
+from google.cloud import firestore
+from google.cloud.firestore_v1.field_path import FieldPath
+from google.api_core.exceptions import FailedPrecondition, NotFound, PreconditionFailed
 from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from collections import OrderedDict
+from urllib.parse import urlsplit
 
-import requests
+import httpx
 import json
 import base64
 import os
 import io
+import asyncio
+import functools
+import hashlib
+import tempfile
+import time
+import itertools
+import random
+import bisect
+import contextlib
+import contextvars
+import threading
+import logging
+import queue
+import sys
+from logging.handlers import QueueHandler, QueueListener
+import atexit
+import multiprocessing
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow is optional; image preprocessing is skipped without it
+    Image = ImageOps = None
+
 app = FastAPI()
 app.add_middleware(
     CORSMiddleware,
@@ -43,219 +75,1621 @@ feature_api_config = {
         "url": f"{API_URL}comprehensive-analysis",
     },
 }
- 
-@app.post("/save-user-profile")
-async def save_user_profile(profile: UserProfile):
-    try:
-        # Create unique ID for the user
-        user_id = str(uuid.uuid4())
- 
-        # Prepare data
-        data = profile.dict()
-        data["user_id"] = user_id
- 
-        # Save to Firebase Firestore
-        db.collection("user_profiles").document(user_id).set(data)
-        print('saveuser')
-        return {"message": "User profile saved successfully", "user_id": user_id}
-   
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
- 
-@app.get("/get-user-profile/{user_id}")
-async def get_user_profile(user_id: str):
-    try:
-        # Fetch document by ID from Firestore
-        doc_ref = db.collection("userProfileDetails").document(user_id)
-        doc = doc_ref.get()
-        print('getuser')
-        if not doc.exists:
-            raise HTTPException(status_code=404, detail="User profile not found")
 
-        profile_data = doc.to_dict()
-        
-        # Note: Removed hardcoded max_ads_per_month correction logic
-        # The database now stores the correct values for topup/upgrade scenarios
-        # where users may have combined plans (e.g., Pro + Pro = 22 ads/month)
 
-        return profile_data
+# ===============================
+# Logging
+# ===============================
+# All application logging goes through `logger`. The calling code only fills
+# in the message and puts the record on a queue (DeferredQueueHandler leaves
+# the traceback and the output line to the listener, unlike the stdlib
+# QueueHandler). A QueueListener thread formats it and writes it to stdout.
+# The default format is one JSON object per line; LOG_FORMAT=text gives
+# plain lines. Every record carries the request ID and artifact ID that were
+# in effect when it was logged. Pass values as %-style arguments, so debug
+# payloads are only formatted when LOG_LEVEL=DEBUG.
 
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
- 
-@app.post("/UserProfileDetails")
-async def post_user_profile(profile: UserProfile):
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json").lower()
+
+request_id_var: contextvars.ContextVar = contextvars.ContextVar("request_id", default=None)
+artifact_id_var: contextvars.ContextVar = contextvars.ContextVar("artifact_id", default=None)
+
+
+class LogContextFilter(logging.Filter):
+    """Stamp each record with the request/artifact IDs of the code that logged it."""
+
+    def filter(self, record):
+        record.request_id = request_id_var.get()
+        record.artifact_id = artifact_id_var.get()
+        return True
+
+
+class JsonLogFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": datetime.utcfromtimestamp(record.created).isoformat(timespec="milliseconds") + "Z",
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key in ("request_id", "artifact_id"):
+            if getattr(record, key, None):
+                entry[key] = getattr(record, key)
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+class DeferredQueueHandler(QueueHandler):
+    """Queue records with their message fixed; the line and traceback are formatted by the listener."""
+
+    def prepare(self, record):
+        # Callers go on to mutate what they logged, so the %-args cannot wait for the listener
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+logger = logging.getLogger("incivus")
+logger.setLevel(LOG_LEVEL)
+logger.propagate = False
+
+_log_queue: queue.SimpleQueue = queue.SimpleQueue()
+_log_queue_handler = DeferredQueueHandler(_log_queue)
+_log_queue_handler.addFilter(LogContextFilter())
+logger.addHandler(_log_queue_handler)
+
+_log_output = logging.StreamHandler(sys.stdout)
+_log_output.setFormatter(
+    JsonLogFormatter() if LOG_FORMAT == "json"
+    else logging.Formatter("%(asctime)s %(levelname)s [%(request_id)s %(artifact_id)s] %(message)s")
+)
+log_listener = QueueListener(_log_queue, _log_output)
+log_listener.start()
+atexit.register(log_listener.stop)  # flush what is still queued on exit
+
+
+@app.middleware("http")
+async def bind_request_id(request: Request, call_next):
+    """Tag the request's log lines with X-Request-ID (generated if absent) and echo it back."""
+    request_id = request.headers.get("X-Request-ID") or uuid.uuid4().hex
+    token = request_id_var.set(request_id)
     try:
-       # user_id = str(uuid.uuid4())
-        data = profile.dict()
-        user_id = data["userId"]
-        print('postuser')
-        db.collection("userProfileDetails").document(user_id).set(data)
-        return {"message": "User profile saved successfully", "user_id": user_id}
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+        response = await call_next(request)
+    finally:
+        request_id_var.reset(token)
+    response.headers["X-Request-ID"] = request_id
+    return response
 
 
-@app.patch("/updateUserProfileDetails/{user_id}")
-async def update_user_profile_details(user_id: str, request: Request):
-    """Merge arbitrary updates into userProfileDetails. Accepts JSON { updates: {...}, timestamp?: str }"""
+# ===============================
+# Metrics
+# ===============================
+# Prometheus text exposition at GET /metrics. The HTTP middleware times every
+# request per route template and tracks requests in flight. Firestore
+# reads/writes/deletes, GCS upload bytes and signed URLs are counted in the
+# access layer (fs_*, tx_get and fs_transactional for transactions, gcs_*)
+# and upstream calls in upstream_post. Each count is attributed to the route
+# that caused it (metrics_route); work outside a request is labelled
+# "background". The per-feature *_stats dicts, the in-process caches and which
+# optional stages are on are exported alongside; this is the only metrics
+# endpoint.
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+metrics_route: contextvars.ContextVar = contextvars.ContextVar("metrics_route", default="background")
+# Counters below are also bumped from I/O threads
+metrics_lock = threading.Lock()
+
+http_in_flight: dict[str, int] = {}                # route -> requests in flight
+http_request_histograms: dict[tuple, dict] = {}    # (method, route) -> histogram
+http_request_counts: dict[tuple, int] = {}         # (method, route, status) -> requests
+firestore_op_counts: dict[tuple, int] = {}         # (route, op) -> documents
+gcs_upload_byte_counts: dict[str, int] = {}        # route -> bytes
+gcs_signed_url_counts: dict[str, int] = {}         # route -> URLs signed
+upstream_histograms: dict[str, dict] = {}          # model -> histogram
+upstream_status_counts: dict[tuple, int] = {}      # (model, status) -> calls
+
+
+def new_histogram(buckets: tuple = LATENCY_BUCKETS) -> dict:
+    return {"buckets": buckets, "counts": [0] * (len(buckets) + 1), "count": 0, "sum": 0.0}
+
+
+def observe(histogram: dict, value: float):
+    """Add one observation to a histogram made by new_histogram."""
+    histogram["counts"][bisect.bisect_left(histogram["buckets"], value)] += 1
+    histogram["count"] += 1
+    histogram["sum"] += value
+
+
+def count_metric(counter: dict, key, n: float = 1):
+    """Increment a metrics counter; safe to call from I/O threads."""
+    with metrics_lock:
+        counter[key] = counter.get(key, 0) + n
+
+
+def count_firestore(op: str, n: int = 1):
+    if n:
+        count_metric(firestore_op_counts, (metrics_route.get(), op), n)
+
+
+def _route_template(scope) -> str:
+    for route in app.router.routes:
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return route.path
+    return "unmatched"
+
+
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    route = _route_template(request.scope)
+    token = metrics_route.set(route)
+    http_in_flight[route] = http_in_flight.get(route, 0) + 1
+    started = time.perf_counter()
+    status = 500
     try:
-        try:
-            payload = await request.json()
-        except Exception:
-            raise HTTPException(status_code=400, detail="Invalid JSON body")
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        http_in_flight[route] -= 1
+        observe(http_request_histograms.setdefault((request.method, route), new_histogram()), time.perf_counter() - started)
+        count_metric(http_request_counts, (request.method, route, status))
+        metrics_route.reset(token)
 
-        updates = payload.get("updates", {})
-        if not isinstance(updates, dict):
-            raise HTTPException(status_code=400, detail="'updates' must be an object")
 
-        # Always bump updatedAt
-        updates.setdefault("updatedAt", datetime.utcnow().isoformat())
+def _prom_escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
 
-        profile_ref = db.collection("userProfileDetails").document(user_id)
-        profile_ref.set(updates, merge=True)
-        return {"message": "User profile updated", "user_id": user_id}
-    except HTTPException:
+
+def _prom_labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_prom_escape(value)}"' for name, value in labels.items()) + "}"
+
+
+def _prom_histogram(lines: list, name: str, labels: dict, histogram: dict):
+    cumulative = 0
+    for bound, n in zip(histogram["buckets"] + ("+Inf",), histogram["counts"]):
+        cumulative += n
+        lines.append(f"{name}_bucket{_prom_labels({**labels, 'le': bound})} {cumulative}")
+    lines.append(f"{name}_sum{_prom_labels(labels)} {histogram['sum']}")
+    lines.append(f"{name}_count{_prom_labels(labels)} {histogram['count']}")
+
+
+def _prom_stats(lines: list, name: str, stats: dict, labels: Optional[dict] = None):
+    for key, value in stats.items():
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            lines.append(f"{name}_{key}{_prom_labels(labels or {})} {value}")
+
+
+@app.get("/metrics")
+async def get_metrics():
+    """All application metrics in the Prometheus text format."""
+    lines = [
+        "# TYPE incivus_http_requests_in_flight gauge",
+        *(f"incivus_http_requests_in_flight{_prom_labels({'route': route})} {n}" for route, n in http_in_flight.items()),
+        "# TYPE incivus_http_request_duration_seconds histogram",
+    ]
+    for (method, route), histogram in list(http_request_histograms.items()):
+        _prom_histogram(lines, "incivus_http_request_duration_seconds", {"method": method, "route": route}, histogram)
+    lines.append("# TYPE incivus_http_requests_total counter")
+    for (method, route, status), n in list(http_request_counts.items()):
+        lines.append(f"incivus_http_requests_total{_prom_labels({'method': method, 'route': route, 'status': status})} {n}")
+
+    lines.append("# TYPE incivus_firestore_documents_total counter")
+    for (route, op), n in list(firestore_op_counts.items()):
+        lines.append(f"incivus_firestore_documents_total{_prom_labels({'route': route, 'op': op})} {n}")
+    lines.append("# TYPE incivus_gcs_upload_bytes_total counter")
+    for route, n in list(gcs_upload_byte_counts.items()):
+        lines.append(f"incivus_gcs_upload_bytes_total{_prom_labels({'route': route})} {n}")
+    lines.append("# TYPE incivus_gcs_signed_urls_total counter")
+    for route, n in list(gcs_signed_url_counts.items()):
+        lines.append(f"incivus_gcs_signed_urls_total{_prom_labels({'route': route})} {n}")
+
+    lines.append("# TYPE incivus_upstream_request_duration_seconds histogram")
+    for model, histogram in list(upstream_histograms.items()):
+        _prom_histogram(lines, "incivus_upstream_request_duration_seconds", {"model": model}, histogram)
+    lines.append("# TYPE incivus_upstream_requests_total counter")
+    for (model, status), n in list(upstream_status_counts.items()):
+        lines.append(f"incivus_upstream_requests_total{_prom_labels({'model': model, 'status': status})} {n}")
+    for host, stats in list(upstream_host_stats.items()):
+        _prom_stats(lines, "incivus_upstream_pool", stats, {"host": host})
+
+    lines.append("# TYPE incivus_analysis_stage_duration_seconds histogram")
+    for stage, histogram in list(analysis_stage_histograms.items()):
+        _prom_histogram(lines, "incivus_analysis_stage_duration_seconds", {"stage": stage}, histogram)
+
+    for cache in list(ttl_caches):
+        _prom_stats(lines, "incivus_cache", {
+            **cache.stats, "entries": len(cache), "max_entries": cache.max_entries, "ttl_seconds": cache.ttl_seconds,
+        }, {"cache": cache.name})
+
+    lines.append("# TYPE incivus_feature_enabled gauge")
+    for feature, enabled in (
+        ("content_store", CAS_ENABLED),
+        ("image_preprocess", bool(image_preprocess_variant("image/png"))),
+        ("video_keyframes", video_process_pool is not None),
+    ):
+        lines.append(f"incivus_feature_enabled{_prom_labels({'feature': feature})} {int(enabled)}")
+    lines.append(f"incivus_upstream_client_open {int(upstream_client is not None and not upstream_client.is_closed)}")
+    _prom_stats(lines, "incivus_upstream_pool_limit", {
+        "max_connections": UPSTREAM_MAX_CONNECTIONS,
+        "max_keepalive_connections": UPSTREAM_MAX_KEEPALIVE,
+        "max_per_host": UPSTREAM_MAX_PER_HOST,
+    })
+    lines.append(f"incivus_analysis_timing_sample_rate {ANALYSIS_TIMING_SAMPLE_RATE}")
+    for name, stats in (
+        ("content_store", content_store_stats),
+        ("image_preprocess", image_preprocess_stats),
+        ("video_keyframes", video_keyframe_stats),
+        ("analysis_timing", analysis_timing_stats),
+    ):
+        _prom_stats(lines, f"incivus_{name}", stats)
+    return PlainTextResponse("\n".join(lines) + "\n", media_type="text/plain; version=0.0.4")
+
+
+# ===============================
+# In-process caches
+# ===============================
+# Signed URLs, result-cache index entries, plan documents and brand records
+# are kept in TTLCache instances: bounded LRU maps whose entries expire after a
+# TTL. Lookups happen on the event loop and invalidations also from I/O
+# threads, so every operation takes the cache's lock. A read-through fill
+# takes a token from begin_fill before its read; put() with that token is
+# discarded if the key was invalidated meanwhile, so a read that overlapped a
+# write cannot cache the old data. Every cache's counters are exported by
+# /metrics as incivus_cache_*{cache="<name>"}.
+
+CACHE_MISS = object()
+
+ttl_caches: list = []  # every TTLCache, for /metrics
+
+
+class TTLCache:
+    """Bounded LRU cache with per-entry expiry, fill tokens and counters."""
+
+    def __init__(self, name: str, max_entries: int, ttl_seconds: float, extra_stats: tuple = ()):
+        self.name = name
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.stats = dict.fromkeys(("hits", "misses", "expired", "fills", "evictions", "invalidations", "discarded_fills") + extra_stats, 0)
+        self._entries: "OrderedDict[object, tuple]" = OrderedDict()  # key -> (value, expires_at)
+        self._pending: dict = {}  # key -> fill tokens in flight
+        self._fill_ids = itertools.count()
+        self._lock = threading.Lock()
+        ttl_caches.append(self)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """The cached value, or CACHE_MISS if there is none or it expired."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.stats["hits"] += 1
+                return entry[0]
+            self.stats["misses"] += 1
+            if entry is not None:
+                self.stats["expired"] += 1
+            return CACHE_MISS
+
+    def peek(self, key):
+        """The stored value even if expired, or CACHE_MISS; not counted."""
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry[0] if entry is not None else CACHE_MISS
+
+    def begin_fill(self, key) -> int:
+        """Token for a read about to fill `key`; pass it to put() or cancel_fill()."""
+        with self._lock:
+            fill = next(self._fill_ids)
+            self._pending.setdefault(key, set()).add(fill)
+            return fill
+
+    def cancel_fill(self, key, fill: int):
+        with self._lock:
+            self._end_fill(key, fill)
+
+    def _end_fill(self, key, fill: int) -> bool:
+        pending = self._pending.get(key)
+        if pending is None or fill not in pending:
+            return False
+        pending.discard(fill)
+        if not pending:
+            del self._pending[key]
+        return True
+
+    def put(self, key, value, fill: Optional[int] = None, ttl_seconds: Optional[float] = None) -> bool:
+        """Cache a value for ttl_seconds (default: the cache's TTL). Returns False if the fill was invalidated."""
+        with self._lock:
+            if fill is not None and not self._end_fill(key, fill):
+                self.stats["discarded_fills"] += 1
+                return False
+            ttl = self.ttl_seconds if ttl_seconds is None else ttl_seconds
+            self._entries[key] = (value, time.monotonic() + ttl)
+            self._entries.move_to_end(key)
+            self.stats["fills"] += 1
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.stats["evictions"] += 1
+            return True
+
+    def invalidate(self, key):
+        """Forget a key and discard fills of it already in flight."""
+        with self._lock:
+            self._entries.pop(key, None)
+            self._pending.pop(key, None)
+            self.stats["invalidations"] += 1
+
+    def count(self, stat: str, n: int = 1):
+        with self._lock:
+            self.stats[stat] += n
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._pending.clear()
+
+
+# ===============================
+# Firestore / GCS access layer
+# ===============================
+# The google-cloud clients are synchronous. Handlers must not call them
+# directly on the event loop; every Firestore/GCS round-trip goes through
+# the helpers below, which run it on a bounded thread pool.
+
+IO_EXECUTOR_WORKERS = int(os.getenv("IO_EXECUTOR_WORKERS", "32"))
+io_executor = ThreadPoolExecutor(max_workers=IO_EXECUTOR_WORKERS, thread_name_prefix="gcp-io")
+
+
+async def run_io(func, *args, **kwargs):
+    """Run a blocking call on the I/O executor and await its result."""
+    loop = asyncio.get_running_loop()
+    # Carry the caller's context so metrics see which route the call is for
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(io_executor, functools.partial(context.run, func, *args, **kwargs))
+
+
+async def fs_get(doc_ref, field_paths: Optional[list] = None):
+    """Fetch a document snapshot (only field_paths, when given)."""
+    snapshot = await run_io(doc_ref.get, field_paths=field_paths)
+    count_firestore("reads")
+    return snapshot
+
+
+async def fs_set(doc_ref, data: dict, merge: bool = False):
+    """Create or overwrite a document (or merge into it)."""
+    result = await run_io(doc_ref.set, data, merge=merge)
+    count_firestore("writes")
+    return result
+
+
+async def fs_update(doc_ref, updates: dict, option=None):
+    """Update fields of an existing document, subject to `option`'s precondition if given."""
+    result = await run_io(doc_ref.update, updates, option=option)
+    count_firestore("writes")
+    return result
+
+
+async def fs_delete(doc_ref):
+    """Delete a document."""
+    result = await run_io(doc_ref.delete)
+    count_firestore("deletes")
+    return result
+
+
+async def fs_add(collection_ref, data: dict):
+    """Add a document with an auto-generated ID."""
+    result = await run_io(collection_ref.add, data)
+    count_firestore("writes")
+    return result
+
+
+async def fs_stream(query) -> list:
+    """Run a query and return all matching snapshots."""
+    snapshots = await run_io(lambda: list(query.stream()))
+    # A query is billed at least one read even when it matches nothing
+    count_firestore("reads", max(len(snapshots), 1))
+    return snapshots
+
+
+async def fs_commit(batch):
+    """Commit a write batch built on the caller's side."""
+    writes = len(batch)
+    result = await run_io(batch.commit)
+    count_firestore("writes", writes)
+    return result
+
+
+# Transactional functions run on the I/O executor (run_io) and are declared
+# with fs_transactional instead of firestore.transactional; they read with
+# tx_get. Reads are counted for every attempt, writes once, for the attempt
+# that committed.
+_transaction_attempt = threading.local()
+
+
+def fs_transactional(func):
+    """firestore.transactional, counting the transaction's Firestore operations."""
+    @functools.wraps(func)
+    def attempt(transaction, *args, **kwargs):
+        result = func(transaction, *args, **kwargs)
+        _transaction_attempt.writes = len(transaction)
+        return result
+
+    run_attempts = firestore.transactional(attempt)
+
+    @functools.wraps(func)
+    def run(transaction, *args, **kwargs):
+        _transaction_attempt.writes = 0
+        result = run_attempts(transaction, *args, **kwargs)
+        count_firestore("writes", _transaction_attempt.writes)
+        return result
+
+    return run
+
+
+def tx_get(transaction, doc_ref):
+    """Read a document inside a transaction."""
+    snapshot = doc_ref.get(transaction=transaction)
+    count_firestore("reads")
+    return snapshot
+
+
+async def gcs_upload_file(storage_path: str, file_obj, content_type: Optional[str] = None,
+                          if_generation_match: Optional[int] = None):
+    """Upload a file-like object to GCS and return the blob."""
+    blob = bucket.blob(storage_path)
+    await run_io(blob.upload_from_file, file_obj, content_type=content_type, if_generation_match=if_generation_match)
+    count_metric(gcs_upload_byte_counts, metrics_route.get(), blob.size or 0)
+    return blob
+
+
+async def gcs_download_to_spooled(storage_path: str):
+    """Download a stored object into a spooled temp file (on disk past 1MB), rewound."""
+    media_file = tempfile.SpooledTemporaryFile(max_size=1024 * 1024)
+    try:
+        await run_io(bucket.blob(storage_path).download_to_file, media_file)
+        await run_io(media_file.seek, 0)
+    except Exception:
+        media_file.close()
         raise
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
- 
-@app.post("/branddata-form")
-async def receive_brand_form(
-    request: Request,
-    userId: str = Form(...),
-    timestamp: str = Form(...),
-    brandName: str = Form(...),
-    tagline: str = Form(...),
-    brandDescription: str = Form(...),
-    industryCategory: str = Form(...),
-    targetAudience: str = Form(...),
-    primaryColor: str = Form(...),
-    secondaryColor: str = Form(...),
-    accentColor: str = Form(...),
-    colorPalette: str = Form(...),
-    toneOfVoice: str = Form(...),
-    customTone: str = Form(...),
-    communicationStyle: str = Form(...),
-    brandVoice: str = Form(...),
-    keyMessages: str = Form(...),
-    isComplete: bool = Form(...),
-    completionPercentage: int = Form(...),
-    lastUpdated: str = Form(...),
-    dataVersion: float = Form(...),
-    source: str = Form(...),
-    apiEndpoint: str = Form(...),
-    submissionSource: str = Form(...),
-    systemMetadata: str = Form(...),
-    logoFiles: Optional[list[UploadFile]] = File(None),
-    logoMetadata: Optional[list[str]] = Form(None)
-):
+    return media_file
+
+
+async def gcs_upload_bytes(storage_path: str, data: bytes, content_type: Optional[str] = None):
+    """Upload in-memory bytes to GCS and return the blob."""
+    blob = bucket.blob(storage_path)
+    await run_io(blob.upload_from_string, data, content_type=content_type)
+    count_metric(gcs_upload_byte_counts, metrics_route.get(), len(data))
+    return blob
+
+
+# Signing is an RSA operation (or an IAM signBlob round-trip), so URLs are reused
+# per storagePath until SIGNED_URL_REFRESH_MARGIN before they expire.
+SIGNED_URL_TTL = timedelta(days=7)
+SIGNED_URL_REFRESH_MARGIN = timedelta(seconds=int(os.getenv("SIGNED_URL_REFRESH_MARGIN_SECONDS", str(24 * 3600))))
+SIGNED_URL_CACHE_MAX_ENTRIES = int(os.getenv("SIGNED_URL_CACHE_MAX_ENTRIES", "10000"))
+
+# A URL is cached until SIGNED_URL_REFRESH_MARGIN before it expires
+signed_url_cache = TTLCache("signed_url", SIGNED_URL_CACHE_MAX_ENTRIES, (SIGNED_URL_TTL - SIGNED_URL_REFRESH_MARGIN).total_seconds())
+
+
+async def gcs_signed_url(storage_path: str) -> str:
+    """Return a v4 GET signed URL for a stored object, reusing a cached one while it is still fresh."""
+    url = signed_url_cache.get(storage_path)
+    if url is not CACHE_MISS:
+        return url
+
+    fill = signed_url_cache.begin_fill(storage_path)
+    blob = bucket.blob(storage_path)
     try:
-        brand_id = str(uuid.uuid4())
-        
-        # Allowed file types
-        ALLOWED_IMAGE_TYPES = ['image/jpeg', 'image/jpg', 'image/png', 'image/gif', 'image/webp', 'image/svg+xml']
-        ALLOWED_VIDEO_TYPES = ['video/mp4', 'video/avi', 'video/mov', 'video/wmv', 'video/flv', 'video/webm']
-        MAX_FILE_SIZE = 50 * 1024 * 1024  # 50MB limit
-        
-        media_info_list = []
-        
-        # Sanitize brand name for file path (remove special characters)
-        sanitized_brand_name = "".join(c for c in brandName if c.isalnum() or c in (' ', '-', '_')).rstrip()
-        sanitized_brand_name = sanitized_brand_name.replace(' ', '_')
-        
-        print(f"📁 Brand name: {brandName}")
-        print(f"📁 Sanitized brand name: {sanitized_brand_name}")
-        
-        # Process logo files provided as arrays
-        if logoFiles:
-            for i, logo_file in enumerate(logoFiles):
-                if logo_file.content_type not in ALLOWED_IMAGE_TYPES:
-                    raise HTTPException(status_code=400, detail=f"Invalid file type for logo: {logo_file.content_type}")
-                if getattr(logo_file, "size", None) and logo_file.size > MAX_FILE_SIZE:
-                    raise HTTPException(status_code=400, detail=f"File too large: {logo_file.filename}")
-                file_ext = os.path.splitext(logo_file.filename)[1]
-                media_id = str(uuid.uuid4())
-                storage_filename = f"{userId}/{sanitized_brand_name}/{brand_id}/logo/{media_id}{file_ext}"
-                print(f"📁 Uploading logo: {storage_filename}")
-                blob = bucket.blob(storage_filename)
-                blob.upload_from_file(logo_file.file, content_type=logo_file.content_type)
-                #media_url = blob.generate_signed_url(expiration=3600 * 24 * 7)
-                media_url = blob.generate_signed_url(
-                version="v4",                # use v4 signed URLs
-                expiration=timedelta(days=7), # 7 days from now
-                method="GET"                  # HTTP method allowed
-                )
-                metadata = logoMetadata[i] if logoMetadata and i < len(logoMetadata) else ""
-                media_info_list.append({
-                    "fileId": media_id,
-                    "filename": logo_file.filename,
-                    "contentType": logo_file.content_type,
-                    "fileSize": getattr(logo_file, "size", None),
-                    "url": media_url,
-                    "storagePath": storage_filename,
-                    "mediaType": "logo",
-                    "metadata": metadata,
-                    "uploadTimestamp": datetime.utcnow().isoformat()
-                })
+        url = await run_io(
+            blob.generate_signed_url,
+            version="v4",                 # use v4 signed URLs
+            expiration=SIGNED_URL_TTL,    # 7 days from now
+            method="GET"                  # HTTP method allowed
+        )
+    except Exception:
+        signed_url_cache.cancel_fill(storage_path, fill)
+        raise
+    count_metric(gcs_signed_url_counts, metrics_route.get())
+    signed_url_cache.put(storage_path, url, fill=fill)
+    return url
 
-        # Also support enumerated fields: logo_0, logo_1, ... using logoCount
-        try:
-            form = await request.form()
-        except Exception:
-            form = None
-        if form is not None:
-            raw_logo_count = form.get("logoCount")
-            try:
-                count = int(raw_logo_count) if raw_logo_count is not None else 0
-            except ValueError:
-                count = 0
-            for i in range(count):
-                field_name = f"logo_{i}"
-                if field_name not in form:
-                    continue
-                logo_file = form.get(field_name)
-                if not logo_file:
-                    continue
-                # Starlette returns UploadFile for file fields
-                if getattr(logo_file, "content_type", None) not in ALLOWED_IMAGE_TYPES:
-                    raise HTTPException(status_code=400, detail=f"Invalid file type for logo: {getattr(logo_file, 'content_type', 'unknown')}")
-                size_attr = getattr(logo_file, "size", None)
-                if size_attr and size_attr > MAX_FILE_SIZE:
-                    raise HTTPException(status_code=400, detail=f"File too large: {logo_file.filename}")
-                file_ext = os.path.splitext(logo_file.filename)[1]
-                media_id = str(uuid.uuid4())
-                storage_filename = f"{userId}/{sanitized_brand_name}/{brand_id}/logo/{media_id}{file_ext}"
-                print(f"📁 Uploading logo (enum): {storage_filename}")
-                blob = bucket.blob(storage_filename)
-                blob.upload_from_file(logo_file.file, content_type=logo_file.content_type)
-                #media_url = blob.generate_signed_url(expiration=3600 * 24 * 7)
-                media_url = blob.generate_signed_url(
-                version="v4",                # use v4 signed URLs
-                expiration=timedelta(days=7), # 7 days from now
-                method="GET"                  # HTTP method allowed
-                )
-                # Metadata key typo tolerant: logo_0_metadata or log_0_metadata
-                meta_key = f"logo_{i}_metadata"
-                alt_meta_key = f"log_{i}_metadata"
-                metadata = form.get(meta_key) or form.get(alt_meta_key) or ""
-                media_info_list.append({
-                    "fileId": media_id,
-                    "filename": logo_file.filename,
-                    "contentType": logo_file.content_type,
-                    "fileSize": size_attr,
-                    "url": media_url,
-                    "storagePath": storage_filename,
-                    "mediaType": "logo",
-                    "metadata": metadata,
-                    "uploadTimestamp": datetime.utcnow().isoformat()
-                })
-        
 
+async def sign_media_files(media_files: list):
+    """Set "url" on every mediaFiles entry that has a storagePath."""
+    entries = [m for m in media_files if "storagePath" in m]
+    urls = await asyncio.gather(*(gcs_signed_url(m["storagePath"]) for m in entries))
+    for media_file, url in zip(entries, urls):
+        media_file["url"] = url
 
-        data = {
-            "userId": userId,
-            "timestamp": timestamp,
+
+async def gcs_delete(storage_path: str) -> bool:
+    """Delete a stored object if it exists. Returns True when something was deleted."""
+    blob = bucket.blob(storage_path)
+    signed_url_cache.invalidate(storage_path)
+
+    def _delete():
+        if blob.exists():
+            blob.delete()
+            return True
+        return False
+
+    return await run_io(_delete)
+
+
+# Content-addressed storage: with CAS_ENABLED, uploads are hashed and stored
+# once under cas/{sha256}. blobRefs/{sha256} counts the records pointing at the
+# object and the object generation they point at. A reference is only added
+# for a generation that is known to exist: either the recorded one, checked
+# against the bucket, or one this process just wrote with if_generation_match=0
+# (a 412 means the object is already there and its generation is read back).
+# When the count drops to 0 the doc stays behind while the object is deleted
+# (guarded by that generation) and is removed after; a store that finds such a
+# doc finishes the release itself and uploads afresh.
+CAS_ENABLED = os.getenv("CAS_ENABLED", "false").lower() == "true"
+CAS_PREFIX = "cas/"
+CAS_STORE_ATTEMPTS = int(os.getenv("CAS_STORE_ATTEMPTS", "5"))
+
+content_store_stats = {"uploads": 0, "deduplicated": 0, "bytes_saved": 0, "released": 0, "deleted": 0}
+
+
+def _blob_ref(digest: str):
+    return db.collection("blobRefs").document(digest)
+
+
+@fs_transactional
+def _add_blob_ref_in_transaction(transaction, ref, generation: int) -> bool:
+    """Count one more reference if the object is still referenced at `generation`."""
+    snapshot = tx_get(transaction, ref)
+    data = snapshot.to_dict() if snapshot.exists else {}
+    if data.get("refCount", 0) <= 0 or data.get("generation") != generation:
+        return False
+    transaction.update(ref, {"refCount": data["refCount"] + 1, "updatedAt": datetime.utcnow().isoformat() + "Z"})
+    return True
+
+
+@fs_transactional
+def _record_blob_ref_in_transaction(transaction, ref, storage_path: str, generation: int,
+                                    size: Optional[int], content_type: Optional[str]) -> Optional[dict]:
+    """
+    Count a reference to the object at `generation`, which exists in the bucket.
+    Returns None, or the doc if it is being released at that same generation
+    (the object is about to be deleted, so it cannot be referenced).
+    """
+    snapshot = tx_get(transaction, ref)
+    data = snapshot.to_dict() if snapshot.exists else {}
+    ref_count = data.get("refCount", 0)
+    if ref_count <= 0 and snapshot.exists and data.get("generation") == generation:
+        return data
+    now = datetime.utcnow().isoformat() + "Z"
+    if ref_count <= 0:
+        # New, or left at 0 by a release whose object is already gone
+        transaction.set(ref, {
+            "refCount": 1, "storagePath": storage_path, "generation": generation, "size": size,
+            "contentType": content_type, "createdAt": now, "updatedAt": now,
+        })
+    else:
+        # A doc left by an upload that never recorded its generation adopts this one
+        transaction.update(ref, {"refCount": ref_count + 1, "generation": generation, "updatedAt": now})
+    return None
+
+
+@fs_transactional
+def _release_blob_ref_in_transaction(transaction, ref) -> Optional[dict]:
+    """Drop one reference. Returns the doc if that was the last one."""
+    snapshot = tx_get(transaction, ref)
+    if not snapshot.exists:
+        return None
+    data = snapshot.to_dict()
+    if data.get("refCount", 0) <= 0:
+        return None
+    ref_count = data["refCount"] - 1
+    now = datetime.utcnow().isoformat() + "Z"
+    if ref_count > 0:
+        transaction.update(ref, {"refCount": ref_count, "updatedAt": now})
+        return None
+    transaction.update(ref, {"refCount": 0, "releasedAt": now, "updatedAt": now})
+    return data
+
+
+@fs_transactional
+def _forget_blob_ref_in_transaction(transaction, ref, generation: Optional[int]):
+    """Delete the doc of a released object, unless it was referenced again meanwhile."""
+    snapshot = tx_get(transaction, ref)
+    if not snapshot.exists:
+        return
+    data = snapshot.to_dict()
+    if data.get("refCount", 0) <= 0 and data.get("generation") == generation:
+        transaction.delete(ref)
+
+
+async def _finish_blob_release(storage_path: str, ref, generation: Optional[int]) -> bool:
+    """Delete a released object at `generation`, then its doc. Returns True when the object was deleted."""
+    signed_url_cache.invalidate(storage_path)
+
+    def _delete():
+        if generation is None:
+            return False
+        try:
+            bucket.blob(storage_path).delete(if_generation_match=generation)
+            return True
+        except (NotFound, PreconditionFailed):
+            # Already gone, or replaced by a newer upload
+            return False
+
+    deleted = await run_io(_delete)
+    await run_io(lambda: _forget_blob_ref_in_transaction(db.transaction(), ref, generation))
+    if deleted:
+        content_store_stats["deleted"] += 1
+    return deleted
+
+
+async def gcs_store_content_addressed(file_obj, content_type: Optional[str] = None):
+    """Store a file under its sha256, uploading only if no stored copy is referenced. Returns the blob."""
+    digest = await hash_media(file_obj)
+    storage_path = f"{CAS_PREFIX}{digest}"
+    ref = _blob_ref(digest)
+
+    # Dedup against the recorded generation only if that object still exists
+    snapshot = await fs_get(ref)
+    recorded = snapshot.to_dict() if snapshot.exists else {}
+    if recorded.get("refCount", 0) > 0 and recorded.get("generation") is not None:
+        blob = await run_io(bucket.get_blob, storage_path)
+        if blob is not None and blob.generation == recorded["generation"] and await run_io(
+            lambda: _add_blob_ref_in_transaction(db.transaction(), ref, blob.generation)
+        ):
+            content_store_stats["deduplicated"] += 1
+            content_store_stats["bytes_saved"] += await run_io(_media_size, file_obj)
+            return blob
+
+    for _ in range(CAS_STORE_ATTEMPTS):
+        await run_io(file_obj.seek, 0)
+        try:
+            blob = await gcs_upload_file(storage_path, file_obj, content_type=content_type, if_generation_match=0)
+            uploaded = True
+        except PreconditionFailed:
+            blob = await run_io(bucket.get_blob, storage_path)
+            if blob is None:
+                continue  # deleted between the two calls
+            uploaded = False
+        releasing = await run_io(
+            lambda: _record_blob_ref_in_transaction(db.transaction(), ref, storage_path, blob.generation, blob.size, content_type)
+        )
+        if releasing is None:
+            if uploaded:
+                content_store_stats["uploads"] += 1
+            else:
+                content_store_stats["deduplicated"] += 1
+                content_store_stats["bytes_saved"] += blob.size or 0
+            return blob
+        await _finish_blob_release(storage_path, ref, releasing.get("generation"))
+    raise RuntimeError(f"Could not store {storage_path}: it kept being released")
+
+
+async def gcs_store_upload(storage_path: str, file_obj, content_type: Optional[str] = None):
+    """Upload a file at storage_path, or content-addressed when CAS_ENABLED. Use blob.name as the stored path."""
+    if CAS_ENABLED:
+        return await gcs_store_content_addressed(file_obj, content_type)
+    return await gcs_upload_file(storage_path, file_obj, content_type=content_type)
+
+
+async def gcs_release(storage_path: str) -> bool:
+    """
+    Let go of a stored object. Content-addressed objects are deleted only when
+    no other record refers to them; anything else is deleted outright.
+    Returns True when the object was deleted.
+    """
+    if not storage_path.startswith(CAS_PREFIX):
+        return await gcs_delete(storage_path)
+
+    ref = _blob_ref(storage_path[len(CAS_PREFIX):])
+    released = await run_io(lambda: _release_blob_ref_in_transaction(db.transaction(), ref))
+    content_store_stats["released"] += 1
+    if released is None:
+        return False
+    if released.get("generation") is None:
+        logger.warning("Last reference to %s dropped before its upload was recorded; leaving the object", storage_path)
+    return await _finish_blob_release(storage_path, ref, released.get("generation"))
+
+
+UPLOAD_PARALLELISM = int(os.getenv("UPLOAD_PARALLELISM", "4"))
+
+
+def sanitize_brand_name(brand_name: str) -> str:
+    """Brand name reduced to characters that are safe in a storage path."""
+    sanitized = "".join(c for c in brand_name if c.isalnum() or c in (' ', '-', '_')).rstrip()
+    return sanitized.replace(' ', '_')
+
+
+async def rollback_uploads(storage_paths: list):
+    """Best-effort delete of blobs written by a request that is being abandoned."""
+    if not storage_paths:
+        return
+    outcomes = await asyncio.gather(*(gcs_release(path) for path in storage_paths), return_exceptions=True)
+    for path, outcome in zip(storage_paths, outcomes):
+        if isinstance(outcome, Exception):
+            logger.warning("Could not roll back upload %s: %s", path, outcome)
+    logger.info("Rolled back %s uploaded file(s)", len(storage_paths))
+
+
+async def upload_files_parallel(uploads: list, sign: bool = True) -> list:
+    """
+    Upload [(storage_path, file_obj, content_type), ...] concurrently, at most
+    UPLOAD_PARALLELISM at a time. Returns [(blob, signed_url or None), ...] in
+    input order; blob.name is where each file was stored (see gcs_store_upload).
+    If any upload fails, the blobs already written are released and the first
+    error is raised.
+    """
+    slots = asyncio.Semaphore(UPLOAD_PARALLELISM)
+    uploaded = []
+
+    async def _upload(storage_path, file_obj, content_type):
+        async with slots:
+            blob = await gcs_store_upload(storage_path, file_obj, content_type=content_type)
+            uploaded.append(blob.name)
+            url = await gcs_signed_url(blob.name) if sign else None
+            return blob, url
+
+    outcomes = await asyncio.gather(*(_upload(*upload) for upload in uploads), return_exceptions=True)
+    errors = [outcome for outcome in outcomes if isinstance(outcome, BaseException)]
+    if errors:
+        await rollback_uploads(uploaded)
+        raise errors[0]
+    return outcomes
+
+
+# ===============================
+# Upstream model HTTP client
+# ===============================
+# One keep-alive connection pool shared by every feature_api_config model call.
+# The client lives for the lifetime of the app; per-host semaphores cap how many
+# requests a single upstream host sees at once.
+
+UPSTREAM_MAX_CONNECTIONS = int(os.getenv("UPSTREAM_MAX_CONNECTIONS", "100"))
+UPSTREAM_MAX_KEEPALIVE = int(os.getenv("UPSTREAM_MAX_KEEPALIVE", "20"))
+UPSTREAM_KEEPALIVE_EXPIRY = float(os.getenv("UPSTREAM_KEEPALIVE_EXPIRY", "60"))
+UPSTREAM_MAX_PER_HOST = int(os.getenv("UPSTREAM_MAX_PER_HOST", "20"))
+UPSTREAM_CONNECT_TIMEOUT = float(os.getenv("UPSTREAM_CONNECT_TIMEOUT", "10"))
+UPSTREAM_POOL_TIMEOUT = float(os.getenv("UPSTREAM_POOL_TIMEOUT", "30"))
+UPSTREAM_READ_TIMEOUT = float(os.getenv("UPSTREAM_READ_TIMEOUT", "1200"))
+
+upstream_client: Optional[httpx.AsyncClient] = None
+upstream_host_slots: dict[str, asyncio.Semaphore] = {}
+upstream_host_stats: dict[str, dict] = {}
+
+
+@app.on_event("startup")
+async def start_upstream_client():
+    global upstream_client
+    upstream_client = httpx.AsyncClient(
+        limits=httpx.Limits(
+            max_connections=UPSTREAM_MAX_CONNECTIONS,
+            max_keepalive_connections=UPSTREAM_MAX_KEEPALIVE,
+            keepalive_expiry=UPSTREAM_KEEPALIVE_EXPIRY,
+        ),
+        timeout=httpx.Timeout(
+            UPSTREAM_READ_TIMEOUT,
+            connect=UPSTREAM_CONNECT_TIMEOUT,
+            pool=UPSTREAM_POOL_TIMEOUT,
+        ),
+    )
+
+
+async def stop_upstream_client():
+    """Shutdown handler, registered at the end of the module: after the analysis workers stop."""
+    global upstream_client
+    if upstream_client is not None:
+        await upstream_client.aclose()
+        upstream_client = None
+
+
+def _upstream_host(url: str) -> str:
+    return urlsplit(url).netloc
+
+
+async def upstream_post(url: str, data: dict, files: Optional[dict] = None, timeout: Optional[float] = None) -> httpx.Response:
+    """POST to an upstream model through the shared pool, respecting the per-host limit."""
+    host = _upstream_host(url)
+    slots = upstream_host_slots.setdefault(host, asyncio.Semaphore(UPSTREAM_MAX_PER_HOST))
+    stats = upstream_host_stats.setdefault(host, {
+        "in_flight": 0,
+        "waiting": 0,
+        "peak_in_flight": 0,
+        "requests": 0,
+        "errors": 0,
+        "total_seconds": 0.0,
+    })
+
+    stats["waiting"] += 1
+    try:
+        await slots.acquire()
+    finally:
+        stats["waiting"] -= 1
+
+    stats["in_flight"] += 1
+    stats["peak_in_flight"] = max(stats["peak_in_flight"], stats["in_flight"])
+    model = urlsplit(url).path.rstrip("/").rsplit("/", 1)[-1]
+    status = "error"
+    started = time.perf_counter()
+    try:
+        kwargs = {"data": data, "files": files}
+        if timeout is not None:
+            kwargs["timeout"] = httpx.Timeout(timeout, connect=UPSTREAM_CONNECT_TIMEOUT, pool=UPSTREAM_POOL_TIMEOUT)
+        response = await upstream_client.post(url, **kwargs)
+        status = response.status_code
+        return response
+    except httpx.HTTPError:
+        stats["errors"] += 1
+        raise
+    finally:
+        elapsed = time.perf_counter() - started
+        stats["in_flight"] -= 1
+        stats["requests"] += 1
+        stats["total_seconds"] += elapsed
+        observe(upstream_histograms.setdefault(model, new_histogram()), elapsed)
+        count_metric(upstream_status_counts, (model, status))
+        slots.release()
+
+
+async def call_feature_model(feature: str, form_data: dict, files: Optional[dict] = None, timeout: Optional[float] = None) -> dict:
+    """
+    Call one of the feature_api_config models and return its ai_analysis_results entry:
+    {"success": True, "data": ...} or {"success": False, "error": ..., ["status_code": ...]}.
+    """
+    feature_config = feature_api_config.get(feature)
+    if not feature_config:
+        return {"success": False, "error": f"No API configured for {feature}"}
+
+    url = feature_config["url"]
+    logger.info("Calling %s at %s", feature, url)
+    try:
+        response = await upstream_post(url, form_data, files, timeout=timeout)
+    except httpx.HTTPError as e:
+        logger.error("%s: Exception - %s", feature, e)
+        return {"success": False, "error": str(e) or type(e).__name__}
+
+    if response.status_code == 200:
+        try:
+            result = {"success": True, "data": response.json()}
+            logger.info("%s: Success", feature)
+        except json.JSONDecodeError:
+            result = {"success": True, "data": response.text}
+            logger.info("%s: Success (non-JSON response)", feature)
+        return result
+
+    logger.error("%s: Failed - %s", feature, response.status_code)
+    return {
+        "success": False,
+        "status_code": response.status_code,
+        "error": response.text
+    }
+
+
+# ===============================
+# Media streaming
+# ===============================
+
+MEDIA_CHUNK_SIZE = int(os.getenv("MEDIA_CHUNK_SIZE", str(1024 * 1024)))
+
+
+class _PositionalReader(io.RawIOBase):
+    """Read-only view over a file descriptor with its own offset (os.pread), so
+    several consumers can stream the same upload without sharing a file position."""
+
+    def __init__(self, fd: int, size: int):
+        self._fd = fd
+        self._size = size
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self._pos = offset
+        elif whence == io.SEEK_CUR:
+            self._pos += offset
+        elif whence == io.SEEK_END:
+            self._pos = self._size + offset
+        else:
+            raise ValueError(f"Invalid whence: {whence}")
+        return self._pos
+
+    def readinto(self, buffer):
+        remaining = self._size - self._pos
+        if remaining <= 0:
+            return 0
+        data = os.pread(self._fd, min(len(buffer), remaining), self._pos)
+        buffer[:len(data)] = data
+        self._pos += len(data)
+        return len(data)
+
+
+def _media_size(media_file) -> int:
+    position = media_file.tell()
+    media_file.seek(0, io.SEEK_END)
+    size = media_file.tell()
+    media_file.seek(position)
+    return size
+
+
+def _open_media_reader(media_file):
+    media_file.flush()
+    reader = _PositionalReader(media_file.fileno(), _media_size(media_file))
+    return io.BufferedReader(reader, buffer_size=MEDIA_CHUNK_SIZE)
+
+
+async def open_media_reader(media_file):
+    """
+    Independent, seekable reader over an uploaded/spooled media file. The bytes
+    stay on disk and are streamed in MEDIA_CHUNK_SIZE pieces by whoever reads it
+    (upstream multipart body, hashing), so memory does not grow with file size.
+    """
+    return await run_io(_open_media_reader, media_file)
+
+
+def _hash_media(media_file) -> str:
+    digest = hashlib.sha256()
+    with _open_media_reader(media_file) as reader:
+        for chunk in iter(lambda: reader.read(MEDIA_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+async def hash_media(media_file) -> str:
+    """sha256 of a media file, computed chunk by chunk off the event loop."""
+    return await run_io(_hash_media, media_file)
+
+
+# ===============================
+# Image preprocessing
+# ===============================
+# The models do not need camera-resolution pixels. With IMAGE_PREPROCESS_ENABLED
+# (and Pillow installed) image creatives are downsized to IMAGE_MAX_DIMENSION
+# and re-encoded before the upstream call; the original is still what is
+# archived in GCS. image_preprocess_stats compares bytes sent and upstream
+# latency with and without the stage.
+
+IMAGE_PREPROCESS_ENABLED = os.getenv("IMAGE_PREPROCESS_ENABLED", "false").lower() == "true"
+IMAGE_MAX_DIMENSION = int(os.getenv("IMAGE_MAX_DIMENSION", "1568"))
+IMAGE_JPEG_QUALITY = int(os.getenv("IMAGE_JPEG_QUALITY", "85"))
+IMAGE_PREPROCESS_TYPES = ['image/jpeg', 'image/jpg', 'image/png', 'image/webp']
+
+image_preprocess_stats = {
+    "processed": 0,
+    "skipped": 0,
+    "errors": 0,
+    "bytes_before": 0,
+    "bytes_after": 0,
+    "preprocess_seconds": 0.0,
+    "upstream_calls_processed": 0,
+    "upstream_seconds_processed": 0.0,
+    "upstream_bytes_processed": 0,
+    "upstream_calls_original": 0,
+    "upstream_seconds_original": 0.0,
+    "upstream_bytes_original": 0,
+}
+
+
+def image_preprocess_variant(content_type: str) -> str:
+    """Part of the result cache key: results on downsized input are not reused for the original and vice versa."""
+    if IMAGE_PREPROCESS_ENABLED and Image is not None and content_type in IMAGE_PREPROCESS_TYPES:
+        return f"img{IMAGE_MAX_DIMENSION}q{IMAGE_JPEG_QUALITY}"
+    return ""
+
+
+def _downsize_image(media_file) -> Optional[tuple]:
+    with _open_media_reader(media_file) as reader:
+        image = Image.open(reader)
+        image.load()
+    original_size = image.size
+    if max(original_size) <= IMAGE_MAX_DIMENSION:
+        return None
+
+    image = ImageOps.exif_transpose(image)
+    image.thumbnail((IMAGE_MAX_DIMENSION, IMAGE_MAX_DIMENSION), Image.LANCZOS)
+    has_alpha = image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info)
+    output = tempfile.SpooledTemporaryFile(max_size=1024 * 1024)
+    if has_alpha:
+        image.save(output, format="PNG", optimize=True)
+        content_type, extension = "image/png", ".png"
+    else:
+        image.convert("RGB").save(output, format="JPEG", quality=IMAGE_JPEG_QUALITY, optimize=True, progressive=True)
+        content_type, extension = "image/jpeg", ".jpg"
+    output.seek(0)
+    return output, content_type, extension, original_size, image.size
+
+
+async def preprocess_image(media_file, filename: str, content_type: str) -> dict:
+    """
+    Media to send upstream: {"file", "filename", "content_type", "preprocessing"}.
+    Falls back to the original file when the stage is off, the media is not a
+    raster image, it is already small enough, or re-encoding does not help.
+    """
+    upstream_media = {"file": media_file, "filename": filename, "content_type": content_type, "preprocessing": None}
+    if not image_preprocess_variant(content_type):
+        return upstream_media
+
+    started = time.perf_counter()
+    try:
+        downsized = await run_io(_downsize_image, media_file)
+    except Exception as e:
+        image_preprocess_stats["errors"] += 1
+        logger.warning("Image preprocessing failed, sending the original: %s", e)
+        return upstream_media
+    elapsed = time.perf_counter() - started
+
+    bytes_before = await run_io(_media_size, media_file)
+    if downsized is None:
+        image_preprocess_stats["skipped"] += 1
+        return upstream_media
+    output, new_content_type, extension, original_size, new_size = downsized
+    bytes_after = await run_io(_media_size, output)
+    if bytes_after >= bytes_before:
+        output.close()
+        image_preprocess_stats["skipped"] += 1
+        return upstream_media
+
+    image_preprocess_stats["processed"] += 1
+    image_preprocess_stats["bytes_before"] += bytes_before
+    image_preprocess_stats["bytes_after"] += bytes_after
+    image_preprocess_stats["preprocess_seconds"] += elapsed
+    logger.info("Downsized %s: %sx%s -> %sx%s, %s -> %s bytes", filename, original_size[0], original_size[1], new_size[0], new_size[1], bytes_before, bytes_after)
+    return {
+        "file": output,
+        "filename": os.path.splitext(filename)[0] + extension,
+        "content_type": new_content_type,
+        "preprocessing": {
+            "originalDimensions": list(original_size),
+            "dimensions": list(new_size),
+            "bytesBefore": bytes_before,
+            "bytesAfter": bytes_after,
+            "contentType": new_content_type,
+            "seconds": round(elapsed, 3),
+        },
+    }
+
+
+def record_upstream_timing(upstream_media: dict, seconds: float):
+    """Attribute an upstream call's latency and payload size to the preprocessed or original bucket."""
+    preprocessing = upstream_media["preprocessing"]
+    bucket_name = "processed" if preprocessing else "original"
+    image_preprocess_stats[f"upstream_calls_{bucket_name}"] += 1
+    image_preprocess_stats[f"upstream_seconds_{bucket_name}"] += seconds
+    if preprocessing:
+        image_preprocess_stats["upstream_bytes_processed"] += preprocessing["bytesAfter"]
+    else:
+        image_preprocess_stats["upstream_bytes_original"] += _media_size(upstream_media["file"])
+
+
+# ===============================
+# Video keyframes
+# ===============================
+# With VIDEO_KEYFRAMES_ENABLED, video creatives are not forwarded whole:
+# a frame extractor picks VIDEO_KEYFRAME_COUNT frames plus duration and
+# resolution, and the models receive a small zip bundle (frame JPEGs and
+# metadata.json) with the metadata repeated as form fields. Decoding is CPU
+# bound, so extractors run in a process pool. Bundles are cached in GCS and
+# Firestore by media hash and extractor settings.
+#
+# Extractors are registered in VIDEO_FRAME_EXTRACTORS: fn(path, frame_count,
+# max_dimension, jpeg_quality) -> (bundle_bytes, metadata dict). They live in
+# video_keyframes, which a pool worker can import without importing this
+# module (and with it the app, its clients and config). The bundle format is
+# documented there; the stage stays off until the deployed models list it in
+# UPSTREAM_FRAME_BUNDLE_FORMATS, and every bundle is checked against it
+# before it is cached or sent.
+
+VIDEO_KEYFRAMES_ENABLED = os.getenv("VIDEO_KEYFRAMES_ENABLED", "false").lower() == "true"
+VIDEO_FRAME_EXTRACTOR = os.getenv("VIDEO_FRAME_EXTRACTOR", "opencv")
+VIDEO_KEYFRAME_COUNT = int(os.getenv("VIDEO_KEYFRAME_COUNT", "8"))
+VIDEO_FRAME_MAX_DIMENSION = int(os.getenv("VIDEO_FRAME_MAX_DIMENSION", "768"))
+VIDEO_FRAME_JPEG_QUALITY = int(os.getenv("VIDEO_FRAME_JPEG_QUALITY", "80"))
+VIDEO_EXTRACT_WORKERS = int(os.getenv("VIDEO_EXTRACT_WORKERS", "2"))
+UPSTREAM_FRAME_BUNDLE_FORMATS = {f.strip() for f in os.getenv("UPSTREAM_FRAME_BUNDLE_FORMATS", "").split(",") if f.strip()}
+VIDEO_KEYFRAME_TYPES = ['video/mp4', 'video/avi', 'video/mov', 'video/wmv', 'video/flv', 'video/webm']
+
+video_process_pool: Optional[ProcessPoolExecutor] = None
+video_keyframe_stats = {"extracted": 0, "cache_hits": 0, "errors": 0, "extract_seconds": 0.0, "bytes_before": 0, "bytes_after": 0}
+
+
+VIDEO_FRAME_EXTRACTORS = {
+    "opencv": video_keyframes.extract_keyframes_opencv,
+}
+
+
+def video_keyframe_variant(content_type: str) -> str:
+    """Extractor settings; part of the result and bundle cache keys."""
+    if VIDEO_KEYFRAMES_ENABLED and content_type in VIDEO_KEYFRAME_TYPES and _frame_extractor_available():
+        return (f"kf{VIDEO_FRAME_EXTRACTOR}{VIDEO_KEYFRAME_COUNT}d{VIDEO_FRAME_MAX_DIMENSION}"
+                f"q{VIDEO_FRAME_JPEG_QUALITY}v{video_keyframes.BUNDLE_VERSION}")
+    return ""
+
+
+def _frame_extractor_available() -> bool:
+    if video_keyframes.BUNDLE_FORMAT not in UPSTREAM_FRAME_BUNDLE_FORMATS:
+        return False
+    if VIDEO_FRAME_EXTRACTOR not in VIDEO_FRAME_EXTRACTORS:
+        return False
+    return VIDEO_FRAME_EXTRACTOR != "opencv" or video_keyframes.cv2 is not None
+
+
+@app.on_event("startup")
+async def start_video_process_pool():
+    global video_process_pool
+    if VIDEO_KEYFRAMES_ENABLED and video_keyframes.BUNDLE_FORMAT not in UPSTREAM_FRAME_BUNDLE_FORMATS:
+        logger.warning("Video keyframes stay off: the models do not accept %s bundles", video_keyframes.BUNDLE_FORMAT)
+    if VIDEO_KEYFRAMES_ENABLED and _frame_extractor_available():
+        # spawn, not fork: the parent holds gRPC and executor threads
+        video_process_pool = ProcessPoolExecutor(
+            max_workers=VIDEO_EXTRACT_WORKERS,
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+
+
+async def stop_video_process_pool():
+    """Shutdown handler, registered at the end of the module: after the analysis workers stop."""
+    if video_process_pool is not None:
+        video_process_pool.shutdown(wait=False, cancel_futures=True)
+
+
+def _spool_to_named_file(media_file, suffix: str) -> str:
+    """Copy media to a named temp file (chunk by chunk) so another process can open it."""
+    with tempfile.NamedTemporaryFile(suffix=suffix, delete=False) as target:
+        with _open_media_reader(media_file) as reader:
+            for chunk in iter(lambda: reader.read(MEDIA_CHUNK_SIZE), b""):
+                target.write(chunk)
+        return target.name
+
+
+async def _extract_keyframes(media_file, filename: str) -> tuple:
+    path = await run_io(_spool_to_named_file, media_file, os.path.splitext(filename)[1])
+    try:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            video_process_pool,
+            VIDEO_FRAME_EXTRACTORS[VIDEO_FRAME_EXTRACTOR],
+            path,
+            VIDEO_KEYFRAME_COUNT,
+            VIDEO_FRAME_MAX_DIMENSION,
+            VIDEO_FRAME_JPEG_QUALITY,
+        )
+    finally:
+        await run_io(os.unlink, path)
+
+
+async def extract_video_keyframes(media_file, filename: str, content_type: str, media_digest: str) -> dict:
+    """
+    Media to send upstream for a video: the keyframe bundle when the stage is
+    on and extraction succeeds, otherwise the original file. Same shape as
+    preprocess_image, plus "form_fields" for the upstream request.
+    """
+    upstream_media = {"file": media_file, "filename": filename, "content_type": content_type, "preprocessing": None, "form_fields": {}}
+    variant = video_keyframe_variant(content_type)
+    if not variant or video_process_pool is None:
+        return upstream_media
+
+    cache_id = f"{media_digest}-{variant}"
+    cache_ref = db.collection("video_keyframes").document(cache_id)
+    bundle_path = f"keyframes/{cache_id}.zip"
+    bundle_file = None
+    try:
+        cached = await fs_get(cache_ref)
+        if cached.exists:
+            metadata = cached.to_dict()["metadata"]
+            bundle_file = await gcs_download_to_spooled(bundle_path)
+            video_keyframe_stats["cache_hits"] += 1
+            seconds = 0.0
+        else:
+            started = time.perf_counter()
+            bundle, _ = await _extract_keyframes(media_file, filename)
+            metadata = video_keyframes.check_bundle(bundle)
+            seconds = time.perf_counter() - started
+            bundle_file = tempfile.SpooledTemporaryFile(max_size=1024 * 1024)
+            bundle_file.write(bundle)
+            bundle_file.seek(0)
+            await gcs_upload_bytes(bundle_path, bundle, content_type="application/zip")
+            await fs_set(cache_ref, {
+                "mediaHash": media_digest,
+                "variant": variant,
+                "storagePath": bundle_path,
+                "metadata": metadata,
+                "createdAt": datetime.utcnow().isoformat() + "Z",
+            })
+            video_keyframe_stats["extracted"] += 1
+            video_keyframe_stats["extract_seconds"] += seconds
+    except Exception as e:
+        if bundle_file is not None:
+            bundle_file.close()
+        video_keyframe_stats["errors"] += 1
+        logger.warning("Keyframe extraction failed, sending the full video: %s", e)
+        return upstream_media
+
+    bytes_before = await run_io(_media_size, media_file)
+    bytes_after = await run_io(_media_size, bundle_file)
+    video_keyframe_stats["bytes_before"] += bytes_before
+    video_keyframe_stats["bytes_after"] += bytes_after
+    logger.info("Sending %s keyframes for %s: %s -> %s bytes", len(metadata['frames']), filename, bytes_before, bytes_after)
+    return {
+        "file": bundle_file,
+        "filename": os.path.splitext(filename)[0] + "_frames.zip",
+        "content_type": "application/zip",
+        "preprocessing": {
+            "keyframes": metadata,
+            "bundleStoragePath": bundle_path,
+            "bytesBefore": bytes_before,
+            "bytesAfter": bytes_after,
+            "seconds": round(seconds, 3),
+        },
+        "form_fields": {
+            "media_kind": "frame_bundle",
+            "bundle_format": metadata["format"],
+            "original_content_type": content_type,
+            "video_duration": str(metadata.get("durationSeconds") or ""),
+            "video_resolution": f"{metadata.get('width')}x{metadata.get('height')}",
+            "frame_timestamps": ",".join(str(frame["timestamp"]) for frame in metadata["frames"]),
+        },
+    }
+
+
+async def prepare_upstream_media(media_file, filename: str, content_type: str, media_digest: str) -> dict:
+    """Run the pre-analysis stage for the media type (image downsizing or video keyframes)."""
+    if content_type in VIDEO_KEYFRAME_TYPES:
+        return await extract_video_keyframes(media_file, filename, content_type, media_digest)
+    upstream_media = await preprocess_image(media_file, filename, content_type)
+    upstream_media["form_fields"] = {}
+    return upstream_media
+
+
+@app.post("/save-user-profile")
+async def save_user_profile(profile: UserProfile):
+    try:
+        # Create unique ID for the user
+        user_id = str(uuid.uuid4())
+ 
+        # Prepare data
+        data = profile.dict()
+        data["user_id"] = user_id
+ 
+        # Save to Firebase Firestore
+        await fs_set(db.collection("user_profiles").document(user_id), data)
+        logger.debug("saveuser")
+        return {"message": "User profile saved successfully", "user_id": user_id}
+   
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+ 
+@app.get("/get-user-profile/{user_id}")
+async def get_user_profile(user_id: str):
+    try:
+        # Fetch document by ID from Firestore
+        doc_ref = db.collection("userProfileDetails").document(user_id)
+        doc = await fs_get(doc_ref)
+        logger.debug("getuser")
+        if not doc.exists:
+            raise HTTPException(status_code=404, detail="User profile not found")
+
+        profile_data = doc.to_dict()
+        
+        # Note: Removed hardcoded max_ads_per_month correction logic
+        # The database now stores the correct values for topup/upgrade scenarios
+        # where users may have combined plans (e.g., Pro + Pro = 22 ads/month)
+
+        return profile_data
+
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+ 
+@app.post("/UserProfileDetails")
+async def post_user_profile(profile: UserProfile):
+    try:
+       # user_id = str(uuid.uuid4())
+        data = profile.dict()
+        user_id = data["userId"]
+        logger.debug("postuser")
+        await fs_set(db.collection("userProfileDetails").document(user_id), data)
+        return {"message": "User profile saved successfully", "user_id": user_id}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.patch("/updateUserProfileDetails/{user_id}")
+async def update_user_profile_details(user_id: str, request: Request):
+    """Merge arbitrary updates into userProfileDetails. Accepts JSON { updates: {...}, timestamp?: str }"""
+    try:
+        try:
+            payload = await request.json()
+        except Exception:
+            raise HTTPException(status_code=400, detail="Invalid JSON body")
+
+        updates = payload.get("updates", {})
+        if not isinstance(updates, dict):
+            raise HTTPException(status_code=400, detail="'updates' must be an object")
+
+        # Always bump updatedAt
+        updates.setdefault("updatedAt", datetime.utcnow().isoformat())
+
+        profile_ref = db.collection("userProfileDetails").document(user_id)
+        await fs_set(profile_ref, updates, merge=True)
+        return {"message": "User profile updated", "user_id": user_id}
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+ 
+# ===============================
+# Brand media
+# ===============================
+# Each media file is its own document in brandData/{brandId}/media/{fileId};
+# the brand document only keeps mediaCount, maintained with Increment. Adding
+# or removing a file touches that file's record and the counter, nothing else.
+# Brands written before this still carry a mediaFiles array, which the
+# readers below merge in and delete_brand_media can remove from.
+
+def brand_media_collection(brand_id: str):
+    return db.collection("brandData").document(brand_id).collection("media")
+
+
+def _media_sort_key(media: dict):
+    return media.get("uploadTimestamp") or ""
+
+
+async def save_brand_media(brand_id: str, user_id: str, media_files: list, brand_doc: Optional[dict] = None):
+    """
+    Write media records and bump mediaCount in one batch. With brand_doc the
+    brand document itself is created in the same batch.
+    """
+    brand_ref = db.collection("brandData").document(brand_id)
+    media_ref = brand_media_collection(brand_id)
+
+    batch = db.batch()
+    if brand_doc is not None:
+        batch.set(brand_ref, {**brand_doc, "mediaCount": len(media_files)})
+    else:
+        batch.update(brand_ref, {"mediaCount": firestore.Increment(len(media_files))})
+    for media in media_files:
+        batch.set(media_ref.document(media["fileId"]), {**media, "brandId": brand_id, "userId": user_id})
+
+    try:
+        await fs_commit(batch)
+    finally:
+        invalidate_brand_cache(brand_id)
+
+
+@fs_transactional
+def _delete_media_in_transaction(transaction, brand_ref, file_id: str) -> Optional[dict]:
+    media_ref = brand_ref.collection("media").document(file_id)
+    media_snapshot = tx_get(transaction, media_ref)
+    if media_snapshot.exists:
+        transaction.delete(media_ref)
+        transaction.update(brand_ref, {"mediaCount": firestore.Increment(-1)})
+        return media_snapshot.to_dict()
+
+    # Legacy brands keep their media in the mediaFiles array
+    brand_snapshot = tx_get(transaction, brand_ref)
+    legacy_media = (brand_snapshot.to_dict() or {}).get("mediaFiles", []) if brand_snapshot.exists else []
+    for media in legacy_media:
+        if media.get("fileId") == file_id:
+            transaction.update(brand_ref, {
+                "mediaFiles": firestore.ArrayRemove([media]),
+                "mediaCount": firestore.Increment(-1),
+            })
+            return media
+    return None
+
+
+async def delete_brand_media(brand_id: str, file_id: str) -> Optional[dict]:
+    """Remove one media record and decrement mediaCount. Returns the record, or None if absent."""
+    brand_ref = db.collection("brandData").document(brand_id)
+    try:
+        return await run_io(lambda: _delete_media_in_transaction(db.transaction(), brand_ref, file_id))
+    finally:
+        invalidate_brand_cache(brand_id)
+
+
+async def load_brand_media(brand_id: str, brand_data: dict) -> list:
+    """All media of one brand (subcollection plus legacy mediaFiles), oldest first."""
+    docs = await fs_stream(brand_media_collection(brand_id))
+    media_files = list(brand_data.get("mediaFiles", [])) + [doc.to_dict() for doc in docs]
+    return sorted(media_files, key=_media_sort_key)
+
+
+async def load_user_brand_media(user_id: str) -> dict:
+    """Media of every brand a user owns in one collection-group query: {brandId: [media, ...]}."""
+    # Needs the collection-group userId index in firestore.indexes.json
+    # (firebase deploy --only firestore:indexes)
+    docs = await fs_stream(db.collection_group("media").where("userId", "==", user_id))
+    media_by_brand = {}
+    for doc in docs:
+        media = doc.to_dict()
+        media_by_brand.setdefault(media.get("brandId") or doc.reference.parent.parent.id, []).append(media)
+    return media_by_brand
+
+
+# ===============================
+# Brand cache
+# ===============================
+# Every analysis needs a brand's owner, name, tone, palette and first logo.
+# brand_cache keeps just those fields per brand, pre-digested from the brand
+# document and its media, so a submission for a known brand does no Firestore
+# read. The media writers above invalidate it, and a fill whose read
+# overlapped an invalidation of that brand is not cached.
+
+BRAND_CACHE_TTL_SECONDS = float(os.getenv("BRAND_CACHE_TTL_SECONDS", "300"))
+BRAND_CACHE_MAX_ENTRIES = int(os.getenv("BRAND_CACHE_MAX_ENTRIES", "2000"))
+BRAND_LOGO_FIELDS = ("fileId", "filename", "contentType", "fileSize", "storagePath", "mediaType", "url")
+
+# brandId -> summary, or None for a brand that does not exist
+brand_cache = TTLCache("brand", BRAND_CACHE_MAX_ENTRIES, BRAND_CACHE_TTL_SECONDS)
+
+
+def _brand_summary(brand_data: dict, media_files: list) -> dict:
+    """The fields an analysis needs from a brand; media_files must be oldest first."""
+    primary_logo = next((m for m in media_files if m.get("mediaType") == "logo"), None)
+    return {
+        "userId": brand_data.get("userId"),
+        "brandName": brand_data.get("brandName", "Unknown Brand"),
+        "brandLogo": brand_data.get("brandLogo", "default_logo.png"),
+        "toneOfVoice": brand_data.get("toneOfVoice", "Professional and friendly"),
+        "colorPalette": brand_data.get("colorPalette", "#FF0000,#00FF00,#0000FF"),
+        "primaryLogo": {k: primary_logo[k] for k in BRAND_LOGO_FIELDS if k in primary_logo} if primary_logo else None,
+    }
+
+
+async def get_brand_summary(brand_id: str) -> Optional[dict]:
+    """Compact record of a brand (None if it does not exist), served from brand_cache while fresh."""
+    summary = brand_cache.get(brand_id)
+    if summary is not CACHE_MISS:
+        return summary
+
+    fill = brand_cache.begin_fill(brand_id)
+    try:
+        brand_doc = await fs_get(db.collection("brandData").document(brand_id))
+        brand_data = brand_doc.to_dict() if brand_doc.exists else None
+        media_files = await load_brand_media(brand_id, brand_data) if brand_data is not None else []
+    except Exception:
+        brand_cache.cancel_fill(brand_id, fill)
+        raise
+    summary = _brand_summary(brand_data, media_files) if brand_data is not None else None
+    brand_cache.put(brand_id, summary, fill=fill)
+    return summary
+
+
+def invalidate_brand_cache(brand_id: str):
+    """Forget a brand after its document or media changed."""
+    brand_cache.invalidate(brand_id)
+
+
+@app.post("/branddata-form")
+async def receive_brand_form(
+    request: Request,
+    userId: str = Form(...),
+    timestamp: str = Form(...),
+    brandName: str = Form(...),
+    tagline: str = Form(...),
+    brandDescription: str = Form(...),
+    industryCategory: str = Form(...),
+    targetAudience: str = Form(...),
+    primaryColor: str = Form(...),
+    secondaryColor: str = Form(...),
+    accentColor: str = Form(...),
+    colorPalette: str = Form(...),
+    toneOfVoice: str = Form(...),
+    customTone: str = Form(...),
+    communicationStyle: str = Form(...),
+    brandVoice: str = Form(...),
+    keyMessages: str = Form(...),
+    isComplete: bool = Form(...),
+    completionPercentage: int = Form(...),
+    lastUpdated: str = Form(...),
+    dataVersion: float = Form(...),
+    source: str = Form(...),
+    apiEndpoint: str = Form(...),
+    submissionSource: str = Form(...),
+    systemMetadata: str = Form(...),
+    logoFiles: Optional[list[UploadFile]] = File(None),
+    logoMetadata: Optional[list[str]] = Form(None)
+):
+    try:
+        brand_id = str(uuid.uuid4())
+        
+        # Allowed file types
+        ALLOWED_IMAGE_TYPES = ['image/jpeg', 'image/jpg', 'image/png', 'image/gif', 'image/webp', 'image/svg+xml']
+        ALLOWED_VIDEO_TYPES = ['video/mp4', 'video/avi', 'video/mov', 'video/wmv', 'video/flv', 'video/webm']
+        MAX_FILE_SIZE = 50 * 1024 * 1024  # 50MB limit
+        
+        media_info_list = []
+        
+        # Sanitize brand name for file path (remove special characters)
+        sanitized_brand_name = sanitize_brand_name(brandName)
+        
+        logger.info("Brand name: %s", brandName)
+        logger.info("Sanitized brand name: %s", sanitized_brand_name)
+        
+        # Every logo is validated before anything is uploaded; the uploads then
+        # run in parallel and media_info_list keeps the order they were sent in
+        pending_logos = []
+
+        def add_pending_logo(logo_file, metadata):
+            file_ext = os.path.splitext(logo_file.filename)[1]
+            media_id = str(uuid.uuid4())
+            storage_filename = f"{userId}/{sanitized_brand_name}/{brand_id}/logo/{media_id}{file_ext}"
+            pending_logos.append((logo_file, media_id, storage_filename, metadata))
+
+        # Process logo files provided as arrays
+        if logoFiles:
+            for i, logo_file in enumerate(logoFiles):
+                if logo_file.content_type not in ALLOWED_IMAGE_TYPES:
+                    raise HTTPException(status_code=400, detail=f"Invalid file type for logo: {logo_file.content_type}")
+                if getattr(logo_file, "size", None) and logo_file.size > MAX_FILE_SIZE:
+                    raise HTTPException(status_code=400, detail=f"File too large: {logo_file.filename}")
+                metadata = logoMetadata[i] if logoMetadata and i < len(logoMetadata) else ""
+                add_pending_logo(logo_file, metadata)
+
+        # Also support enumerated fields: logo_0, logo_1, ... using logoCount
+        try:
+            form = await request.form()
+        except Exception:
+            form = None
+        if form is not None:
+            raw_logo_count = form.get("logoCount")
+            try:
+                count = int(raw_logo_count) if raw_logo_count is not None else 0
+            except ValueError:
+                count = 0
+            for i in range(count):
+                field_name = f"logo_{i}"
+                if field_name not in form:
+                    continue
+                logo_file = form.get(field_name)
+                if not logo_file:
+                    continue
+                # Starlette returns UploadFile for file fields
+                if getattr(logo_file, "content_type", None) not in ALLOWED_IMAGE_TYPES:
+                    raise HTTPException(status_code=400, detail=f"Invalid file type for logo: {getattr(logo_file, 'content_type', 'unknown')}")
+                size_attr = getattr(logo_file, "size", None)
+                if size_attr and size_attr > MAX_FILE_SIZE:
+                    raise HTTPException(status_code=400, detail=f"File too large: {logo_file.filename}")
+                # Metadata key typo tolerant: logo_0_metadata or log_0_metadata
+                meta_key = f"logo_{i}_metadata"
+                alt_meta_key = f"log_{i}_metadata"
+                metadata = form.get(meta_key) or form.get(alt_meta_key) or ""
+                add_pending_logo(logo_file, metadata)
+
+        logger.info("Uploading %s logo(s)", len(pending_logos))
+        uploaded = await upload_files_parallel([
+            (storage_filename, logo_file.file, logo_file.content_type)
+            for logo_file, _, storage_filename, _ in pending_logos
+        ])
+        for (logo_file, media_id, _, metadata), (blob, media_url) in zip(pending_logos, uploaded):
+            media_info_list.append({
+                "fileId": media_id,
+                "filename": logo_file.filename,
+                "contentType": logo_file.content_type,
+                "fileSize": getattr(logo_file, "size", None),
+                "url": media_url,
+                "storagePath": blob.name,
+                "mediaType": "logo",
+                "metadata": metadata,
+                "uploadTimestamp": datetime.utcnow().isoformat()
+            })
+
+        data = {
+            "userId": userId,
+            "timestamp": timestamp,
             "brandName": brandName,
             "tagline": tagline,
             "brandDescription": brandDescription,
@@ -275,124 +1709,1428 @@ async def receive_brand_form(
             "lastUpdated": lastUpdated,
             "dataVersion": dataVersion,
             "source": source,
-            "apiEndpoint": apiEndpoint,
-            "submissionSource": submissionSource,
-            "systemMetadata": systemMetadata,
-            "mediaFiles": media_info_list,
-            "mediaCount": len(media_info_list),
-            "brandId": brand_id
+            "apiEndpoint": apiEndpoint,
+            "submissionSource": submissionSource,
+            "systemMetadata": systemMetadata,
+            "brandId": brand_id
+        }
+
+        # Store the brand and its media records in one batch
+        try:
+            await save_brand_media(brand_id, userId, media_info_list, brand_doc=data)
+        except Exception:
+            await rollback_uploads([media["storagePath"] for media in media_info_list])
+            raise
+
+        return {
+            "message": "Brand data saved successfully", 
+            "brand_id": brand_id,
+            "logo_count": len(media_info_list),
+            "logo_files": media_info_list
+        }
+
+    except Exception as e:
+        logger.error("Error saving brand data: %s", e)
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+# ===============================
+# Plan document cache
+# ===============================
+# PlanSelectionDetails/{userId} is read by most analysis and plan endpoints.
+# Reads that only display plan data go through get_plan_data, a read-through
+# cache with a short TTL. Every write to the document from this process calls
+# invalidate_plan_cache, and a fill whose read overlapped an invalidation is
+# discarded instead of cached. Quota transactions and read-modify-write flows
+# keep reading Firestore directly.
+
+PLAN_CACHE_TTL_SECONDS = float(os.getenv("PLAN_CACHE_TTL_SECONDS", "30"))
+PLAN_CACHE_MAX_ENTRIES = int(os.getenv("PLAN_CACHE_MAX_ENTRIES", "5000"))
+
+# userId -> {"data", "updateTime", "hits"}
+plan_cache = TTLCache(
+    "plan", PLAN_CACHE_MAX_ENTRIES, PLAN_CACHE_TTL_SECONDS,
+    extra_stats=(
+        "stale_refreshes",  # refreshes that found the document changed elsewhere
+        "stale_reads",      # hits served from those out-of-date entries
+    ),
+)
+
+
+async def get_plan_data(user_id: str) -> Optional[dict]:
+    """
+    Return the user's PlanSelectionDetails document (None if there is none),
+    served from the plan cache while fresh. Treat the result as read-only.
+    """
+    entry = plan_cache.get(user_id)
+    if entry is not CACHE_MISS:
+        entry["hits"] += 1
+        return entry["data"]
+
+    previous = plan_cache.peek(user_id)
+    fill = plan_cache.begin_fill(user_id)
+    try:
+        snapshot = await fs_get(db.collection("PlanSelectionDetails").document(user_id))
+    except Exception:
+        plan_cache.cancel_fill(user_id, fill)
+        raise
+
+    data = snapshot.to_dict() if snapshot.exists else None
+    update_time = snapshot.update_time if snapshot.exists else None
+    if not plan_cache.put(user_id, {"data": data, "updateTime": update_time, "hits": 0}, fill=fill):
+        return data
+    if previous is not CACHE_MISS and previous["updateTime"] != update_time:
+        plan_cache.count("stale_refreshes")
+        plan_cache.count("stale_reads", previous["hits"])
+    return data
+
+
+def invalidate_plan_cache(user_id: str):
+    """Forget the cached plan for a user after its document was written."""
+    plan_cache.invalidate(user_id)
+
+
+# ===============================
+# Plan/profile writes
+# ===============================
+# PlanSelectionDetails is the source of truth and userProfileDetails.subscription
+# is the copy the frontend reads. Both are written in one batch so they cannot
+# drift apart.
+
+def _merge_write(updates: dict) -> tuple:
+    """
+    Turn update()-style {"a.b": v} into (nested data, merge field paths) for
+    set(merge=...): the same fields are replaced as with update(), but the
+    document is created if it does not exist yet.
+    """
+    paths = [FieldPath.from_string(key) for key in updates]
+    nested = {}
+    for path, value in zip(paths, updates.values()):
+        target = nested
+        for part in path.parts[:-1]:
+            target = target.setdefault(part, {})
+        target[path.parts[-1]] = value
+    return nested, paths
+
+
+async def write_plan_and_profile(
+    user_id: str,
+    plan_updates: Optional[dict] = None,
+    profile_updates: Optional[dict] = None,
+    replace_plan: bool = False,
+):
+    """
+    Commit a user's PlanSelectionDetails and userProfileDetails changes in one
+    batch. Updates use update() field paths ("subscription.adsUsed"); with
+    replace_plan the plan document is overwritten with plan_updates instead.
+    """
+    plan_ref = db.collection("PlanSelectionDetails").document(user_id)
+    profile_ref = db.collection("userProfileDetails").document(user_id)
+
+    batch = db.batch()
+    if plan_updates is not None:
+        if replace_plan:
+            batch.set(plan_ref, plan_updates)
+        else:
+            nested, paths = _merge_write(plan_updates)
+            batch.set(plan_ref, nested, merge=paths)
+    if profile_updates:
+        nested, paths = _merge_write(profile_updates)
+        batch.set(profile_ref, nested, merge=paths)
+
+    try:
+        await fs_commit(batch)
+    finally:
+        if plan_updates is not None:
+            invalidate_plan_cache(user_id)
+
+
+def profile_subscription_updates(plan_data: dict, updated_at: str) -> dict:
+    """userProfileDetails.subscription fields mirrored from a plan document."""
+    return {
+        "subscription.planType": plan_data["planName"].replace("Incivus_", "").lower(),
+        "subscription.planName": plan_data["planName"],
+        "subscription.adQuota": plan_data["totalAds"],
+        "subscription.adsUsed": monthly_ads_used(plan_data),
+        "subscription.max_ads_per_month": plan_data.get("max_ads_per_month", 0),
+        "subscription.totalPrice": plan_data.get("totalPrice", 0),
+        "subscription.subscriptionStartDate": plan_data["subscriptionStartDate"],
+        "subscription.subscriptionEndDate": plan_data["subscriptionEndDate"],
+        "subscription.validityDays": plan_data["validityDays"],
+        "subscription.selectedFeatures": plan_data.get("selectedFeatures", []),
+        "subscription.updatedAt": updated_at,
+        "updatedAt": updated_at,
+    }
+
+
+@app.post("/save-plan-selection")
+async def save_plan_selection(
+    userId: str = Form(...),
+    planId: str = Form(...),
+    planName: str = Form(...),
+    paymentId: str = Form(...),
+    paymentStatus: str = Form(...),
+    subscriptionType: str = Form(...),
+    subscriptionStartDate: str = Form(...),
+    subscriptionEndDate: str = Form(...),
+    totalPrice: float = Form(...),
+    basePrice: float = Form(...),
+    additionalAdPrice4: float = Form(...),
+    totalAds: int = Form(...),
+    validityDays: int = Form(...),
+    isActive: bool = Form(...),
+    selectedFeatures: list[str] = Form(...),
+    createdAt: str = Form(...),
+    updatedAt: str = Form(...),
+    max_ads_per_month: int = Form(...)
+            
+):
+    try:
+        doc_id = userId
+        
+        # selectedFeatures may arrive as an array, or as a single comma-separated string inside an array
+        features_list = selectedFeatures or []
+        if len(features_list) == 1 and "," in features_list[0]:
+            features_list = [item.strip().strip('"\'') for item in features_list[0].split(',') if item.strip()]
+        
+        # Build indexed map: {"0": feature0, "1": feature1, ...}
+        features_indexed = {str(i): feature for i, feature in enumerate(features_list)}
+        
+        plan_data = {
+            "userId": userId,
+            "planId": planId,
+            "planName": planName,
+            "paymentId": paymentId,
+            "paymentStatus": paymentStatus,
+            "subscriptionType": subscriptionType,
+            "subscriptionStartDate": subscriptionStartDate,
+            "subscriptionEndDate": subscriptionEndDate,
+            "totalPrice": totalPrice,
+            "basePrice": basePrice,
+            "additionalAdPrice4": additionalAdPrice4,
+            "totalAds": totalAds,
+            "validityDays": validityDays,
+            "isActive": isActive,
+            "selectedFeatures": features_list,
+            #"selectedFeaturesIndexed": features_indexed,
+            "createdAt": createdAt,
+            "updatedAt": updatedAt,
+            "max_ads_per_month": max_ads_per_month,
+            "adsUsed": 0
+        }
+        
+        # Also upsert subscription into user profile so frontend can read it
+        subscription = {
+            "planType": planId,
+            "planName": planName,
+            "features": features_list,
+            "adQuota": totalAds,
+            "totalPrice": totalPrice,
+            "basePrice": basePrice,
+            "validityDays": validityDays,
+            "subscriptionStartDate": subscriptionStartDate,
+            "subscriptionEndDate": subscriptionEndDate,
+            "status": "active" if isActive else "inactive",
+            "adsUsed": 0,
+            "max_ads_per_month": max_ads_per_month,
+            "paymentStatus": paymentStatus,
+            "paymentId": paymentId,
+            "subscriptionType": subscriptionType,
+            "updatedAt": updatedAt,
+        }
+        await write_plan_and_profile(
+            doc_id,
+            plan_data,
+            {
+                "userId": userId,
+                **{f"subscription.{key}": value for key, value in subscription.items()},
+                "updatedAt": updatedAt,
+            },
+            replace_plan=True,
+        )
+
+        return {"message": "Plan selection saved", "doc_id": doc_id}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error saving plan: {str(e)}")
+
+
+
+   
+# ===============================
+# Usage periods
+# ===============================
+# Monthly usage is stored per billing period on the plan document, e.g.
+# usage: {"2026-10": 3}. A new month simply has no entry yet, so rollover
+# happens at read time and no global reset is needed. adsUsed is kept as a
+# mirror of the current period for older readers (frontend, profile sync).
+
+def current_usage_period(now: Optional[datetime] = None) -> str:
+    """Billing period key ("YYYY-MM") for a UTC datetime, defaulting to now."""
+    return (now or datetime.utcnow()).strftime("%Y-%m")
+
+
+def usage_field(period: str) -> str:
+    """Firestore field path for a period's counter (keys start with a digit, so they need quoting)."""
+    return FieldPath("usage", period).to_api_repr()
+
+
+def _usage_period(iso_date: Optional[str]) -> Optional[str]:
+    """"YYYY-MM" for an ISO timestamp, or None if missing/unparseable."""
+    if not iso_date:
+        return None
+    try:
+        return datetime.fromisoformat(iso_date.replace("Z", "")).strftime("%Y-%m")
+    except ValueError:
+        return None
+
+
+def monthly_ads_used(plan_data: dict, period: Optional[str] = None) -> int:
+    """Ads used by a plan in a billing period (the current one by default)."""
+    period = period or current_usage_period()
+    usage = plan_data.get("usage") or {}
+    if period in usage:
+        return usage[period]
+    # Documents written before usage periods only carry adsUsed + lastUsageDate
+    if _usage_period(plan_data.get("lastUsageDate")) == period:
+        return plan_data.get("adsUsed", 0)
+    return 0
+
+
+# ===============================
+# Ad quota reservations
+# ===============================
+# A submission reserves one ad unit inside a Firestore transaction before the
+# upstream call: the monthly and total limits are checked and the period
+# counter/totalAds move in the same commit, so concurrent submissions cannot
+# both pass on the same count. Each open reservation is marked under
+# quotaReservations.<id>; commit clears the marker, release hands the unit back
+# exactly once. A marker older than QUOTA_RESERVATION_TTL_SECONDS belongs to a
+# request that died without doing either (e.g. the instance was killed); the
+# next reservation on that plan hands its unit back. The TTL must exceed the
+# longest queue wait plus analysis, or a slow job could be refunded early.
+
+QUOTA_RESERVATION_TTL_SECONDS = int(os.getenv("QUOTA_RESERVATION_TTL_SECONDS", str(6 * 3600)))
+
+
+def _reclaim_stale_reservations(plan_data: dict, now: datetime) -> dict:
+    """
+    Field updates that return the units of expired reservations to the plan.
+    plan_data is updated to match, so limits can be checked against it.
+    """
+    cutoff = now - timedelta(seconds=QUOTA_RESERVATION_TTL_SECONDS)
+    reservations = plan_data.get("quotaReservations") or {}
+    updates = {}
+    for reservation_id, reserved_at in list(reservations.items()):
+        try:
+            reserved = datetime.fromisoformat(reserved_at.replace("Z", ""))
+        except (AttributeError, ValueError):
+            continue
+        if reserved > cutoff:
+            continue
+        period = current_usage_period(reserved)
+        period_used = max(0, monthly_ads_used(plan_data, period) - 1)
+        plan_data.setdefault("usage", {})[period] = period_used
+        updates[usage_field(period)] = period_used
+        if period == current_usage_period(now):
+            plan_data["adsUsed"] = updates["adsUsed"] = period_used
+        plan_data["totalAds"] = updates["totalAds"] = plan_data.get("totalAds", 0) + 1
+        del reservations[reservation_id]
+        updates[f"quotaReservations.{reservation_id}"] = firestore.DELETE_FIELD
+    return updates
+
+
+@fs_transactional
+def _reserve_quota_in_transaction(transaction, plan_ref, reservation_id: str) -> dict:
+    snapshot = tx_get(transaction, plan_ref)
+    if not snapshot.exists:
+        raise HTTPException(status_code=404, detail="User plan not found. Please select a plan first.")
+
+    plan_data = snapshot.to_dict()
+    current_date = datetime.utcnow()
+    period = current_usage_period(current_date)
+    reclaimed = _reclaim_stale_reservations(plan_data, current_date)
+    max_ads_per_month = plan_data.get("max_ads_per_month", 0)
+    total_ads = plan_data.get("totalAds", 0)
+    ads_used = monthly_ads_used(plan_data, period)
+
+    denied = None
+    if ads_used >= max_ads_per_month:
+        denied = HTTPException(
+            status_code=429, 
+            detail=f"Maximum monthly limit reached ({max_ads_per_month} ads). Please wait until next month or upgrade your plan."
+        )
+    elif total_ads <= 0:
+        denied = HTTPException(
+            status_code=400, 
+            detail="No ads remaining in your plan. Please purchase more ads or upgrade your plan."
+        )
+    if denied is not None:
+        # Raising here would roll the reclaim back with the reservation
+        if reclaimed:
+            transaction.update(plan_ref, reclaimed)
+        return {"denied": denied}
+
+    now = current_date.isoformat() + "Z"
+    transaction.update(plan_ref, {
+        **reclaimed,
+        usage_field(period): ads_used + 1,
+        "adsUsed": ads_used + 1,
+        "totalAds": total_ads - 1,
+        "lastUsageDate": now,
+        "updatedAt": now,
+        f"quotaReservations.{reservation_id}": now,
+    })
+    return {
+        "id": reservation_id,
+        "userId": plan_ref.id,
+        "period": period,
+        "adsUsed": ads_used + 1,
+        "totalAds": total_ads - 1,
+        "max_ads_per_month": max_ads_per_month,
+        "planName": plan_data.get("planName", "Unknown"),
+        "planType": plan_data.get("planName", "lite").lower().replace("incivus_", ""),
+        "reservedAt": now,
+    }
+
+
+@fs_transactional
+def _release_quota_in_transaction(transaction, plan_ref, reservation: dict) -> bool:
+    snapshot = tx_get(transaction, plan_ref)
+    if not snapshot.exists:
+        return False
+    plan_data = snapshot.to_dict()
+    if reservation["id"] not in (plan_data.get("quotaReservations") or {}):
+        # Already committed or released
+        return False
+
+    updates = {
+        "totalAds": plan_data.get("totalAds", 0) + 1,
+        f"quotaReservations.{reservation['id']}": firestore.DELETE_FIELD,
+        "updatedAt": datetime.utcnow().isoformat() + "Z",
+    }
+    # The unit goes back to the period it was taken from, even after a rollover
+    period_used = max(0, monthly_ads_used(plan_data, reservation["period"]) - 1)
+    updates[usage_field(reservation["period"])] = period_used
+    if reservation["period"] == current_usage_period():
+        updates["adsUsed"] = period_used
+    transaction.update(plan_ref, updates)
+    return True
+
+
+async def reserve_ad_quota(user_id: str, reservation_id: str) -> dict:
+    """
+    Atomically take one ad unit from the user's plan.
+    Raises HTTPException 404/429/400 when the plan is missing or exhausted.
+    """
+    plan_ref = db.collection("PlanSelectionDetails").document(user_id)
+    try:
+        reservation = await run_io(lambda: _reserve_quota_in_transaction(db.transaction(), plan_ref, reservation_id))
+    finally:
+        invalidate_plan_cache(user_id)
+    if "denied" in reservation:
+        raise reservation["denied"]
+    return reservation
+
+
+async def commit_ad_quota(reservation: dict, profile_updates: Optional[dict] = None):
+    """Mark a reserved unit as spent, writing profile_updates to userProfileDetails in the same batch."""
+    await write_plan_and_profile(
+        reservation["userId"],
+        {f"quotaReservations.{reservation['id']}": firestore.DELETE_FIELD},
+        profile_updates,
+    )
+    reservation["committed"] = True
+
+
+async def release_ad_quota(reservation: Optional[dict]):
+    """Return a reserved unit to the plan. Safe to call twice or after commit; never raises."""
+    if not reservation or reservation.get("committed") or reservation.get("released"):
+        return
+    try:
+        plan_ref = db.collection("PlanSelectionDetails").document(reservation["userId"])
+        try:
+            await run_io(lambda: _release_quota_in_transaction(db.transaction(), plan_ref, reservation))
+        finally:
+            invalidate_plan_cache(reservation["userId"])
+        reservation["released"] = True
+        logger.info("Released quota reservation %s for user %s", reservation['id'], reservation['userId'])
+    except Exception as e:
+        logger.warning("Could not release quota reservation %s: %s", reservation['id'], e)
+
+
+# ===============================
+# Analysis stage timing
+# ===============================
+# A sampled analysis carries a stage_timings dict from the endpoint through
+# the job. analysis_span adds each stage's wall time to it and to a per-stage
+# histogram. The totals are stored on the user_analysis document (stages
+# finished before it is written), returned in the response and, for queued
+# analyses, recorded on the analysis_jobs status. Unsampled analyses carry
+# None and every span is a shared no-op context.
+
+ANALYSIS_TIMING_SAMPLE_RATE = float(os.getenv("ANALYSIS_TIMING_SAMPLE_RATE", "1.0"))
+
+analysis_stage_histograms: dict[str, dict] = {}  # stage -> new_histogram()
+analysis_timing_stats = {"sampled": 0, "unsampled": 0}
+_NO_SPAN = contextlib.nullcontext()
+
+
+def new_stage_timings() -> Optional[dict]:
+    """Start timing an analysis: a dict to collect stages in, or None when it is not sampled."""
+    if ANALYSIS_TIMING_SAMPLE_RATE > 0 and random.random() < ANALYSIS_TIMING_SAMPLE_RATE:
+        analysis_timing_stats["sampled"] += 1
+        return {}
+    analysis_timing_stats["unsampled"] += 1
+    return None
+
+
+def record_stage(timings: Optional[dict], stage: str, seconds: float):
+    """Add one measured stage to an analysis and to the stage histogram."""
+    if timings is None:
+        return
+    timings[stage] = timings.get(stage, 0.0) + seconds
+    observe(analysis_stage_histograms.setdefault(stage, new_histogram()), seconds)
+
+
+@contextlib.contextmanager
+def _timed_span(timings: dict, stage: str):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(timings, stage, time.perf_counter() - started)
+
+
+def analysis_span(timings: Optional[dict], stage: str):
+    """Time a `with` block as one analysis stage; a no-op when the analysis is not sampled."""
+    return _NO_SPAN if timings is None else _timed_span(timings, stage)
+
+
+def stage_timings_ms(timings: dict) -> dict:
+    return {stage: round(seconds * 1000, 1) for stage, seconds in timings.items()}
+
+
+# ===============================
+# Background analysis queue
+# ===============================
+# In async mode /postAnalysisDetailsFormData only validates, uploads and
+# enqueues; a pool of worker tasks runs the long upstream call. Job state is
+# kept in the analysis_jobs collection so any app instance can answer polls.
+# The queue itself is in memory: on shutdown, jobs that were running or still
+# waiting are marked failed and their quota reservations handed back, so no
+# job is left "queued"/"running" with a unit held against the plan.
+
+ANALYSIS_ASYNC_DEFAULT = os.getenv("ANALYSIS_ASYNC_DEFAULT", "false").lower() == "true"
+ANALYSIS_WORKERS = int(os.getenv("ANALYSIS_WORKERS", "4"))
+ANALYSIS_QUEUE_MAX = int(os.getenv("ANALYSIS_QUEUE_MAX", "100"))
+ANALYSIS_SHUTDOWN_ERROR = "Analysis was interrupted by a server restart. Please submit it again."
+ANALYSIS_QUEUE_FULL_ERROR = "Analysis queue is full. Please retry shortly."
+
+analysis_queue: Optional[asyncio.Queue] = None
+analysis_worker_tasks: list = []
+
+
+async def set_analysis_job_status(artifact_id: str, status: str, **fields):
+    """Record the state of a queued analysis (queued/running/done/failed)."""
+    now = datetime.utcnow().isoformat() + "Z"
+    payload = {"artifactId": artifact_id, "status": status, "updatedAt": now, **fields}
+    payload[f"{status}At"] = now
+    await fs_set(db.collection("analysis_jobs").document(artifact_id), payload, merge=True)
+
+
+async def enqueue_analysis_job(job: dict):
+    """
+    Queue an analysis for the worker pool. Raises 503 if the queue is full;
+    a job turned away after its status was recorded is failed and its quota
+    unit returned.
+    """
+    if analysis_queue is None:
+        raise HTTPException(status_code=503, detail="Analysis workers are not running")
+    if analysis_queue.full():
+        raise HTTPException(status_code=503, detail=ANALYSIS_QUEUE_FULL_ERROR)
+    await set_analysis_job_status(
+        job["artifact_id"],
+        "queued",
+        userId=job["userId"],
+        brandId=job["brandId"],
+        adTitle=job["adTitle"],
+    )
+    job["enqueued_at"] = time.perf_counter()
+    job["request_id"] = request_id_var.get()
+    try:
+        analysis_queue.put_nowait(job)
+    except asyncio.QueueFull:
+        # Other submissions filled the queue while the status was being written
+        await abandon_analysis_job(job, ANALYSIS_QUEUE_FULL_ERROR)
+        raise HTTPException(status_code=503, detail=ANALYSIS_QUEUE_FULL_ERROR)
+    logger.info("Queued analysis %s (%s waiting)", job['artifact_id'], analysis_queue.qsize())
+
+
+async def abandon_analysis_job(job: dict, reason: str):
+    """Fail a job that will not run to completion and return its quota unit and media. Never raises."""
+    status, fields = "failed", {"error": reason}
+    if job["quota_reservation"].get("committed"):
+        # Interrupted after its results were stored and charged
+        status, fields = "done", {}
+    else:
+        await release_ad_quota(job["quota_reservation"])
+        await release_job_media(job)
+    try:
+        await set_analysis_job_status(job["artifact_id"], status, **fields)
+    except Exception as e:
+        logger.warning("Could not record %s status for %s: %s", status, job["artifact_id"], e)
+
+
+async def analysis_worker(worker_id: int):
+    """Pull queued analyses and run them until cancelled."""
+    while True:
+        job = await analysis_queue.get()
+        artifact_id = job["artifact_id"]
+        artifact_token = artifact_id_var.set(artifact_id)
+        request_token = request_id_var.set(job.get("request_id"))
+        timings = job.get("stage_timings")
+        record_stage(timings, "queue_wait", time.perf_counter() - job["enqueued_at"])
+        media_file = None
+        try:
+            await set_analysis_job_status(artifact_id, "running", worker=worker_id)
+            # The request's upload is closed once the response is sent, so the
+            # worker reads the media back from GCS.
+            with analysis_span(timings, "media_download"):
+                media_file = await gcs_download_to_spooled(job["storage_path"])
+            result = await run_analysis_job(job, media_file)
+            done_fields = {
+                "analysis_summary": result.get("analysis_summary"),
+                "plan_usage": result.get("plan_usage"),
+            }
+            if "stageTimingsMs" in result:
+                done_fields["stageTimingsMs"] = result["stageTimingsMs"]
+            await set_analysis_job_status(artifact_id, "done", **done_fields)
+            logger.info("Worker %s finished analysis %s", worker_id, artifact_id)
+        except asyncio.CancelledError:
+            logger.warning("Worker %s interrupted analysis %s", worker_id, artifact_id)
+            await abandon_analysis_job(job, ANALYSIS_SHUTDOWN_ERROR)
+            raise
+        except Exception as e:
+            detail = e.detail if isinstance(e, HTTPException) else str(e)
+            logger.error("Worker %s failed analysis %s: %s", worker_id, artifact_id, detail)
+            try:
+                await set_analysis_job_status(artifact_id, "failed", error=detail)
+            except Exception as status_error:
+                logger.warning("Could not record failure for %s: %s", artifact_id, status_error)
+        finally:
+            if media_file is not None:
+                media_file.close()
+            artifact_id_var.reset(artifact_token)
+            request_id_var.reset(request_token)
+            analysis_queue.task_done()
+
+
+@app.on_event("startup")
+async def start_analysis_workers():
+    global analysis_queue
+    analysis_queue = asyncio.Queue(maxsize=ANALYSIS_QUEUE_MAX)
+    for worker_id in range(ANALYSIS_WORKERS):
+        analysis_worker_tasks.append(asyncio.create_task(analysis_worker(worker_id)))
+
+
+@app.on_event("shutdown")
+async def stop_analysis_workers():
+    for task in analysis_worker_tasks:
+        task.cancel()
+    await asyncio.gather(*analysis_worker_tasks, return_exceptions=True)
+    analysis_worker_tasks.clear()
+
+    abandoned = []
+    while analysis_queue is not None and not analysis_queue.empty():
+        abandoned.append(analysis_queue.get_nowait())
+        analysis_queue.task_done()
+    if abandoned:
+        logger.warning("Failing %s queued analyses on shutdown", len(abandoned))
+        await asyncio.gather(*(abandon_analysis_job(job, ANALYSIS_SHUTDOWN_ERROR) for job in abandoned))
+
+
+# ===============================
+# Fan-out model execution
+# ===============================
+# Instead of one monolithic comprehensive-analysis call, "fanout" mode calls the
+# individual models concurrently. Each model maps onto the results section it
+# produces inside comprehensive-analysis.data.results.
+
+ANALYSIS_MODE_DEFAULT = os.getenv("ANALYSIS_MODE", "comprehensive")
+ANALYSIS_MODES = ("comprehensive", "fanout")
+
+FANOUT_MODELS = {
+    "brand-compliance": "brand_compliance",
+    "channel-compliance": "channel_compliance",
+    "metaphor-analysis": "metaphor_analysis",
+    "analyze-ad": "content_analysis",
+}
+
+FANOUT_DEFAULT_TIMEOUT = float(os.getenv("FANOUT_MODEL_TIMEOUT", "300"))
+FANOUT_MODEL_TIMEOUTS = {
+    feature: float(os.getenv(f"FANOUT_TIMEOUT_{feature.upper().replace('-', '_')}", FANOUT_DEFAULT_TIMEOUT))
+    for feature in FANOUT_MODELS
+}
+
+
+async def _call_model_with_deadline(feature: str, form_data: dict, media_file, filename: str, content_type: str) -> dict:
+    timeout = FANOUT_MODEL_TIMEOUTS[feature]
+    # Each model streams the media through its own reader
+    reader = await open_media_reader(media_file)
+    files = {"file": (filename, reader, content_type)}
+    try:
+        return await asyncio.wait_for(
+            call_feature_model(feature, dict(form_data), files, timeout=timeout),
+            timeout=timeout,
+        )
+    except asyncio.TimeoutError:
+        logger.warning("%s: Timed out after %.0fs", feature, timeout)
+        return {"success": False, "error": f"Timed out after {timeout:.0f}s", "timed_out": True}
+    finally:
+        reader.close()
+
+
+async def run_fanout_analysis(form_data: dict, media_file, filename: str, content_type: str) -> dict:
+    """Call every FANOUT_MODELS model concurrently. Returns {feature: result entry}."""
+    features = list(FANOUT_MODELS.keys())
+    outcomes = await asyncio.gather(
+        *(_call_model_with_deadline(feature, form_data, media_file, filename, content_type) for feature in features)
+    )
+    return dict(zip(features, outcomes))
+
+
+def merge_fanout_results(model_results: dict) -> dict:
+    """
+    Fold per-model results into a single comprehensive-analysis style entry.
+    Failed models are left out of data.results and listed under failed_models.
+    """
+    sections = {}
+    model_status = {}
+    for feature, result in model_results.items():
+        section = FANOUT_MODELS[feature]
+        model_status[feature] = {k: v for k, v in result.items() if k != "data"}
+        if not result.get("success"):
+            continue
+        payload = result.get("data")
+        # Models may answer with the same {"results": {...}} envelope as comprehensive-analysis
+        if isinstance(payload, dict) and isinstance(payload.get("results"), dict) and section in payload["results"]:
+            payload = payload["results"][section]
+        sections[section] = payload
+
+    failed_models = [feature for feature, result in model_results.items() if not result.get("success")]
+    return {
+        "success": bool(sections),
+        "data": {"results": sections},
+        "mode": "fanout",
+        "partial": bool(failed_models) and bool(sections),
+        "failed_models": failed_models,
+        "model_status": model_status,
+    }
+
+
+# ===============================
+# Analysis result cache
+# ===============================
+# Keyed on the submitting user, sha256(media bytes) and the form data sent
+# upstream, with the brand logo identified by where it is stored rather than
+# by its signed URL (a new signature every time it is re-signed). Results are
+# never shared between users: a hit returns another analysis's stored record,
+# which belongs to whoever submitted it. The index
+# lives in the analysis_result_cache collection and points at the user_analysis
+# document holding the results; a bounded in-process LRU avoids the index read
+# for hot keys.
+
+RESULT_CACHE_ENABLED = os.getenv("RESULT_CACHE_ENABLED", "true").lower() == "true"
+RESULT_CACHE_TTL_SECONDS = int(os.getenv("RESULT_CACHE_TTL_SECONDS", str(7 * 24 * 3600)))
+RESULT_CACHE_MAX_ENTRIES = int(os.getenv("RESULT_CACHE_MAX_ENTRIES", "1000"))
+
+# key -> (artifactId, createdAt). The index's own hits/misses count memory
+# lookups; lookup_hits/lookup_misses count whole lookups, Firestore included.
+result_cache_index = TTLCache("result_index", RESULT_CACHE_MAX_ENTRIES, RESULT_CACHE_TTL_SECONDS,
+                              extra_stats=("lookup_hits", "lookup_misses", "bypassed", "stores", "dropped"))
+
+
+def result_cache_key(user_id: str, media_digest: str, form_data: dict, analysis_mode: str, variant: str = "",
+                     logo_ref: Optional[str] = None) -> str:
+    """Cache key for a user's analysis; logo_ref (the logo's storagePath or fileId) stands in for form_data["logo_url"]."""
+    keyed = {k: v for k, v in form_data.items() if k != "logo_url"}
+    if "logo_url" in form_data:
+        keyed["logo"] = logo_ref or form_data["logo_url"]
+    canonical = json.dumps(keyed, sort_keys=True, separators=(",", ":"))
+    scope = json.dumps([user_id, media_digest, analysis_mode, variant])
+    return hashlib.sha256(f"{scope}|{canonical}".encode("utf-8")).hexdigest()
+
+
+def _remember_cache_entry(key: str, artifact_id: str, created_at: float):
+    # Kept in memory no longer than the entry has left to live
+    result_cache_index.put(key, (artifact_id, created_at), ttl_seconds=created_at + RESULT_CACHE_TTL_SECONDS - time.time())
+
+
+async def _drop_cache_entry(key: str):
+    result_cache_index.invalidate(key)
+    result_cache_index.count("dropped")
+    await fs_delete(db.collection("analysis_result_cache").document(key))
+
+
+async def lookup_cached_results(key: str) -> Optional[dict]:
+    """
+    Return {"artifactId", "results", "model_results"} for a cached analysis,
+    or None on a miss. Expired or dangling entries are evicted.
+    """
+    if not RESULT_CACHE_ENABLED:
+        return None
+    try:
+        entry = result_cache_index.get(key)
+        if entry is CACHE_MISS:
+            doc = await fs_get(db.collection("analysis_result_cache").document(key))
+            if not doc.exists:
+                result_cache_index.count("lookup_misses")
+                return None
+            data = doc.to_dict()
+            entry = (data["artifactId"], data["createdAt"])
+
+        artifact_id, created_at = entry
+        if time.time() - created_at > RESULT_CACHE_TTL_SECONDS:
+            result_cache_index.count("lookup_misses")
+            await _drop_cache_entry(key)
+            return None
+
+        source = await fs_get(
+            db.collection("user_analysis").document(artifact_id),
+            field_paths=["ai_analysis_results", "feature_results", "feature_sections", "projectionVersion"],
+        )
+        results = stored_analysis_results(source.to_dict() or {}) if source.exists else None
+        if not results:
+            # The source analysis was deleted by its owner
+            result_cache_index.count("lookup_misses")
+            await _drop_cache_entry(key)
+            return None
+
+        _remember_cache_entry(key, artifact_id, created_at)
+        result_cache_index.count("lookup_hits")
+        comp = results.get("comprehensive-analysis", {})
+        # Fan-out entries keep per-model status; the success bookkeeping needs it
+        model_results = comp.get("model_status") if comp.get("mode") == "fanout" else results
+        return {"artifactId": artifact_id, "results": results, "model_results": model_results}
+    except Exception as e:
+        logger.warning("Result cache lookup failed: %s", e)
+        result_cache_index.count("lookup_misses")
+        return None
+
+
+async def store_cached_results(key: str, artifact_id: str, analysis_mode: str):
+    """Point the cache key at a freshly stored user_analysis document."""
+    if not RESULT_CACHE_ENABLED:
+        return
+    created_at = time.time()
+    await fs_set(db.collection("analysis_result_cache").document(key), {
+        "artifactId": artifact_id,
+        "analysisMode": analysis_mode,
+        "createdAt": created_at,
+    })
+    _remember_cache_entry(key, artifact_id, created_at)
+    result_cache_index.count("stores")
+
+
+async def run_analysis_job(job: dict, media_file) -> dict:
+    """
+    Run a queued or synchronous analysis, releasing its quota reservation and
+    uploaded media if it does not complete. See _execute_analysis_job for the
+    details.
+    """
+    try:
+        return await _execute_analysis_job(job, media_file)
+    except BaseException:
+        await release_ad_quota(job["quota_reservation"])
+        await release_job_media(job)
+        raise
+
+
+async def release_job_media(job: dict):
+    """
+    Drop the media reference of an analysis that stored no record, as deleting
+    the record would (see release_analysis_media). Safe to call twice; never raises.
+    """
+    if job.get("results_stored") or job.get("media_released"):
+        return
+    job["media_released"] = True
+    await release_analysis_media({"storagePath": job["storage_path"]})
+
+
+async def _execute_analysis_job(job: dict, media_file) -> dict:
+    """
+    Run the upstream analysis for an already uploaded ad and persist the outcome.
+
+    Shared by the synchronous /postAnalysisDetailsFormData path and the
+    background analysis workers. `job` is the context assembled by the endpoint
+    (plan snapshot, brand details, media location); `media_file` is a readable
+    binary file with the media bytes.
+
+    Stores the results in user_analysis, commits the job's quota reservation on
+    success and returns the response payload. Raises HTTPException if the
+    analysis failed.
+    """
+    userId = job["userId"]
+    brandId = job["brandId"]
+    artifact_id = job["artifact_id"]
+    timestamp = job["timestamp"]
+    messageIntent = job["messageIntent"]
+    funnelStage = job["funnelStage"]
+    channels_list = job["channels_list"]
+    source = job["source"]
+    clientId = job["clientId"]
+    artifacts_data = job["artifacts_data"]
+    adTitle = job["adTitle"]
+    media_url = job["media_url"]
+    storage_path = job["storage_path"]
+    media_type = job["media_type"]
+    content_type = job["content_type"]
+    filename = job["filename"]
+    file_size = job["file_size"]
+    brand_name = job["brand_name"]
+    tone_of_voice = job["tone_of_voice"]
+    brand_colours = job["brand_colours"]
+    logo_data = job["logo_data"]
+    reservation = job["quota_reservation"]
+    max_ads_per_month = reservation["max_ads_per_month"]
+    plan_name = reservation["planName"]
+    current_date = datetime.utcnow()
+    analysis_mode = job.get("analysis_mode", "comprehensive")
+    bypass_cache = job.get("bypass_cache", False)
+    timings = job.get("stage_timings")
+
+    # Brand data was fetched by the endpoint and is carried in the job
+
+    # Map channels to valid platform names
+    platform_mapping = {
+        "facebook": "Facebook",
+        "instagram": "Instagram", 
+        "google ads": "Google Ads",
+        "youtube": "YouTube",
+        "tiktok": "TikTok"
+    }
+    comp_platforms = []
+    logger.debug("Channels list: %s", channels_list)
+    for channel in channels_list:
+        if channel.lower() in platform_mapping:
+            comp_platforms.append(platform_mapping[channel.lower()])
+    
+    # Use only the platforms provided in the request, no defaults
+    if not comp_platforms:
+        logger.warning("No valid platforms found in channels: %s", channels_list)
+        comp_platforms = []  # Empty list instead of defaults
+    
+    # Prepare form data for the analysis models
+    form_data = {
+        "ad_description": messageIntent,
+        "user_ad_type": funnelStage,
+        "brand_colors": brand_colours,
+        "tone_of_voice": tone_of_voice,
+        "platforms": ",".join(comp_platforms)
+    }
+    
+    # Add logo from brand data if available
+    if logo_data and logo_data.get("logoUrl"):
+        form_data["logo_url"] = logo_data["logoUrl"]
+
+    logger.debug("Form data: %s", form_data)
+
+    # The media is never read into memory whole: hashing and the upstream
+    # request each stream it from the spooled file through their own reader
+    with analysis_span(timings, "media_hash"):
+        media_digest = await hash_media(media_file)
+    media_variant = image_preprocess_variant(content_type) or video_keyframe_variant(content_type)
+    logo_ref = (logo_data.get("logoStoragePath") or logo_data.get("logo_artifact_id")) if logo_data else None
+    cache_key = result_cache_key(userId, media_digest, form_data, analysis_mode, media_variant, logo_ref)
+    with analysis_span(timings, "cache_lookup"):
+        cached = None if bypass_cache else await lookup_cached_results(cache_key)
+    if bypass_cache:
+        result_cache_index.count("bypassed")
+
+    preprocessing = None
+    if cached:
+        # Same creative and inputs were analysed before; reuse the stored results
+        logger.info("Result cache hit: reusing analysis %s", cached['artifactId'])
+        results = cached["results"]
+        model_results = cached["model_results"]
+        selected_features = list(model_results.keys())
+    else:
+        # Optionally send the model a downsized image or a video keyframe
+        # bundle; the GCS original is untouched
+        with analysis_span(timings, "media_preprocess"):
+            upstream_media = await prepare_upstream_media(media_file, filename, content_type, media_digest)
+        preprocessing = upstream_media["preprocessing"]
+        upstream_form_data = {**form_data, **upstream_media["form_fields"]}
+        upstream_started = time.perf_counter()
+        try:
+            if analysis_mode == "fanout":
+                # Call the individual models concurrently and merge them into the
+                # comprehensive-analysis shape the read endpoints expect
+                selected_features = list(FANOUT_MODELS.keys())
+                logger.info("Using fan-out analysis across %s", selected_features)
+                model_results = await run_fanout_analysis(
+                    upstream_form_data, upstream_media["file"], upstream_media["filename"], upstream_media["content_type"]
+                )
+                results = {"comprehensive-analysis": merge_fanout_results(model_results)}
+            else:
+                # Use only comprehensive-analysis for AI results
+                selected_features = ["comprehensive-analysis"]
+                logger.info("Using comprehensive-analysis model for AI results")
+                reader = await open_media_reader(upstream_media["file"])
+                try:
+                    files = {
+                        "file": (upstream_media["filename"], reader, upstream_media["content_type"])
+                    }
+                    results = {"comprehensive-analysis": await call_feature_model("comprehensive-analysis", upstream_form_data, files)}
+                finally:
+                    reader.close()
+                model_results = results
+            upstream_seconds = time.perf_counter() - upstream_started
+            record_stage(timings, f"upstream_{analysis_mode}", upstream_seconds)
+            if content_type in IMAGE_PREPROCESS_TYPES:
+                record_upstream_timing(upstream_media, upstream_seconds)
+        finally:
+            if upstream_media["file"] is not media_file:
+                upstream_media["file"].close()
+
+    # ===== STORE ANALYSIS RESULTS AND UPDATE PLAN USAGE ONLY ON SUCCESS =====
+    try:
+        # Calculate success statistics first
+        successful_models = [feature for feature, result in model_results.items() if result.get('success', False)]
+        failed_models = [feature for feature, result in model_results.items() if not result.get('success', False)]
+        
+        # Check if we have at least one successful model
+        if len(successful_models) == 0:
+            logger.error("No successful models found. Skipping plan usage update.")
+            raise Exception("No successful AI models completed. Analysis failed.")
+        
+        # Check if we have a reasonable success rate (at least 50% of requested models)
+        success_rate = len(successful_models) / len(selected_features) if selected_features else 0
+        if success_rate < 0.5:
+            logger.warning("Low success rate (%.1f%%). Only %s/%s models succeeded.", success_rate * 100, len(successful_models), len(selected_features))
+            # Still proceed but log the warning
+        
+        # Usage figures include the unit reserved for this analysis
+        new_ads_used = reservation["adsUsed"]
+        new_total_ads = reservation["totalAds"]
+        
+        # Store analysis data in user_analysis collection
+        logger.debug("About to save adTitle to database: '%s'", adTitle)
+        analysis_data = {
+            "userId": userId,
+            "artifact_id": artifact_id,
+            "brand_id": brandId,
+            "timestamp": timestamp,
+            "messageIntent": messageIntent,
+            "funnelStage": funnelStage,
+            "channels": channels_list,
+            "source": source,
+            "clientId": clientId,
+            "artifacts": artifacts_data,
+            "adTitle": adTitle,  # Include ad title for Libraries display
+            "mediaUrl": media_url,
+            "mediaType": content_type,
+            "storagePath": storage_path,
+            "mediaCategory": media_type,
+            "brandName": brand_name,
+            "mediaHash": media_digest,
+            # All AI model responses, comprehensive-analysis sections stored per feature
+            **analysis_record_results(results),
+            "plan_usage_at_time": {
+                "adsUsed": new_ads_used,
+                "maxAdsPerMonth": max_ads_per_month,
+                "totalAdsRemaining": new_total_ads,
+                "planName": plan_name
+            }
+        }
+        
+        if cached:
+            analysis_data["cachedFrom"] = cached["artifactId"]
+        if preprocessing:
+            analysis_data["preprocessing"] = preprocessing
+
+        # Add logo data to analysis if logo was found in brand data
+        if logo_data:
+            analysis_data.update(logo_data)
+        if timings is not None:
+            analysis_data["stageTimingsMs"] = stage_timings_ms(timings)
+        
+        # Save to user_analysis collection with artifact_id as document ID
+        with analysis_span(timings, "store_analysis"):
+            await fs_set(db.collection("user_analysis").document(artifact_id), analysis_data)
+        job["results_stored"] = True  # the record now refers to the media
+        logger.info("AI analysis results saved to user_analysis collection with ID: %s", artifact_id)
+        logger.debug("Saved analysis_data with adTitle: '%s'", analysis_data.get('adTitle', 'NOT_FOUND'))
+
+        # The analysis is stored, so the reserved unit is now spent; the user
+        # profile copy is updated in the same batch so the frontend shows it
+        with analysis_span(timings, "commit_quota"):
+            await commit_ad_quota(reservation, {
+                "subscription.adsUsed": new_ads_used,
+                "subscription.adQuota": new_total_ads,  # FIX: Use decremented new_total_ads for correct frontend display
+                "subscription.max_ads_per_month": max_ads_per_month,
+                "subscription.updatedAt": current_date.isoformat() + "Z",
+                "updatedAt": current_date.isoformat() + "Z"
+            })
+        logger.info("Plan usage updated: %s/%s monthly, %s total remaining", new_ads_used, max_ads_per_month, new_total_ads)
+
+        # Only complete, freshly computed results are worth reusing
+        if not cached and not failed_models:
+            try:
+                with analysis_span(timings, "store_cache"):
+                    await store_cached_results(cache_key, artifact_id, analysis_mode)
+            except Exception as e:
+                logger.warning("Could not store result cache entry: %s", e)
+       
+    except Exception as e:
+        logger.error("Analysis failed or could not save results: %s", e)
+        # Don't update plan usage if analysis failed: hand the reserved unit back
+        await release_ad_quota(reservation)
+        raise HTTPException(
+            status_code=500, 
+            detail=f"Analysis failed: {str(e)}. Plan usage was not updated."
+        )
+
+    # Plan type comes from the plan read by the quota reservation
+    selected_models = list(model_results.keys())
+    plan_type = reservation.get("planType", "lite")
+   
+    # Create a more user-friendly response
+    response_data = {
+        "status": "success",
+        "message": f"Analysis completed. {len(successful_models)} out of {len(selected_features)} models succeeded.",
+        "artifactId": artifact_id,
+        "analysis_summary": {
+            "total_models_requested": len(selected_features),
+            "successful_models": len(successful_models),
+            "failed_models": len(failed_models),
+            "success_rate": f"{(len(successful_models) / len(selected_features) * 100):.1f}%" if selected_features else "0%"
+        },
+        "ai_analysis_results": results,
+        "plan_type": plan_type,
+        "selected_models": selected_models,
+        "plan_usage": {
+            "adsUsed": new_ads_used,  # This will be the updated value after successful analysis
+            "maxAdsPerMonth": max_ads_per_month,
+            "totalAdsRemaining": new_total_ads,  # This will be the updated value after successful analysis
+            "planName": plan_name,
+            "monthlyLimitReached": new_ads_used >= max_ads_per_month,
+            "adsRemaining": max_ads_per_month - new_ads_used,
+            "analysis_successful": True
+        },
+        "media_info": {
+            "mediaUrl": media_url,
+            "mediaType": content_type,
+            "mediaCategory": media_type,
+            "filename": filename,
+            "fileSize": file_size
+        },
+        "brand_info": {
+            "brandId": brandId,
+            "brandName": brand_name,
+            "userId": userId,
+            "brandFound": True
         }
+    }
+    
+    # Add logo information to response if logo was found in brand data
+    if logo_data:
+        response_data["logoInfo"] = {
+            "logo_artifact_id": logo_data["logo_artifact_id"],
+            "logoUrl": logo_data["logoUrl"],
+            "logoStoragePath": logo_data["logoStoragePath"],
+            "logoCategory": logo_data["logoCategory"],
+            "logoFilename": logo_data["logoFilename"],
+            "logoFileSize": logo_data["logoFileSize"],
+            "source": "brand_data"
+        }
+    
+    response_data["cache"] = {
+        "hit": bool(cached),
+        "sourceArtifactId": cached["artifactId"] if cached else None,
+    }
+    if preprocessing:
+        response_data["preprocessing"] = preprocessing
+    if timings is not None:
+        response_data["stageTimingsMs"] = stage_timings_ms(timings)
+
+    # Add warnings if any models failed
+    if failed_models:
+        response_data["warnings"] = {
+            "failed_models": failed_models,
+            "message": f"The following models failed: {', '.join(failed_models)}"
+        }
+    
+    return response_data
+
+
+# ===============================
+# Resumable upload sessions
+# ===============================
+# Large media can be sent in ranges instead of one multipart request. Each
+# session wraps a GCS resumable upload: chunks are streamed straight through
+# to GCS (nothing is buffered here), a dropped chunk is retried from the
+# offset GCS reports, and the finished object is handed to the analysis
+# endpoint by uploadSessionId. GCS forgets an unfinished session after a week;
+# from then on (expiresAt) the session answers 410 and the upload has to start
+# over in a new one.
+
+UPLOAD_SESSION_MAX_SIZE = int(os.getenv("UPLOAD_SESSION_MAX_SIZE", str(1024 * 1024 * 1024)))  # 1GB
+UPLOAD_CHUNK_GRANULARITY = 256 * 1024  # GCS requires non-final chunks in multiples of 256KiB
+UPLOAD_CHUNK_TIMEOUT = float(os.getenv("UPLOAD_CHUNK_TIMEOUT", "300"))
+UPLOAD_SESSION_TTL = timedelta(days=7)
+UPLOAD_SESSION_EXPIRED = "Upload session expired; open a new one"
+UPLOAD_SESSION_CONTENT_TYPES = [
+    'image/jpeg', 'image/jpg', 'image/png', 'image/gif', 'image/webp', 'image/svg+xml',
+    'video/mp4', 'video/avi', 'video/mov', 'video/wmv', 'video/flv', 'video/webm',
+]
+
+gcs_session_client: Optional[httpx.AsyncClient] = None
+
+
+class UploadSessionRequest(BaseModel):
+    userId: str
+    filename: str
+    contentType: str
+    totalSize: int
+
+
+@app.on_event("startup")
+async def start_gcs_session_client():
+    global gcs_session_client
+    gcs_session_client = httpx.AsyncClient(timeout=httpx.Timeout(UPLOAD_CHUNK_TIMEOUT, connect=UPSTREAM_CONNECT_TIMEOUT))
+
+
+@app.on_event("shutdown")
+async def stop_gcs_session_client():
+    if gcs_session_client is not None:
+        await gcs_session_client.aclose()
+
+
+def _upload_session_ref(session_id: str):
+    return db.collection("upload_sessions").document(session_id)
+
+
+def _received_from_gcs(response: httpx.Response, total: int) -> Optional[int]:
+    """Bytes GCS has persisted: total on completion, the Range end + 1 on 308, None otherwise."""
+    if response.status_code in (200, 201):
+        return total
+    if response.status_code == 308:
+        committed = response.headers.get("Range")
+        return int(committed.rsplit("-", 1)[1]) + 1 if committed else 0
+    return None
+
+
+async def query_upload_progress(session: dict) -> int:
+    """Ask GCS how many bytes of a resumable upload it has persisted."""
+    response = await gcs_session_client.put(
+        session["gcsSessionUrl"],
+        headers={"Content-Range": f"bytes */{session['totalSize']}", "Content-Length": "0"},
+    )
+    if response.status_code in (404, 410):
+        raise HTTPException(status_code=410, detail=UPLOAD_SESSION_EXPIRED)
+    received = _received_from_gcs(response, session["totalSize"])
+    if received is None:
+        raise HTTPException(status_code=502, detail=f"Storage rejected status query: {response.status_code} {response.text}")
+    return received
+
+
+async def get_upload_session(session_id: str, user_id: Optional[str] = None) -> dict:
+    """Load a session, optionally checking it belongs to user_id. An unfinished session past expiresAt is 410."""
+    doc = await fs_get(_upload_session_ref(session_id))
+    if not doc.exists:
+        raise HTTPException(status_code=404, detail=f"Upload session {session_id} not found")
+    session = doc.to_dict()
+    if user_id is not None and session.get("userId") != user_id:
+        raise HTTPException(status_code=403, detail=f"Upload session {session_id} does not belong to user {user_id}")
+    if session.get("status") == "open" and session.get("expiresAt", "") <= datetime.utcnow().isoformat() + "Z":
+        raise HTTPException(status_code=410, detail=UPLOAD_SESSION_EXPIRED)
+    return session
+
+
+@fs_transactional
+def _claim_upload_session_in_transaction(transaction, session_ref, artifact_id: str) -> dict:
+    snapshot = tx_get(transaction, session_ref)
+    session = snapshot.to_dict() if snapshot.exists else None
+    if not session or session.get("status") != "finalized":
+        raise HTTPException(status_code=409, detail="Upload session is not finalized or was already used")
+    transaction.update(session_ref, {
+        "status": "consumed",
+        "artifactId": artifact_id,
+        "updatedAt": datetime.utcnow().isoformat() + "Z",
+    })
+    return session
+
+
+async def claim_upload_session(session_id: str, artifact_id: str) -> dict:
+    """Mark a finalized session as used by one analysis so its object is handed out once."""
+    session_ref = _upload_session_ref(session_id)
+    return await run_io(lambda: _claim_upload_session_in_transaction(db.transaction(), session_ref, artifact_id))
+
 
-        # Store in Firestore
-        db.collection("brandData").document(brand_id).set(data)
+async def unclaim_upload_session(session_id: str):
+    """Put a claimed session back to finalized when the analysis could not take its object."""
+    try:
+        await fs_update(_upload_session_ref(session_id), {
+            "status": "finalized",
+            "artifactId": firestore.DELETE_FIELD,
+            "updatedAt": datetime.utcnow().isoformat() + "Z",
+        })
+    except Exception as e:
+        logger.warning("Could not reopen upload session %s: %s", session_id, e)
 
-        return {
-            "message": "Brand data saved successfully", 
-            "brand_id": brand_id,
-            "logo_count": len(media_info_list),
-            "logo_files": media_info_list
-        }
 
+def _upload_session_status(session_id: str, session: dict) -> dict:
+    return {
+        "sessionId": session_id,
+        "status": session["status"],
+        "filename": session["filename"],
+        "contentType": session["contentType"],
+        "totalSize": session["totalSize"],
+        "bytesReceived": session.get("bytesReceived", 0),
+        "nextOffset": session.get("bytesReceived", 0),
+    }
+
+
+@app.post("/upload-sessions")
+async def create_upload_session(body: UploadSessionRequest):
+    """
+    Open a resumable upload. Send the bytes with PUT /upload-sessions/{sessionId}
+    and a Content-Range header, then POST .../finalize.
+    """
+    if body.contentType not in UPLOAD_SESSION_CONTENT_TYPES:
+        raise HTTPException(status_code=400, detail=f"Invalid media file type: {body.contentType}")
+    if body.totalSize <= 0 or body.totalSize > UPLOAD_SESSION_MAX_SIZE:
+        raise HTTPException(status_code=400, detail=f"totalSize must be between 1 and {UPLOAD_SESSION_MAX_SIZE} bytes")
+
+    session_id = str(uuid.uuid4())
+    file_ext = os.path.splitext(body.filename)[1]
+    storage_path = f"upload_sessions/{body.userId}/{session_id}{file_ext}"
+    try:
+        gcs_session_url = await run_io(
+            bucket.blob(storage_path).create_resumable_upload_session,
+            content_type=body.contentType,
+            size=body.totalSize,
+        )
     except Exception as e:
-        print("Error saving brand data:", e)
-        raise HTTPException(status_code=500, detail=str(e))
+        raise HTTPException(status_code=500, detail=f"Could not open storage upload session: {str(e)}")
 
+    now = datetime.utcnow()
+    session = {
+        "userId": body.userId,
+        "filename": body.filename,
+        "contentType": body.contentType,
+        "totalSize": body.totalSize,
+        "storagePath": storage_path,
+        "gcsSessionUrl": gcs_session_url,
+        "bytesReceived": 0,
+        "status": "open",
+        "createdAt": now.isoformat() + "Z",
+        "updatedAt": now.isoformat() + "Z",
+        "expiresAt": (now + UPLOAD_SESSION_TTL).isoformat() + "Z",
+    }
+    await fs_set(_upload_session_ref(session_id), session)
+    logger.info("Opened upload session %s for %s (%s bytes)", session_id, body.filename, body.totalSize)
+    return {**_upload_session_status(session_id, session), "chunkGranularity": UPLOAD_CHUNK_GRANULARITY}
 
-@app.post("/save-plan-selection")
-async def save_plan_selection(
-    userId: str = Form(...),
-    planId: str = Form(...),
-    planName: str = Form(...),
-    paymentId: str = Form(...),
-    paymentStatus: str = Form(...),
-    subscriptionType: str = Form(...),
-    subscriptionStartDate: str = Form(...),
-    subscriptionEndDate: str = Form(...),
-    totalPrice: float = Form(...),
-    basePrice: float = Form(...),
-    additionalAdPrice4: float = Form(...),
-    totalAds: int = Form(...),
-    validityDays: int = Form(...),
-    isActive: bool = Form(...),
-    selectedFeatures: list[str] = Form(...),
-    createdAt: str = Form(...),
-    updatedAt: str = Form(...),
-    max_ads_per_month: int = Form(...)
-            
-):
+
+@app.put("/upload-sessions/{session_id}")
+async def upload_session_chunk(session_id: str, request: Request):
+    """
+    Append one range ("Content-Range: bytes start-end/total") to the session.
+    start must equal the session's nextOffset; non-final chunks must be a multiple
+    of 256KiB. The body is streamed to storage as it arrives.
+    """
+    session = await get_upload_session(session_id)
+    if session["status"] != "open":
+        raise HTTPException(status_code=409, detail=f"Upload session is {session['status']}")
+
+    content_range = request.headers.get("Content-Range", "")
     try:
-        doc_id = userId
-        
-        # selectedFeatures may arrive as an array, or as a single comma-separated string inside an array
-        features_list = selectedFeatures or []
-        if len(features_list) == 1 and "," in features_list[0]:
-            features_list = [item.strip().strip('"\'') for item in features_list[0].split(',') if item.strip()]
-        
-        # Build indexed map: {"0": feature0, "1": feature1, ...}
-        features_indexed = {str(i): feature for i, feature in enumerate(features_list)}
-        
-        plan_data = {
-            "userId": userId,
-            "planId": planId,
-            "planName": planName,
-            "paymentId": paymentId,
-            "paymentStatus": paymentStatus,
-            "subscriptionType": subscriptionType,
-            "subscriptionStartDate": subscriptionStartDate,
-            "subscriptionEndDate": subscriptionEndDate,
-            "totalPrice": totalPrice,
-            "basePrice": basePrice,
-            "additionalAdPrice4": additionalAdPrice4,
-            "totalAds": totalAds,
-            "validityDays": validityDays,
-            "isActive": isActive,
-            "selectedFeatures": features_list,
-            #"selectedFeaturesIndexed": features_indexed,
-            "createdAt": createdAt,
-            "updatedAt": updatedAt,
-            "max_ads_per_month": max_ads_per_month,
-            "adsUsed": 0
-        }
-        
-        db.collection("PlanSelectionDetails").document(doc_id).set(plan_data)
+        unit, spec = content_range.split(" ", 1)
+        byte_range, total = spec.split("/", 1)
+        start, end = (int(part) for part in byte_range.split("-", 1))
+        total = int(total)
+        if unit != "bytes":
+            raise ValueError(unit)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Content-Range header must look like 'bytes start-end/total'")
 
-        # Also upsert subscription into user profile so frontend can read it
-        try:
-            subscription = {
-                "planType": planId,
-                "planName": planName,
-                "features": features_list,
-                "adQuota": totalAds,
-                "totalPrice": totalPrice,
-                "basePrice": basePrice,
-                "validityDays": validityDays,
-                "subscriptionStartDate": subscriptionStartDate,
-                "subscriptionEndDate": subscriptionEndDate,
-                "status": "active" if isActive else "inactive",
-                "adsUsed": 0,
-                "max_ads_per_month": max_ads_per_month,
-                "paymentStatus": paymentStatus,
-                "paymentId": paymentId,
-                "subscriptionType": subscriptionType,
-                "updatedAt": updatedAt,
-            }
-            profile_ref = db.collection("userProfileDetails").document(userId)
-            profile_ref.set({
-                "userId": userId,
-                "subscription": subscription,
-                "updatedAt": updatedAt,
-            }, merge=True)
-        except Exception as e:
-            # Do not fail the request if profile upsert fails; log instead
-            print(f"Warning: could not upsert subscription into user profile: {e}")
+    received = session.get("bytesReceived", 0)
+    if total != session["totalSize"] or end < start or end >= total:
+        raise HTTPException(status_code=416, detail=f"Range {start}-{end}/{total} does not fit a {session['totalSize']} byte upload")
+    if start != received:
+        raise HTTPException(status_code=409, detail={"message": "Chunk does not start at the next offset", "nextOffset": received})
+    chunk_size = end - start + 1
+    if end + 1 < total and chunk_size % UPLOAD_CHUNK_GRANULARITY:
+        raise HTTPException(status_code=400, detail=f"Non-final chunks must be a multiple of {UPLOAD_CHUNK_GRANULARITY} bytes")
 
-        return {"message": "Plan selection saved", "doc_id": doc_id}
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error saving plan: {str(e)}")
+    try:
+        response = await gcs_session_client.put(
+            session["gcsSessionUrl"],
+            content=request.stream(),
+            headers={"Content-Range": f"bytes {start}-{end}/{total}", "Content-Length": str(chunk_size)},
+        )
+        received = _received_from_gcs(response, total)
+        if received is None:
+            logger.error("Upload session %s: storage answered %s", session_id, response.status_code)
+            received = await query_upload_progress(session)
+    except httpx.HTTPError as e:
+        # The client dropped or storage hung up mid-chunk; report where to resume
+        logger.warning("Upload session %s: chunk %s-%s interrupted: %s", session_id, start, end, e)
+        received = await query_upload_progress(session)
 
+    count_metric(gcs_upload_byte_counts, metrics_route.get(), max(received - start, 0))
+    session["bytesReceived"] = received
+    session["updatedAt"] = datetime.utcnow().isoformat() + "Z"
+    await fs_update(_upload_session_ref(session_id), {
+        "bytesReceived": received,
+        "updatedAt": session["updatedAt"],
+    })
+    return {**_upload_session_status(session_id, session), "complete": received >= total}
+
+
+@app.get("/upload-sessions/{session_id}")
+async def get_upload_session_status(session_id: str):
+    """Report how much of an upload storage has persisted, i.e. where to resume."""
+    session = await get_upload_session(session_id)
+    if session["status"] == "open":
+        session["bytesReceived"] = await query_upload_progress(session)
+        await fs_update(_upload_session_ref(session_id), {"bytesReceived": session["bytesReceived"]})
+    return _upload_session_status(session_id, session)
+
+
+@app.post("/upload-sessions/{session_id}/finalize")
+async def finalize_upload_session(session_id: str):
+    """Check every byte arrived and make the object available to /postAnalysisDetailsFormData."""
+    session = await get_upload_session(session_id)
+    if session["status"] != "open":
+        return _upload_session_status(session_id, session)
+
+    received = await query_upload_progress(session)
+    if received < session["totalSize"]:
+        raise HTTPException(status_code=409, detail={"message": "Upload is incomplete", "nextOffset": received})
+
+    blob = bucket.blob(session["storagePath"])
+    await run_io(blob.reload)
+    if blob.size != session["totalSize"]:
+        raise HTTPException(status_code=409, detail=f"Stored object is {blob.size} bytes, expected {session['totalSize']}")
+
+    session.update({
+        "status": "finalized",
+        "bytesReceived": received,
+        "updatedAt": datetime.utcnow().isoformat() + "Z",
+    })
+    await fs_update(_upload_session_ref(session_id), {
+        "status": "finalized",
+        "bytesReceived": received,
+        "finalizedAt": session["updatedAt"],
+        "updatedAt": session["updatedAt"],
+    })
+    logger.info("Finalized upload session %s", session_id)
+    return _upload_session_status(session_id, session)
 
 
-   
 @app.post("/postAnalysisDetailsFormData")
 async def post_analysis_details_form_data(
     userId: str = Form(...),
@@ -405,7 +3143,11 @@ async def post_analysis_details_form_data(
     clientId: str = Form(...),
     artifacts: str = Form(...),
     adTitle: str = Form(""),     # Ad title for display in Libraries
-    mediaFile: UploadFile = File(...)
+    mediaFile: Optional[UploadFile] = File(None),
+    uploadSessionId: Optional[str] = Form(None),  # Finalized /upload-sessions upload instead of mediaFile
+    asyncMode: Optional[bool] = Form(None),  # Submit-then-poll; defaults to ANALYSIS_ASYNC_DEFAULT
+    analysisMode: Optional[str] = Form(None),  # "comprehensive" or "fanout"; defaults to ANALYSIS_MODE
+    bypassCache: bool = Form(False)  # Force a fresh upstream analysis
 ):
     """
     Main endpoint for AI analysis of media files.
@@ -422,98 +3164,89 @@ async def post_analysis_details_form_data(
     Parameters:
     - userId: User identifier
     - brandId: Brand identifier (required)
-    - mediaFile: Main media file to analyze (required)
+    - mediaFile: Main media file to analyze (or uploadSessionId)
     - Other parameters for context and analysis configuration
     
     Returns:
     - JSON response with analysis results from all AI models
     - Success/failure statistics
     - Media and brand information
+
+    With asyncMode=true the request returns as soon as the plan is validated and
+    the media is uploaded: the analysis is queued and the response only carries
+    the artifactId. Poll /analysis-status/{artifactId} for progress.
+
+    With analysisMode=fanout the individual models are called in parallel and
+    merged into the comprehensive-analysis result shape; models that fail or
+    time out are reported as warnings while the rest are kept.
+
+    Re-submitting identical media with identical inputs reuses the earlier
+    results from the result cache unless bypassCache=true. Plan usage is
+    charged either way.
+
+    Large files can be sent through /upload-sessions first; pass the finalized
+    session as uploadSessionId instead of mediaFile.
     """
+    reservation = None
+    upload_session = None
+    claimed_session = False
+    # The uploaded media (or the job carrying it) until the queue or
+    # run_analysis_job takes it over; released if the request fails first
+    unowned_media = None
+    timings = new_stage_timings()
     try:
         # Debug: Log received parameters
-        print(f"🔍 DEBUG: Received adTitle: '{adTitle}'")
-        print(f"🔍 DEBUG: Received messageIntent: '{messageIntent}'")
-        print(f"🔍 DEBUG: Received funnelStage: '{funnelStage}'")
+        logger.debug("Received adTitle: '%s'", adTitle)
+        logger.debug("Received messageIntent: '%s'", messageIntent)
+        logger.debug("Received funnelStage: '%s'", funnelStage)
         
         artifact_id = str(uuid.uuid4())
+        artifact_id_var.set(artifact_id)
         
         # Input validation
-        if not mediaFile or mediaFile.filename == "":
-            raise HTTPException(status_code=400, detail="Media file is required")
-        
         if not userId or userId.strip() == "":
             raise HTTPException(status_code=400, detail="User ID is required")
+
+        if uploadSessionId:
+            upload_session = await get_upload_session(uploadSessionId, userId)
+            if upload_session["status"] != "finalized":
+                raise HTTPException(status_code=409, detail=f"Upload session is {upload_session['status']}, expected finalized")
+            media_filename = upload_session["filename"]
+            media_content_type = upload_session["contentType"]
+            media_size = upload_session["totalSize"]
+        elif not mediaFile or mediaFile.filename == "":
+            raise HTTPException(status_code=400, detail="Media file is required")
+        else:
+            media_filename = mediaFile.filename
+            media_content_type = mediaFile.content_type
+            media_size = mediaFile.size
         
         if not brandId or brandId.strip() == "":
             raise HTTPException(status_code=400, detail="Brand ID is required")
         
+        analysis_mode = analysisMode or ANALYSIS_MODE_DEFAULT
+        if analysis_mode not in ANALYSIS_MODES:
+            raise HTTPException(status_code=400, detail=f"Invalid analysisMode: {analysis_mode}. Use one of: {', '.join(ANALYSIS_MODES)}")
 
         
-        # ===== PLAN VALIDATION AND MONTHLY RESET LOGIC =====
+        # ===== PLAN VALIDATION: RESERVE ONE AD UNIT =====
+        # The unit is taken atomically now and either committed once the
+        # analysis is stored or released if anything fails on the way.
         try:
-            # Get user's plan details
-            plan_doc = db.collection("PlanSelectionDetails").document(userId).get()
-            if not plan_doc.exists:
-                raise HTTPException(status_code=404, detail="User plan not found. Please select a plan first.")
-            
-            plan_data = plan_doc.to_dict()
-            max_ads_per_month = plan_data.get("max_ads_per_month", 0)
-            ads_used = plan_data.get("adsUsed", 0)
-            total_ads = plan_data.get("totalAds", 0)
-            last_usage_date = plan_data.get("lastUsageDate")
-            
-            # Check if we need to reset monthly usage (new month)
-            current_date = datetime.utcnow()
-            print(f"🔍 Monthly usage check - Current date: {current_date}, Last usage: {last_usage_date}")
-            
-            if last_usage_date:
-                try:
-                    last_usage = datetime.fromisoformat(last_usage_date.replace("Z", ""))
-                    print(f"🔍 Parsed dates - Current: {current_date.year}-{current_date.month:02d}, Last: {last_usage.year}-{last_usage.month:02d}")
-                    
-                    # Reset if it's a new month
-                    if (current_date.year != last_usage.year or current_date.month != last_usage.month):
-                        print(f"🔄 Monthly reset triggered: {last_usage.month}/{last_usage.year} -> {current_date.month}/{current_date.year}")
-                        print(f"🔍 BEFORE reset - ads_used: {ads_used}")
-                        ads_used = 0
-                        print(f"🔍 AFTER reset - ads_used: {ads_used}")
-                    else:
-                        print(f"✅ Same month - preserving ads_used: {ads_used}")
-                except Exception as e:
-                    print(f"⚠️ Warning: Could not parse last usage date: {e}")
-                    print(f"🔍 Defaulting ads_used to 0 due to parse error")
-                    ads_used = 0
-            else:
-                print(f"🔍 No last usage date - keeping ads_used: {ads_used}")
-            
-            # Check monthly limit
-            if ads_used >= max_ads_per_month:
-                raise HTTPException(
-                    status_code=429, 
-                    detail=f"Maximum monthly limit reached ({max_ads_per_month} ads). Please wait until next month or upgrade your plan."
-                )
-            
-            # Check total ads remaining
-            if total_ads <= 0:
-                raise HTTPException(
-                    status_code=400, 
-                    detail="No ads remaining in your plan. Please purchase more ads or upgrade your plan."
-                )
-            
-            print(f"✅ Plan validation passed: {ads_used}/{max_ads_per_month} monthly, {total_ads} total remaining")
-            
+            with analysis_span(timings, "plan_validation"):
+                reservation = await reserve_ad_quota(userId, artifact_id)
+            logger.info("Plan validation passed: %s/%s monthly, %s total remaining after this analysis", reservation['adsUsed'], reservation['max_ads_per_month'], reservation['totalAds'])
         except HTTPException:
             raise
         except Exception as e:
-            print(f"Error during plan validation: {str(e)}")
+            logger.error("Error during plan validation: %s", e)
             raise HTTPException(status_code=500, detail=f"Error validating user plan: {str(e)}")
         
-        # Debug: Print received values
-        print(f"🔍 DEBUG: Received channels: '{channels}'")
-        print(f"🔍 DEBUG: Received artifacts: '{artifacts}'")
-        print(f"🔍 DEBUG: Media file: {mediaFile.filename} ({mediaFile.content_type})")
-        print(f"🔍 DEBUG: Logo will be fetched from brand data")
+        # Debug: Log received values
+        logger.debug("Received channels: '%s'", channels)
+        logger.debug("Received artifacts: '%s'", artifacts)
+        logger.debug("Media file: %s (%s)", media_filename, media_content_type)
+        logger.debug("Logo will be fetched from brand data")
         
         # Safely parse channels JSON with multiple format support
         channels_list = []
@@ -534,12 +3267,12 @@ async def post_analysis_details_form_data(
                 if not isinstance(channels_list, list):
                     channels_list = [channels_list] if channels_list else []
                 
-                print(f"✅ DEBUG: Parsed channels_list: {channels_list}")
+                logger.debug("Parsed channels_list: %s", channels_list)
             else:
-                print(f"⚠️ Channels is empty or None")
+                logger.warning("Channels is empty or None")
                 channels_list = []
         except Exception as e:
-            print(f"Warning: Error parsing channels '{channels}': {e}")
+            logger.warning("Error parsing channels '%s': %s", channels, e)
             channels_list = []
         
         # Safely parse artifacts JSON with multiple format support
@@ -551,29 +3284,29 @@ async def post_analysis_details_form_data(
                     artifacts_data = json.loads(artifacts)
                 except json.JSONDecodeError:
                     # If JSON fails, try to create a simple object
-                    print(f"Warning: Invalid artifacts JSON: {artifacts}, using empty object")
+                    logger.warning("Invalid artifacts JSON: %s, using empty object", artifacts)
                     artifacts_data = {}
                 
                 # Ensure it's a dict
                 if not isinstance(artifacts_data, dict):
                     artifacts_data = {}
                 
-                print(f"✅ DEBUG: Parsed artifacts_data: {artifacts_data}")
+                logger.debug("Parsed artifacts_data: %s", artifacts_data)
             else:
-                print(f"⚠️ Artifacts is empty or None")
+                logger.warning("Artifacts is empty or None")
                 artifacts_data = {}
         except Exception as e:
-            print(f"Warning: Error parsing artifacts '{artifacts}': {e}")
+            logger.warning("Error parsing artifacts '%s': %s", artifacts, e)
             artifacts_data = {}
         
         # Validate and provide defaults for required fields
         if not messageIntent or messageIntent.strip() == "":
             messageIntent = "string"
-            print(f"⚠️ messageIntent was empty, using default: {messageIntent}")
+            logger.warning("messageIntent was empty, using default: %s", messageIntent)
         
         if not funnelStage or funnelStage.strip() == "":
             funnelStage = "string"
-            print(f"⚠️ funnelStage was empty, using default: {funnelStage}")
+            logger.warning("funnelStage was empty, using default: %s", funnelStage)
         
         # Get brand data using specific brandId from brandData collection
         brand_name = "Unknown Brand"
@@ -583,41 +3316,40 @@ async def post_analysis_details_form_data(
         logo_data = None
         
         try:
-            # Get specific brand document by brandId
-            brand_doc = db.collection("brandData").document(brandId).get()
+            # Owner, name, tone, palette and first logo, usually from the brand cache
+            with analysis_span(timings, "brand_lookup"):
+                brand = await get_brand_summary(brandId)
             
-            if brand_doc.exists:
-                brand_data = brand_doc.to_dict()
-                
+            if brand is not None:
                 # Verify the brand belongs to the user
-                if brand_data.get("userId") != userId:
+                if brand["userId"] != userId:
                     raise HTTPException(
                         status_code=403, 
                         detail=f"Brand ID {brandId} does not belong to user {userId}"
                     )
                 
-                brand_name = brand_data.get("brandName", "Unknown Brand")
-                brand_logo = brand_data.get("brandLogo", "default_logo.png")
-                tone_of_voice = brand_data.get("toneOfVoice", "Professional and friendly")
-                brand_colours = brand_data.get("colorPalette", "#FF0000,#00FF00,#0000FF")
+                brand_name = brand["brandName"]
+                brand_logo = brand["brandLogo"]
+                tone_of_voice = brand["toneOfVoice"]
+                brand_colours = brand["colorPalette"]
                 
-                # Extract logo information from mediaFiles array
-                media_files = brand_data.get("mediaFiles", [])
-                for media_file in media_files:
-                    if media_file.get("mediaType") == "logo":
-                        logo_data = {
-                            "logoUrl": media_file.get("url"),
-                            "logoType": media_file.get("contentType"),
-                            "logoStoragePath": media_file.get("storagePath"),
-                            "logoCategory": media_file.get("mediaType"),
-                            "logoFilename": media_file.get("filename"),
-                            "logoFileSize": media_file.get("fileSize"),
-                            "logo_artifact_id": media_file.get("fileId")
-                        }
-                        print(f"✅ Found logo in brand data: {logo_data['logoFilename']}")
-                        break
+                # Use the brand's first logo
+                logo = brand["primaryLogo"]
+                if logo:
+                    with analysis_span(timings, "url_signing"):
+                        logo_url = await gcs_signed_url(logo["storagePath"]) if "storagePath" in logo else logo.get("url")
+                    logo_data = {
+                        "logoUrl": logo_url,
+                        "logoType": logo.get("contentType"),
+                        "logoStoragePath": logo.get("storagePath"),
+                        "logoCategory": logo.get("mediaType"),
+                        "logoFilename": logo.get("filename"),
+                        "logoFileSize": logo.get("fileSize"),
+                        "logo_artifact_id": logo.get("fileId")
+                    }
+                    logger.info("Found logo in brand data: %s", logo_data['logoFilename'])
                 
-                print(f"✅ Found brand data: {brand_name}, ID: {brandId}")
+                logger.info("Found brand data: %s, ID: %s", brand_name, brandId)
             else:
                 raise HTTPException(
                     status_code=404, 
@@ -626,7 +3358,7 @@ async def post_analysis_details_form_data(
         except HTTPException:
             raise
         except Exception as e:
-            print(f"⚠️ Error getting brand data: {str(e)}")
+            logger.warning("Error getting brand data: %s", e)
             raise HTTPException(
                 status_code=500, 
                 detail=f"Error fetching brand data: {str(e)}"
@@ -637,301 +3369,144 @@ async def post_analysis_details_form_data(
         ALLOWED_VIDEO_TYPES = ['video/mp4', 'video/avi', 'video/mov', 'video/wmv', 'video/flv', 'video/webm']
         
         # Validate media file type
-        if mediaFile.content_type not in ALLOWED_IMAGE_TYPES + ALLOWED_VIDEO_TYPES:
+        if media_content_type not in ALLOWED_IMAGE_TYPES + ALLOWED_VIDEO_TYPES:
             raise HTTPException(
                 status_code=400, 
-                detail=f"Invalid media file type: {mediaFile.content_type}. Allowed types: {', '.join(ALLOWED_IMAGE_TYPES + ALLOWED_VIDEO_TYPES)}"
+                detail=f"Invalid media file type: {media_content_type}. Allowed types: {', '.join(ALLOWED_IMAGE_TYPES + ALLOWED_VIDEO_TYPES)}"
             )
         
         # Determine media type based on content type using predefined lists
         media_type = "image"  # default
-        content_type = mediaFile.content_type
+        content_type = media_content_type
         
         if content_type in ALLOWED_VIDEO_TYPES:
             media_type = "video"
-        elif "logo" in mediaFile.filename.lower() or "logo" in content_type.lower():
+        elif "logo" in media_filename.lower() or "logo" in content_type.lower():
             media_type = "logo"
         elif content_type in ALLOWED_IMAGE_TYPES:
             media_type = "image"
         
         # Create storage path with structure: user_id - brand_name - brandId - media_type
-        file_ext = os.path.splitext(mediaFile.filename)[1]
+        file_ext = os.path.splitext(media_filename)[1]
         storage_path = f"{userId}/{brand_name}/{brandId}/{media_type}/{artifact_id}{file_ext}"
         storage_filename = storage_path
         
-        print(f"📁 Storage path: {storage_path}")
-        print(f"📁 Media type: {media_type}")
-        print(f"📁 Content type: {content_type}")
-        
-        # Upload to GCS with the new path structure
-        blob = bucket.blob(storage_filename)
-        blob.upload_from_file(mediaFile.file, content_type=mediaFile.content_type)
-        #media_url = blob.generate_signed_url(expiration=3600 * 24 * 7)
-        media_url = blob.generate_signed_url(
-                version="v4",                # use v4 signed URLs
-                expiration=timedelta(days=7), # 7 days from now
-                method="GET"                  # HTTP method allowed
-            )
-        
-        # Logo data is fetched from brandData collection above
-        # No need to process uploaded logo file since we get it from brand data
- 
-
- 
-        # Use only comprehensive-analysis for AI results
-        selected_features = ["comprehensive-analysis"]
-        print("Using comprehensive-analysis model for AI results")
- 
-        # Brand data is already fetched above using userId
-        # Use the values we got from the brandData collection query
- 
-        results = {}
- 
-        # Process comprehensive-analysis only
-        feature = "comprehensive-analysis"
-        feature_config = feature_api_config.get(feature)
- 
-        if not feature_config:
-            results[feature] = {"error": "No API configured for comprehensive-analysis"}
+        logger.info("Storage path: %s", storage_path)
+        logger.info("Media type: %s", media_type)
+        logger.info("Content type: %s", content_type)
+        
+        if upload_session:
+            # The bytes are already in GCS; move the object into place server-side
+            await claim_upload_session(uploadSessionId, artifact_id)
+            claimed_session = True
+            staged_blob = bucket.blob(upload_session["storagePath"])
+            with analysis_span(timings, "media_upload"):
+                await run_io(bucket.rename_blob, staged_blob, storage_filename)
+            claimed_session = False  # the object now belongs to this analysis
         else:
-            try:
-                print(f'🤖 Processing comprehensive-analysis')
-                url = feature_config["url"]
- 
-                # Create a fresh file object for the request
-                mediaFile.file.seek(0)
-                file_content = mediaFile.file.read()
-                file_obj = io.BytesIO(file_content)
- 
-                # Map channels to valid platform names
-                platform_mapping = {
-                    "facebook": "Facebook",
-                    "instagram": "Instagram", 
-                    "google ads": "Google Ads",
-                    "youtube": "YouTube",
-                    "tiktok": "TikTok"
-                }
-                comp_platforms = []
-                print(f"🔍 DEBUG: Channels list: {channels_list}")
-                for channel in channels_list:
-                    if channel.lower() in platform_mapping:
-                        comp_platforms.append(platform_mapping[channel.lower()])
-                
-                # Use only the platforms provided in the request, no defaults
-                if not comp_platforms:
-                    print(f"⚠️ No valid platforms found in channels: {channels_list}")
-                    comp_platforms = []  # Empty list instead of defaults
-                
-                # Prepare form data for comprehensive analysis
-                form_data = {
-                    "ad_description": messageIntent,
-                    "user_ad_type": funnelStage,
-                    "brand_colors": brand_colours,
-                    "tone_of_voice": tone_of_voice,
-                    "platforms": ",".join(comp_platforms)
-                }
-                files = {
-                    "file": (mediaFile.filename, file_obj, mediaFile.content_type)
-                }
-                
-                # Add logo from brand data if available
-                if logo_data and logo_data.get("logoUrl"):
-                    form_data["logo_url"] = logo_data["logoUrl"]
- 
-                print(f"🤖 Calling comprehensive-analysis at {url}")
-                print(f"📤 Form data: {form_data}")
-                response = requests.post(url, data=form_data, files=files, timeout=1200)
- 
-                if response.status_code == 200:
-                    try:
-                        response_data = response.json()
-                        results[feature] = {"success": True, "data": response_data}
-                        print(f"✅ comprehensive-analysis: Success")
-                    except json.JSONDecodeError:
-                        results[feature] = {"success": True, "data": response.text}
-                        print(f"✅ comprehensive-analysis: Success (non-JSON response)")
-                else:
-                    results[feature] = {
-                        "success": False,
-                        "status_code": response.status_code,
-                        "error": response.text
-                    }
-                    print(f"❌ comprehensive-analysis: Failed - {response.status_code}")
- 
-            except requests.exceptions.RequestException as e:
-                results[feature] = {"success": False, "error": str(e)}
-                print(f"❌ comprehensive-analysis: Exception - {str(e)}")
- 
-        # ===== STORE ANALYSIS RESULTS AND UPDATE PLAN USAGE ONLY ON SUCCESS =====
-        try:
-            # Calculate success statistics first
-            successful_models = [feature for feature, result in results.items() if result.get('success', False)]
-            failed_models = [feature for feature, result in results.items() if not result.get('success', False)]
-            
-            # Check if we have at least one successful model
-            if len(successful_models) == 0:
-                print(f"❌ No successful models found. Skipping plan usage update.")
-                raise Exception("No successful AI models completed. Analysis failed.")
-            
-            # Check if we have a reasonable success rate (at least 50% of requested models)
-            success_rate = len(successful_models) / len(selected_features) if selected_features else 0
-            if success_rate < 0.5:
-                print(f"⚠️ Low success rate ({success_rate:.1%}). Only {len(successful_models)}/{len(selected_features)} models succeeded.")
-                # Still proceed but log the warning
-            
-            # Only update plan usage if we have successful analysis results
-            new_ads_used = ads_used + 1
-            new_total_ads = total_ads - 1
-            
-            plan_updates = {
-                "adsUsed": new_ads_used,
-                "totalAds": new_total_ads,
-                "lastUsageDate": current_date.isoformat() + "Z",
-                "updatedAt": current_date.isoformat() + "Z"
-            }
-            
-            # Update the plan document
-            db.collection("PlanSelectionDetails").document(userId).update(plan_updates)
-            print(f"✅ Plan usage updated: {new_ads_used}/{max_ads_per_month} monthly, {new_total_ads} total remaining")
-            
-            # SYNC: Also update the user profile subscription data so frontend shows correct data
-            try:
-                profile_ref = db.collection("userProfileDetails").document(userId)
-                profile_ref.update({
-                    "subscription.adsUsed": new_ads_used,
-                    "subscription.adQuota": new_total_ads,  # FIX: Use decremented new_total_ads for correct frontend display
-                    "subscription.max_ads_per_month": max_ads_per_month,
-                    "subscription.updatedAt": current_date.isoformat() + "Z",
-                    "updatedAt": current_date.isoformat() + "Z"
-                })
-                print(f"✅ User profile subscription synced: {new_ads_used} ads used, {new_total_ads} total quota (remaining: {new_total_ads})")
-            except Exception as e:
-                print(f"⚠️ Warning: Could not sync subscription data to user profile: {e}")
-                # Don't fail the request if profile sync fails
-            
-            # Store analysis data in user_analysis collection
-            print(f"🔍 DEBUG: About to save adTitle to database: '{adTitle}'")
-            analysis_data = {
-                "userId": userId,
-                "artifact_id": artifact_id,
-                "brand_id": brandId,
-                "timestamp": timestamp,
-                "messageIntent": messageIntent,
-                "funnelStage": funnelStage,
-                "channels": channels_list,
-                "source": source,
-                "clientId": clientId,
-                "artifacts": artifacts_data,
-                "adTitle": adTitle,  # Include ad title for Libraries display
-                "mediaUrl": media_url,
-                "mediaType": mediaFile.content_type,
-                "storagePath": storage_path,
-                "mediaCategory": media_type,
-                "brandName": brand_name,
-                "ai_analysis_results": results,  # Store all AI model responses
-                "plan_usage_at_time": {
-                    "adsUsed": new_ads_used,
-                    "maxAdsPerMonth": max_ads_per_month,
-                    "totalAdsRemaining": new_total_ads,
-                    "planName": plan_data.get("planName", "Unknown")
+            # Upload to GCS with the new path structure (or under its digest with CAS_ENABLED)
+            with analysis_span(timings, "media_upload"):
+                blob = await gcs_store_upload(storage_filename, mediaFile.file, content_type=media_content_type)
+            storage_path = storage_filename = blob.name
+        unowned_media = {"storage_path": storage_path}
+        with analysis_span(timings, "url_signing"):
+            media_url = await gcs_signed_url(storage_filename)
+        
+        analysis_job = {
+            "userId": userId,
+            "brandId": brandId,
+            "artifact_id": artifact_id,
+            "timestamp": timestamp,
+            "messageIntent": messageIntent,
+            "funnelStage": funnelStage,
+            "channels_list": channels_list,
+            "source": source,
+            "clientId": clientId,
+            "artifacts_data": artifacts_data,
+            "adTitle": adTitle,
+            "media_url": media_url,
+            "storage_path": storage_path,
+            "media_type": media_type,
+            "content_type": content_type,
+            "filename": media_filename,
+            "file_size": media_size,
+            "brand_name": brand_name,
+            "tone_of_voice": tone_of_voice,
+            "brand_colours": brand_colours,
+            "logo_data": logo_data,
+            "quota_reservation": reservation,
+            "analysis_mode": analysis_mode,
+            "bypass_cache": bypassCache,
+            "stage_timings": timings,
+        }
+        unowned_media = analysis_job
+
+        use_async = ANALYSIS_ASYNC_DEFAULT if asyncMode is None else asyncMode
+        if use_async:
+            await enqueue_analysis_job(analysis_job)
+            reservation = unowned_media = None  # the worker now owns them
+            return {
+                "status": "queued",
+                "message": "Analysis queued. Poll the status endpoint for results.",
+                "artifactId": artifact_id,
+                "statusUrl": f"/analysis-status/{artifact_id}",
+                "media_info": {
+                    "mediaUrl": media_url,
+                    "mediaType": content_type,
+                    "mediaCategory": media_type,
+                    "filename": media_filename,
+                    "fileSize": media_size
                 }
             }
-            
-            # Add logo data to analysis if logo was found in brand data
-            if logo_data:
-                analysis_data.update(logo_data)
-            
-            # Save to user_analysis collection with artifact_id as document ID
-            db.collection("user_analysis").document(artifact_id).set(analysis_data)
-            print(f"✅ AI analysis results saved to user_analysis collection with ID: {artifact_id}")
-            print(f"🔍 DEBUG: Saved analysis_data with adTitle: '{analysis_data.get('adTitle', 'NOT_FOUND')}'")
-           
-        except Exception as e:
-            print(f"❌ Analysis failed or could not save results: {str(e)}")
-            # Don't update plan usage if analysis failed
-            # Return error response without updating plan usage
-            raise HTTPException(
-                status_code=500, 
-                detail=f"Analysis failed: {str(e)}. Plan usage was not updated."
-            )
- 
-        # Get plan type from user's plan selection
-        selected_models = list(results.keys())
+
+        reservation = None  # run_analysis_job commits or releases it
+        if not upload_session:
+            unowned_media = None
+            return await run_analysis_job(analysis_job, mediaFile.file)
+        with analysis_span(timings, "media_download"):
+            media_file = await gcs_download_to_spooled(storage_path)
+        unowned_media = None
         try:
-            plan_doc = db.collection("PlanSelectionDetails").document(userId).get()
-            if plan_doc.exists:
-                plan_data = plan_doc.to_dict()
-                plan_type = plan_data.get("planName", "lite").lower().replace("incivus_", "")
-            else:
-                plan_type = "lite"
-        except Exception as e:
-            print(f"Warning: Could not get plan type: {e}")
-            plan_type = "lite"
-       
-        # Create a more user-friendly response
-        response_data = {
-            "status": "success",
-            "message": f"Analysis completed. {len(successful_models)} out of {len(selected_features)} models succeeded.",
-            "artifactId": artifact_id,
-            "analysis_summary": {
-                "total_models_requested": len(selected_features),
-                "successful_models": len(successful_models),
-                "failed_models": len(failed_models),
-                "success_rate": f"{(len(successful_models) / len(selected_features) * 100):.1f}%" if selected_features else "0%"
-            },
-            "ai_analysis_results": results,
-            "plan_type": plan_type,
-            "selected_models": selected_models,
-            "plan_usage": {
-                "adsUsed": new_ads_used,  # This will be the updated value after successful analysis
-                "maxAdsPerMonth": max_ads_per_month,
-                "totalAdsRemaining": new_total_ads,  # This will be the updated value after successful analysis
-                "planName": plan_data.get("planName", "Unknown"),
-                "monthlyLimitReached": new_ads_used >= max_ads_per_month,
-                "adsRemaining": max_ads_per_month - new_ads_used,
-                "analysis_successful": True
-            },
-            "media_info": {
-                "mediaUrl": media_url,
-                "mediaType": mediaFile.content_type,
-                "mediaCategory": media_type,
-                "filename": mediaFile.filename,
-                "fileSize": mediaFile.size
-            },
-            "brand_info": {
-                "brandId": brandId,
-                "brandName": brand_name,
-                "userId": userId,
-                "brandFound": brand_data is not None
-            }
-        }
-        
-        # Add logo information to response if logo was found in brand data
-        if logo_data:
-            response_data["logoInfo"] = {
-                "logo_artifact_id": logo_data["logo_artifact_id"],
-                "logoUrl": logo_data["logoUrl"],
-                "logoStoragePath": logo_data["logoStoragePath"],
-                "logoCategory": logo_data["logoCategory"],
-                "logoFilename": logo_data["logoFilename"],
-                "logoFileSize": logo_data["logoFileSize"],
-                "source": "brand_data"
-            }
-        
-        # Add warnings if any models failed
-        if failed_models:
-            response_data["warnings"] = {
-                "failed_models": failed_models,
-                "message": f"The following models failed: {', '.join(failed_models)}"
-            }
-        
-        return response_data
+            return await run_analysis_job(analysis_job, media_file)
+        finally:
+            media_file.close()
  
+    except HTTPException:
+        await release_ad_quota(reservation)
+        if unowned_media is not None:
+            await release_job_media(unowned_media)
+        if claimed_session:
+            await unclaim_upload_session(uploadSessionId)
+        raise
     except Exception as e:
-        print(f"Error saving analysis details: {str(e)}")
+        await release_ad_quota(reservation)
+        if unowned_media is not None:
+            await release_job_media(unowned_media)
+        if claimed_session:
+            await unclaim_upload_session(uploadSessionId)
+        logger.error("Error saving analysis details: %s", e)
         raise HTTPException(status_code=500, detail=f"Failed to save analysis details: {str(e)}")
  
 
+@app.get("/analysis-status/{artifact_id}")
+async def get_analysis_status(artifact_id: str):
+    """Report the state of a queued analysis: queued, running, done or failed."""
+    try:
+        doc = await fs_get(db.collection("analysis_jobs").document(artifact_id))
+        if not doc.exists:
+            raise HTTPException(status_code=404, detail=f"No analysis job found with ID '{artifact_id}'")
+
+        job = doc.to_dict()
+        if job.get("status") == "done":
+            job["resultUrl"] = f"/get-analysis-by-id/{artifact_id}"
+        return job
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to get analysis status: {str(e)}")
+
+
 @app.post("/uploadBrand")
 async def upload_brand(
     request: Request,
@@ -946,49 +3521,250 @@ async def upload_brand(
 ):
     try:
         form = await request.form()
-        logos = []
+        brand_id = str(uuid.uuid4())
+        sanitized_brand_name = sanitize_brand_name(brandName)
+
+        # Logos are stored in GCS like /branddata-form does, with one media
+        # record per logo
+        pending_logos = []
+        for i in range(logoCount):
+            logo_file: UploadFile = form[f"logo_{i}"]
+            if logo_file.content_type not in BRAND_LOGO_TYPES:
+                raise HTTPException(status_code=400, detail=f"Invalid file type for logo: {logo_file.content_type}")
+            file_ext = os.path.splitext(logo_file.filename)[1]
+            media_id = str(uuid.uuid4())
+            storage_filename = f"{userId}/{sanitized_brand_name}/{brand_id}/logo/{media_id}{file_ext}"
+            pending_logos.append((logo_file, media_id, storage_filename))
+
+        uploaded = await upload_files_parallel([
+            (storage_filename, logo_file.file, logo_file.content_type)
+            for logo_file, _, storage_filename in pending_logos
+        ])
+        media_files = [
+            {
+                "fileId": media_id,
+                "filename": logo_file.filename,
+                "contentType": logo_file.content_type,
+                "fileSize": logo_file.size,
+                "url": media_url,
+                "storagePath": blob.name,
+                "mediaType": "logo",
+                "metadata": "",
+                "uploadTimestamp": datetime.utcnow().isoformat()
+            }
+            for (logo_file, media_id, _), (blob, media_url) in zip(pending_logos, uploaded)
+        ]
+
+        brand_doc = {
+            "userId": userId,
+            "brandName": brandName,
+            "tagline": tagline,
+            "brandDescription": brandDescription,
+            "industryCategory": industryCategory,
+            "colorPalette": [c.strip() for c in colorPalette.split(",") if c.strip()],
+            "keyMessages": [k.strip() for k in keyMessages.split(",") if k.strip()],
+            "brandId": brand_id,
+            "timestamp": datetime.utcnow().isoformat()
+        }
+
+        try:
+            await save_brand_media(brand_id, userId, media_files, brand_doc=brand_doc)
+        except Exception:
+            await rollback_uploads([media["storagePath"] for media in media_files])
+            raise
+        return {"message": "Brand uploaded successfully!", "brand_id": brand_id}
+
+    except Exception as e:
+        return {"error": f"Error uploading brand: {str(e)}"}
+
+
+# ===============================
+# Base64 logo migration
+# ===============================
+# Brands created by the old /uploadBrand carry their logos as base64 strings in
+# a "logos" array. The migration moves each one to GCS, records it in the
+# brand's media subcollection and drops the array, so brand reads stop
+# pulling image bytes.
+
+BRAND_LOGO_TYPES = ['image/jpeg', 'image/jpg', 'image/png', 'image/gif', 'image/webp', 'image/svg+xml']
+LOGO_MIGRATION_PAGE_SIZE = int(os.getenv("LOGO_MIGRATION_PAGE_SIZE", "20"))  # documents can be close to 1 MiB
+
+logo_migration_task: Optional[asyncio.Task] = None
+
+
+def _logo_migration_ref():
+    return db.collection("maintenance_jobs").document("brand-logo-migration")
+
+
+async def migrate_brand_logos(snapshot) -> int:
+    """
+    Move one brand's base64 logos to GCS. Returns the number of logos moved, 0
+    if the brand changed after `snapshot` was read (e.g. an overlapping run
+    migrated it first); a later run picks it up again if it still has logos.
+    """
+    brand = snapshot.to_dict() or {}
+    logos = brand.get("logos") or []
+    sanitized_brand_name = sanitize_brand_name(brand.get("brandName", ""))
+    media_files = []
+    uploads = []
+    for i, logo in enumerate(logos):
+        # Deterministic IDs: a rerun after a crash overwrites the same blobs
+        media_id = str(uuid.uuid5(uuid.NAMESPACE_URL, f"brandData/{snapshot.id}/logos/{i}"))
+        filename = logo.get("logoFilename") or f"logo_{i}"
+        file_ext = os.path.splitext(filename)[1]
+        storage_filename = f"{brand.get('userId')}/{sanitized_brand_name}/{snapshot.id}/logo/{media_id}{file_ext}"
+        data = base64.b64decode(logo.get("logoBase64") or "")
+        uploads.append(gcs_upload_bytes(storage_filename, data, content_type=logo.get("logoContentType")))
+        media_files.append({
+            "fileId": media_id,
+            "filename": filename,
+            "contentType": logo.get("logoContentType"),
+            "fileSize": len(data),
+            "storagePath": storage_filename,
+            "mediaType": "logo",
+            "metadata": "",
+            "uploadTimestamp": brand.get("timestamp") or datetime.utcnow().isoformat()
+        })
+    await asyncio.gather(*uploads)
+
+    batch = db.batch()
+    media_ref = snapshot.reference.collection("media")
+    for media in media_files:
+        batch.set(media_ref.document(media["fileId"]), {**media, "brandId": snapshot.id, "userId": brand.get("userId")})
+    # The logos array is dropped in the same batch, and only if the brand is
+    # unchanged since it was read, so a brand is never counted twice
+    batch.update(snapshot.reference, {
+        "mediaCount": firestore.Increment(len(media_files)),
+        "brandId": snapshot.id,
+        "logos": firestore.DELETE_FIELD,
+        "logosMigratedAt": datetime.utcnow().isoformat() + "Z",
+    }, option=db.write_option(last_update_time=snapshot.update_time))
+
+    try:
+        await fs_commit(batch)
+    except FailedPrecondition:
+        logger.info("Brand %s changed during logo migration, skipping it", snapshot.id)
+        return 0
+    finally:
+        invalidate_brand_cache(snapshot.id)
+    return len(media_files)
+
+
+async def run_logo_migration() -> dict:
+    """
+    Scan brandData in document-ID order and migrate every brand that still has
+    base64 logos. The last scanned ID is checkpointed so an interrupted run
+    resumes where it stopped; a brand that fails is recorded and skipped.
+    """
+    now = datetime.utcnow().isoformat() + "Z"
+    progress_ref = _logo_migration_ref()
+    checkpoint_doc = await fs_get(progress_ref)
+    checkpoint = checkpoint_doc.to_dict() if checkpoint_doc.exists else {}
+    resume = checkpoint.get("status") in ("running", "failed")
+
+    progress = {
+        "status": "running",
+        "brandsScanned": checkpoint.get("brandsScanned", 0) if resume else 0,
+        "brandsMigrated": checkpoint.get("brandsMigrated", 0) if resume else 0,
+        "logosMigrated": checkpoint.get("logosMigrated", 0) if resume else 0,
+        "brandsFailed": checkpoint.get("brandsFailed", 0) if resume else 0,
+        "failedBrandIds": checkpoint.get("failedBrandIds", []) if resume else [],
+        "lastDocId": checkpoint.get("lastDocId") if resume else None,
+        "resumed": resume,
+        "startedAt": checkpoint.get("startedAt", now) if resume else now,
+        "runStartedAt": now,
+    }
+    await fs_set(progress_ref, progress)
+    logger.info("Logo migration %s", 'resumed after ' + str(progress['lastDocId']) if resume else 'started')
+
+    query = db.collection("brandData").order_by(FieldPath.document_id())
+    try:
+        while True:
+            page_query = query.limit(LOGO_MIGRATION_PAGE_SIZE)
+            if progress["lastDocId"]:
+                page_query = page_query.start_after({FieldPath.document_id(): progress["lastDocId"]})
+            page = await fs_stream(page_query)
+            if not page:
+                break
+            for snapshot in page:
+                progress["brandsScanned"] += 1
+                if not (snapshot.to_dict() or {}).get("logos"):
+                    continue
+                try:
+                    moved = await migrate_brand_logos(snapshot)
+                    if moved:
+                        progress["logosMigrated"] += moved
+                        progress["brandsMigrated"] += 1
+                except Exception as e:
+                    logger.warning("Logo migration failed for brand %s: %s", snapshot.id, e)
+                    progress["brandsFailed"] += 1
+                    progress["failedBrandIds"] = (progress["failedBrandIds"] + [snapshot.id])[-50:]
+            progress["lastDocId"] = page[-1].id
+            progress["updatedAt"] = datetime.utcnow().isoformat() + "Z"
+            await fs_set(progress_ref, progress, merge=True)
+            logger.info("Logo migration: %s brands scanned, %s logos moved", progress['brandsScanned'], progress['logosMigrated'])
+            if len(page) < LOGO_MIGRATION_PAGE_SIZE:
+                break
+    except Exception as e:
+        progress["status"] = "failed"
+        progress["error"] = str(e)
+        progress["updatedAt"] = datetime.utcnow().isoformat() + "Z"
+        await fs_set(progress_ref, progress, merge=True)
+        raise
 
-        for i in range(logoCount):
-            logo_file: UploadFile = form[f"logo_{i}"]
-            file_bytes = await logo_file.read()
-            base64_str = base64.b64encode(file_bytes).decode("utf-8")
+    progress["status"] = "done"
+    progress["completedAt"] = datetime.utcnow().isoformat() + "Z"
+    progress.pop("error", None)
+    await fs_set(progress_ref, progress)
+    return progress
 
-            logos.append({
-                "logoFilename": logo_file.filename,
-                "logoContentType": logo_file.content_type,
-                "logoBase64": base64_str
-            })
 
-        brand_doc = {
-            "userId": userId,
-            "brandName": brandName,
-            "tagline": tagline,
-            "brandDescription": brandDescription,
-            "industryCategory": industryCategory,
-            "colorPalette": [c.strip() for c in colorPalette.split(",") if c.strip()],
-            "keyMessages": [k.strip() for k in keyMessages.split(",") if k.strip()],
-            "logos": logos,
-            "timestamp": datetime.utcnow().isoformat()
-        }
+@app.post("/migrate-brand-logos")
+async def migrate_brand_logos_endpoint(background: bool = True):
+    """
+    Move base64 logos from brandData documents into GCS. Runs in the background
+    by default; poll /migrate-brand-logos/status for progress.
+    """
+    global logo_migration_task
+    try:
+        if background:
+            if logo_migration_task is None or logo_migration_task.done():
+                logo_migration_task = asyncio.create_task(run_logo_migration())
+            return {
+                "message": "Logo migration started",
+                "statusUrl": "/migrate-brand-logos/status"
+            }
+
+        progress = await run_logo_migration()
+        return {"message": "Logo migration completed", "progress": progress}
+    except Exception as e:
+        logger.error("Error in logo migration: %s", e)
+        raise HTTPException(status_code=500, detail=f"Failed to migrate brand logos: {str(e)}")
 
-        db.collection("brandData").add(brand_doc)
-        return {"message": "Brand uploaded successfully!"}
 
+@app.get("/migrate-brand-logos/status")
+async def get_logo_migration_status():
+    """Progress of the base64 logo migration."""
+    try:
+        doc = await fs_get(_logo_migration_ref())
+        if not doc.exists:
+            return {"status": "not_started"}
+        progress = doc.to_dict()
+        progress["running"] = logo_migration_task is not None and not logo_migration_task.done()
+        return progress
     except Exception as e:
-        return {"error": f"Error uploading brand: {str(e)}"}
+        raise HTTPException(status_code=500, detail=f"Failed to get logo migration status: {str(e)}")
     
 
 @app.post("/upload-images/")
 async def upload_images(files: list[UploadFile] = File(...)):
-    uploaded_urls = []
- 
-    for file in files:
-        contents = await file.read()
-        blob_name = f"images/{uuid.uuid4()}_{file.filename}"
-        blob = bucket.blob(blob_name)
-        blob.upload_from_string(contents, content_type=file.content_type)
-       # blob.make_public()  # Optional: make image accessible via URL
-        uploaded_urls.append(blob.public_url)
+    uploads = [
+        (f"images/{uuid.uuid4()}_{file.filename}", file.file, file.content_type)
+        for file in files
+    ]
+    uploaded = await upload_files_parallel(uploads, sign=False)
+    # blob.make_public()  # Optional: make image accessible via URL
+    uploaded_urls = [blob.public_url for blob, _ in uploaded]
  
     return {"uploaded_urls": uploaded_urls}
 
@@ -996,20 +3772,24 @@ async def upload_images(files: list[UploadFile] = File(...)):
 async def get_brand_data(brand_id: str):
     try:
         # Fetch document by ID from Firestore
-        doc_ref = db.collection("brandData").document(brand_id)
-        doc = doc_ref.get()
-        
-        if not doc.exists:
-            raise HTTPException(status_code=404, detail="Brand data not found")
-        
-        brand_data = doc.to_dict()
+        fill = brand_cache.begin_fill(brand_id)
+        try:
+            doc_ref = db.collection("brandData").document(brand_id)
+            doc = await fs_get(doc_ref)
+            
+            if not doc.exists:
+                raise HTTPException(status_code=404, detail="Brand data not found")
+            
+            brand_data = doc.to_dict()
+            brand_data["mediaFiles"] = await load_brand_media(brand_id, brand_data)
+        except Exception:
+            brand_cache.cancel_fill(brand_id, fill)
+            raise
+        # The full read is a superset of the brand cache record, so refresh it for free
+        brand_cache.put(brand_id, _brand_summary(brand_data, brand_data["mediaFiles"]), fill=fill)
         
-        # Generate fresh signed URLs for media files
-        if "mediaFiles" in brand_data:
-            for media_file in brand_data["mediaFiles"]:
-                if "storagePath" in media_file:
-                    blob = bucket.blob(media_file["storagePath"])
-                    media_file["url"] = blob.generate_signed_url(expiration=3600 * 24 * 7)
+        # Attach signed URLs for media files (cached per storagePath)
+        await sign_media_files(brand_data["mediaFiles"])
         
         return brand_data
         
@@ -1019,22 +3799,24 @@ async def get_brand_data(brand_id: str):
 @app.get("/get-user-brands/{user_id}")
 async def get_user_brands(user_id: str):
     try:
-        # Fetch all brands for a specific user
-        docs = db.collection("brandData").where("userId", "==", user_id).stream()
+        # Fetch all brands for a specific user, and all their media in one query
+        docs, media_by_brand = await asyncio.gather(
+            fs_stream(db.collection("brandData").where("userId", "==", user_id)),
+            load_user_brand_media(user_id),
+        )
         
         brands = []
         for doc in docs:
             brand_data = doc.to_dict()
             brand_data["brandId"] = doc.id
-            
-            # Generate fresh signed URLs for media files
-            if "mediaFiles" in brand_data:
-                for media_file in brand_data["mediaFiles"]:
-                    if "storagePath" in media_file:
-                        blob = bucket.blob(media_file["storagePath"])
-                        media_file["url"] = blob.generate_signed_url(expiration=3600 * 24 * 7)
-            
+            brand_data["mediaFiles"] = sorted(
+                brand_data.get("mediaFiles", []) + media_by_brand.get(doc.id, []),
+                key=_media_sort_key,
+            )
             brands.append(brand_data)
+
+        # Attach signed URLs for media files (cached per storagePath)
+        await sign_media_files([media for brand in brands for media in brand["mediaFiles"]])
         
         return {"brands": brands, "count": len(brands)}
         
@@ -1044,45 +3826,28 @@ async def get_user_brands(user_id: str):
 @app.delete("/delete-media-file/{brand_id}/{file_id}")
 async def delete_media_file(brand_id: str, file_id: str):
     try:
-        # Get brand data
         doc_ref = db.collection("brandData").document(brand_id)
-        doc = doc_ref.get()
+        doc = await fs_get(doc_ref, field_paths=["mediaCount"])
         
         if not doc.exists:
             raise HTTPException(status_code=404, detail="Brand data not found")
         
-        brand_data = doc.to_dict()
-        media_files = brand_data.get("mediaFiles", [])
-        
-        # Find and remove the file
-        file_to_delete = None
-        updated_media_files = []
-        
-        for media_file in media_files:
-            if media_file.get("fileId") == file_id:
-                file_to_delete = media_file
-            else:
-                updated_media_files.append(media_file)
+        # Remove the record and decrement mediaCount atomically
+        file_to_delete = await delete_brand_media(brand_id, file_id)
         
         if not file_to_delete:
             raise HTTPException(status_code=404, detail="Media file not found")
         
-        # Delete from blob storage
+        # Delete from blob storage (shared content-addressed blobs only go with their last reference)
         if "storagePath" in file_to_delete:
-            blob = bucket.blob(file_to_delete["storagePath"])
-            if blob.exists():
-                blob.delete()
-        
-        # Update Firestore
-        brand_data["mediaFiles"] = updated_media_files
-        brand_data["mediaCount"] = len(updated_media_files)
+            await gcs_release(file_to_delete["storagePath"])
         
-        doc_ref.set(brand_data)
+        doc = await fs_get(doc_ref, field_paths=["mediaCount"])
         
         return {
             "message": "Media file deleted successfully",
             "deleted_file": file_to_delete,
-            "remaining_files": len(updated_media_files)
+            "remaining_files": (doc.to_dict() or {}).get("mediaCount", 0)
         }
         
     except Exception as e:
@@ -1096,10 +3861,156 @@ PLAN_CONFIG = {
     "Incivus_Pro": {"duration_days": 365, "total_ads": 132, "max_ads_per_month": 11, "price": 400}
 }
 
+# Plan hierarchy for upgrades
+PLAN_HIERARCHY = {
+    "Incivus_Lite": 1,
+    "Incivus_Plus": 2,
+    "Incivus_Pro": 3
+}
+
+
+def plan_change_updates(data: dict, plan_name: str, action: str, selected_features: list,
+                        total_ads: Optional[int], current_date: datetime) -> dict:
+    """
+    Top-level plan document fields changed by a topup or upgrade of the plan in
+    `data`. Only these are written back, in the transaction that read `data`.
+    Raises HTTPException if the change is not allowed.
+    """
+    plan_info = PLAN_CONFIG[plan_name]
+    current_plan_name = data.get("planName", "")
+    updates = {}
+
+    logger.debug("Plan change request: Plan: %s, Action: %s", plan_name, action)
+    logger.debug("Current plan: %s, Current date: %s", current_plan_name, current_date)
+
+    # ===== Topup logic =====
+    if action == "topup":
+        # Check if this is the same plan
+        if plan_name != current_plan_name:
+            raise HTTPException(status_code=400, detail=f"Topup can only be done for the same plan. Current plan: {current_plan_name}, Requested plan: {plan_name}")
+        
+        # Get current plan end date
+        current_end = datetime.fromisoformat(data["subscriptionEndDate"].replace("Z", ""))
+        
+        # Check if current plan is still active
+        if current_date > current_end:
+            # Plan has expired, start new plan from today
+            new_start = current_date
+            new_end = new_start + timedelta(days=plan_info["duration_days"])
+            logger.info("Plan expired, starting new plan from today: %s to %s", new_start, new_end)
+        else:
+            # Plan is still active, new plan starts from day after current plan expires
+            new_start = current_end + timedelta(days=1)
+            new_end = new_start + timedelta(days=plan_info["duration_days"])
+            logger.info("Same plan topup: new plan starts from %s to %s", new_start, new_end)
+        
+        # Update plan data
+        updates["subscriptionStartDate"] = new_start.isoformat() + "Z"
+        updates["subscriptionEndDate"] = new_end.isoformat() + "Z"
+        updates["validityDays"] = plan_info["duration_days"]
+        # Use custom total_ads if provided, otherwise fall back to PLAN_CONFIG
+        topup_ads = total_ads if total_ads is not None else plan_info["total_ads"]
+        
+        # Get CURRENT remaining ads (this reflects any ads already used)
+        current_remaining_ads = data.get("totalAds", 0)
+        current_ads_used = monthly_ads_used(data)
+        
+        logger.debug("Topup calculation - Current remaining: %s, Used: %s, Adding: %s", current_remaining_ads, current_ads_used, topup_ads)
+        
+        # Check if current plan has expired
+        if current_date > current_end:
+            # Plan has expired - Start fresh with new ads only
+            updates["totalAds"] = topup_ads
+            logger.debug("Topup (expired plan) - Fresh start: %s ads (previous plan expired)", topup_ads)
+            # Reset monthly usage for new billing cycle
+            updates["adsUsed"] = 0
+            updates["usage"] = {**(data.get("usage") or {}), current_usage_period(current_date): 0}
+            logger.debug("Topup (expired plan) - Reset monthly usage to 0 for new cycle")
+        else:
+            # Plan is still active - ADD new ads to remaining total
+            updates["totalAds"] = current_remaining_ads + topup_ads
+            logger.debug("Topup (active plan) - New total: %s (remaining %s + topup %s)", updates['totalAds'], current_remaining_ads, topup_ads)
+            # PRESERVE monthly usage within same billing cycle
+            logger.debug("Topup (active plan) - Preserving monthly usage: %s ads used", current_ads_used)
+        updates["max_ads_per_month"] = plan_info["max_ads_per_month"]  # FIX: OVERWRITE for topup (same plan, same monthly limit)
+        updates["totalPrice"] = data.get("totalPrice", 0) + plan_info.get("price", 100)  # Add price for topup
+        # Don't update lastUsageDate during topup - it should only be updated when ads are actually used
+        updates["updatedAt"] = current_date.isoformat() + "Z"
+        
+        # Update selectedFeatures if provided
+        if selected_features:
+            updates["selectedFeatures"] = selected_features
+            logger.info("Updated selectedFeatures: %s", selected_features)
+        else:
+            logger.warning("No features provided for topup, keeping existing features: %s", data.get('selectedFeatures', []))
+
+    # ===== Upgrade logic =====
+    else:
+        # Check if this is a valid upgrade (higher plan)
+        current_plan_level = PLAN_HIERARCHY.get(current_plan_name, 0)
+        new_plan_level = PLAN_HIERARCHY.get(plan_name, 0)
+        logger.debug("Plan levels - Current: %s, New: %s", current_plan_level, new_plan_level)
+        
+        if new_plan_level <= current_plan_level:
+            raise HTTPException(status_code=400, detail=f"Upgrade can only be done to a higher plan. Current plan: {current_plan_name} (level {current_plan_level}), Requested plan: {plan_name} (level {new_plan_level})")
+        
+        # Calculate remaining ads from current plan
+        remaining_ads = data.get("totalAds", 0)
+        
+        # New plan starts immediately from today
+        new_start = current_date
+        new_end = new_start + timedelta(days=plan_info["duration_days"])
+        logger.info("Upgrade plan starts from %s to %s", new_start.strftime('%Y-%m-%d'), new_end.strftime('%Y-%m-%d'))
+        
+        # Combine max ads per month from current subscription (actual value) and upgrading plan
+        current_max_ads_per_month = data.get("max_ads_per_month", 0)  # Use actual current value, not base plan
+        new_plan_max_ads_per_month = plan_info["max_ads_per_month"]
+        combined_max_ads_per_month = current_max_ads_per_month + new_plan_max_ads_per_month
+        logger.debug("Monthly limits - Current subscription: %s, New plan: %s, Combined: %s", current_max_ads_per_month, new_plan_max_ads_per_month, combined_max_ads_per_month)
+
+        # Use custom total_ads if provided, otherwise fall back to PLAN_CONFIG
+        new_plan_ads = total_ads if total_ads is not None else plan_info["total_ads"]
+        logger.debug("Upgrade ads calculation - Custom ads: %s, Config ads: %s, Using: %s", total_ads, plan_info['total_ads'], new_plan_ads)
+        
+        # Update plan data for upgrade
+        updates["planName"] = plan_name
+        updates["subscriptionStartDate"] = new_start.isoformat() + "Z"
+        updates["subscriptionEndDate"] = new_end.isoformat() + "Z"
+        updates["validityDays"] = plan_info["duration_days"]
+        updates["totalAds"] = remaining_ads + new_plan_ads  # Carry forward remaining + user-selected ads
+        updates["max_ads_per_month"] = combined_max_ads_per_month  # Combined monthly limit
+        updates["totalPrice"] = data.get("totalPrice", 0) + plan_info.get("price", 100)  # Add upgrade price
+        # PRESERVE current monthly usage during upgrade - don't reset ads used within the current billing cycle  
+        # Don't update lastUsageDate during upgrade - it should only be updated when ads are actually used
+        updates["updatedAt"] = current_date.isoformat() + "Z"
+        
+        # For upgrades, automatically include all features available in the new plan
+        all_features = ["brand_compliance", "content_analysis", "metaphor_analysis", "channel_compliance"]
+        updates["selectedFeatures"] = all_features
+        logger.info("Auto-assigned all features for upgrade: %s", all_features)
+
+    return updates
+
+
+@fs_transactional
+def _change_plan_in_transaction(transaction, plan_ref, profile_ref, plan_name: str, action: str,
+                                selected_features: list, total_ads: Optional[int]) -> tuple:
+    """Apply a topup/upgrade and mirror it to the profile. Returns (previous plan name, updated plan data)."""
+    snapshot = tx_get(transaction, plan_ref)
+    if not snapshot.exists:
+        raise HTTPException(status_code=404, detail="User plan not found")
+    data = snapshot.to_dict()
+    updates = plan_change_updates(data, plan_name, action, selected_features, total_ads, datetime.utcnow())
+    transaction.update(plan_ref, updates)
+
+    updated = {**data, **updates}
+    nested, paths = _merge_write(profile_subscription_updates(updated, updated["updatedAt"]))
+    transaction.set(profile_ref, nested, merge=paths)
+    return data.get("planName", ""), updated
 
 
 @app.post("/update_plan")
-def update_plan(
+async def update_plan(
     user_id: str = Form(..., description="User ID of the plan owner"),
     plan_name: str = Form(..., description="Plan name: Incivus_Lite / Incivus_Plus / Incivus_Pro"),
     action: str = Form(..., description="Action: topup or upgrade"),
@@ -1128,200 +4039,49 @@ def update_plan(
         if not plan_info:
             raise HTTPException(status_code=400, detail="Invalid plan name")
 
-        # Define plan hierarchy for upgrades
-        PLAN_HIERARCHY = {
-            "Incivus_Lite": 1,
-            "Incivus_Plus": 2,
-            "Incivus_Pro": 3
-        }
+        if action not in ("topup", "upgrade"):
+            raise HTTPException(status_code=400, detail="Invalid action type. Use 'topup' or 'upgrade'")
 
-        # Get Firestore document
-        user_ref = db.collection("PlanSelectionDetails").document(user_id)
-        doc = user_ref.get()
-        if not doc.exists:
-            raise HTTPException(status_code=404, detail="User plan not found")
+        # Parse and validate features for topup
+        selected_features = []
+        if action == "topup" and features:
+            try:
+                # Handle different input formats (JSON array, comma-separated, single value)
+                if features.startswith('[') and features.endswith(']'):
+                    # JSON array format
+                    selected_features = json.loads(features)
+                elif ',' in features:
+                    # Comma-separated format
+                    selected_features = [feature.strip() for feature in features.split(',') if feature.strip()]
+                else:
+                    # Single value format
+                    selected_features = [features.strip()] if features.strip() else []
+                
+                logger.debug("Parsed features for topup: %s", selected_features)
+            except json.JSONDecodeError as e:
+                logger.warning("Error parsing features JSON: %s", e)
+                selected_features = []
 
-        data = doc.to_dict()
-        current_plan_name = data.get("planName", "")
-        current_date = datetime.utcnow()
-        
-        print(f"🔍 Topup request: User {user_id}, Plan: {plan_name}, Action: {action}")
-        print(f"🔍 Current plan: {current_plan_name}, Current date: {current_date}")
+        # Read, recompute and write the plan in one transaction, so a quota
+        # reservation committed meanwhile is not overwritten with stale counts
+        plan_ref = db.collection("PlanSelectionDetails").document(user_id)
+        profile_ref = db.collection("userProfileDetails").document(user_id)
+        try:
+            current_plan_name, data = await run_io(
+                lambda: _change_plan_in_transaction(
+                    db.transaction(), plan_ref, profile_ref, plan_name, action, selected_features, total_ads
+                )
+            )
+        finally:
+            invalidate_plan_cache(user_id)
 
-        # ===== Topup logic =====
         if action == "topup":
-            # Check if this is the same plan
-            if plan_name != current_plan_name:
-                raise HTTPException(status_code=400, detail=f"Topup can only be done for the same plan. Current plan: {current_plan_name}, Requested plan: {plan_name}")
-            
-            # Parse and validate features for topup
-            selected_features = []
-            if features:
-                try:
-                    # Handle different input formats (JSON array, comma-separated, single value)
-                    if features.startswith('[') and features.endswith(']'):
-                        # JSON array format
-                        selected_features = json.loads(features)
-                    elif ',' in features:
-                        # Comma-separated format
-                        selected_features = [feature.strip() for feature in features.split(',') if feature.strip()]
-                    else:
-                        # Single value format
-                        selected_features = [features.strip()] if features.strip() else []
-                    
-                    print(f"🔍 Parsed features for topup: {selected_features}")
-                except json.JSONDecodeError as e:
-                    print(f"⚠️ Error parsing features JSON: {e}")
-                    selected_features = []
-            
-            # Get current plan end date
-            current_end = datetime.fromisoformat(data["subscriptionEndDate"].replace("Z", ""))
-            
-            # Check if current plan is still active
-            if current_date > current_end:
-                # Plan has expired, start new plan from today
-                new_start = current_date
-                new_end = new_start + timedelta(days=plan_info["duration_days"])
-                print(f"✅ Plan expired, starting new plan from today: {new_start} to {new_end}")
-            else:
-                # Plan is still active, new plan starts from day after current plan expires
-                new_start = current_end + timedelta(days=1)
-                new_end = new_start + timedelta(days=plan_info["duration_days"])
-                print(f"✅ Same plan topup: new plan starts from {new_start} to {new_end}")
-            
-            # Update plan data
-            data["subscriptionStartDate"] = new_start.isoformat() + "Z"
-            data["subscriptionEndDate"] = new_end.isoformat() + "Z"
-            data["validityDays"] = plan_info["duration_days"]
-            # Use custom total_ads if provided, otherwise fall back to PLAN_CONFIG
-            topup_ads = total_ads if total_ads is not None else plan_info["total_ads"]
-            
-            # Get CURRENT remaining ads (this reflects any ads already used)
-            current_remaining_ads = data.get("totalAds", 0)
-            current_ads_used = data.get("adsUsed", 0)
-            
-            print(f"🔍 Topup calculation - Current remaining: {current_remaining_ads}, Used: {current_ads_used}, Adding: {topup_ads}")
-            
-            # Check if current plan has expired
-            if current_date > current_end:
-                # Plan has expired - Start fresh with new ads only
-                data["totalAds"] = topup_ads
-                print(f"🔍 Topup (expired plan) - Fresh start: {topup_ads} ads (previous plan expired)")
-                # Reset monthly usage for new billing cycle
-                data["adsUsed"] = 0
-                print(f"🔍 Topup (expired plan) - Reset monthly usage to 0 for new cycle")
-            else:
-                # Plan is still active - ADD new ads to remaining total
-                data["totalAds"] = current_remaining_ads + topup_ads
-                print(f"🔍 Topup (active plan) - New total: {data['totalAds']} (remaining {current_remaining_ads} + topup {topup_ads})")
-                # PRESERVE monthly usage within same billing cycle
-                print(f"🔍 Topup (active plan) - Preserving monthly usage: {current_ads_used} ads used")
-            data["max_ads_per_month"] = plan_info["max_ads_per_month"]  # FIX: OVERWRITE for topup (same plan, same monthly limit)
-            data["totalPrice"] = data.get("totalPrice", 0) + plan_info.get("price", 100)  # Add price for topup
-            # Don't update lastUsageDate during topup - it should only be updated when ads are actually used
-            # data["lastUsageDate"] = new_start.isoformat() + "Z"
-            data["updatedAt"] = current_date.isoformat() + "Z"
-            
-            # Update selectedFeatures if provided
-            if selected_features:
-                data["selectedFeatures"] = selected_features
-                print(f"✅ Updated selectedFeatures: {selected_features}")
-            else:
-                print(f"⚠️ No features provided for topup, keeping existing features: {data.get('selectedFeatures', [])}")
-            
-            print(f"✅ Same plan topup completed: {plan_name}")
-            print(f"📅 New period: {new_start.strftime('%Y-%m-%d')} to {new_end.strftime('%Y-%m-%d')}")
-            print(f"📊 Total ads: {data['totalAds']} (added {topup_ads} user-selected ads), Monthly limit: {data['max_ads_per_month']}")
-
-        # ===== Upgrade logic =====
-        elif action == "upgrade":
-            print(f"🔍 Upgrade request: User {user_id}, Current Plan: {current_plan_name}, New Plan: {plan_name}")
-            
-            # Check if this is a valid upgrade (higher plan)
-            current_plan_level = PLAN_HIERARCHY.get(current_plan_name, 0)
-            new_plan_level = PLAN_HIERARCHY.get(plan_name, 0)
-            print(f"🔍 Plan levels - Current: {current_plan_level}, New: {new_plan_level}")
-            
-            if new_plan_level <= current_plan_level:
-                raise HTTPException(status_code=400, detail=f"Upgrade can only be done to a higher plan. Current plan: {current_plan_name} (level {current_plan_level}), Requested plan: {plan_name} (level {new_plan_level})")
-            
-            # Calculate remaining ads from current plan
-            remaining_ads = data.get("totalAds", 0)
-            current_monthly_limit = data.get("max_ads_per_month", 0)
-            print(f"🔍 Current subscription - Remaining ads: {remaining_ads}, Monthly limit: {current_monthly_limit}")
-            
-            # New plan starts immediately from today
-            new_start = current_date
-            new_end = new_start + timedelta(days=plan_info["duration_days"])
-            print(f"✅ Upgrade plan starts from {new_start.strftime('%Y-%m-%d')} to {new_end.strftime('%Y-%m-%d')}")
-            
-            # Combine max ads per month from current subscription (actual value) and upgrading plan
-            current_max_ads_per_month = data.get("max_ads_per_month", 0)  # Use actual current value, not base plan
-            new_plan_max_ads_per_month = plan_info["max_ads_per_month"]
-            combined_max_ads_per_month = current_max_ads_per_month + new_plan_max_ads_per_month
-            print(f"🔍 DEBUG - Raw data from database: {data}")
-            print(f"🔍 DEBUG - Current max_ads_per_month from data: {current_max_ads_per_month}")
-            print(f"🔍 DEBUG - New plan max_ads_per_month: {new_plan_max_ads_per_month}")
-            print(f"🔍 DEBUG - Combined calculation: {current_max_ads_per_month} + {new_plan_max_ads_per_month} = {combined_max_ads_per_month}")
-            print(f"🔍 Monthly limits - Current subscription: {current_max_ads_per_month}, New plan: {new_plan_max_ads_per_month}, Combined: {combined_max_ads_per_month}")
-
-            # Use custom total_ads if provided, otherwise fall back to PLAN_CONFIG
-            new_plan_ads = total_ads if total_ads is not None else plan_info["total_ads"]
-            print(f"🔍 Upgrade ads calculation - Custom ads: {total_ads}, Config ads: {plan_info['total_ads']}, Using: {new_plan_ads}")
-            
-            # Update plan data for upgrade
-            data["planName"] = plan_name
-            data["subscriptionStartDate"] = new_start.isoformat() + "Z"
-            data["subscriptionEndDate"] = new_end.isoformat() + "Z"
-            data["validityDays"] = plan_info["duration_days"]
-            data["totalAds"] = remaining_ads + new_plan_ads  # Carry forward remaining + user-selected ads
-            data["max_ads_per_month"] = combined_max_ads_per_month  # Combined monthly limit
-            data["totalPrice"] = data.get("totalPrice", 0) + plan_info.get("price", 100)  # Add upgrade price
-            # PRESERVE current monthly usage during upgrade - don't reset ads used within the current billing cycle  
-            current_ads_used = data.get("adsUsed", 0)
-            print(f"🔍 Preserving current monthly usage during upgrade: {current_ads_used} ads used")
-            # Don't update lastUsageDate during upgrade - it should only be updated when ads are actually used
-            # data["lastUsageDate"] = new_start.isoformat() + "Z"
-            data["updatedAt"] = current_date.isoformat() + "Z"
-            
-            # For upgrades, automatically include all features available in the new plan
-            all_features = ["brand_compliance", "content_analysis", "metaphor_analysis", "channel_compliance"]
-            data["selectedFeatures"] = all_features
-            print(f"✅ Auto-assigned all features for upgrade: {all_features}")
-            
-            print(f"✅ Plan upgrade completed: {current_plan_name} → {plan_name}")
-            print(f"📅 New period: {new_start.strftime('%Y-%m-%d')} to {new_end.strftime('%Y-%m-%d')}")
-            print(f"📊 Total ads: {data['totalAds']} (carried forward: {remaining_ads} + user-selected: {new_plan_ads})")
-            print(f"📊 Monthly limit: {data['max_ads_per_month']} (combined: {current_max_ads_per_month} + {new_plan_max_ads_per_month})")
-
+            logger.info("Same plan topup completed: %s", plan_name)
         else:
-            raise HTTPException(status_code=400, detail="Invalid action type. Use 'topup' or 'upgrade'")
-
-        # Save updated data
-        user_ref.update(data)
-        
-        # SYNC: Also update the user profile subscription data so frontend shows correct data
-        try:
-            profile_ref = db.collection("userProfileDetails").document(user_id)
-            subscription_update = {
-                "subscription.planType": data["planName"].replace("Incivus_", "").lower(),
-                "subscription.planName": data["planName"],
-                "subscription.adQuota": data["totalAds"],
-                "subscription.adsUsed": data.get("adsUsed", 0),
-                "subscription.max_ads_per_month": data.get("max_ads_per_month", 0),
-                "subscription.totalPrice": data.get("totalPrice", 0),  # FIX: Copy total payment amount during topup/upgrade
-                "subscription.subscriptionStartDate": data["subscriptionStartDate"],
-                "subscription.subscriptionEndDate": data["subscriptionEndDate"],
-                "subscription.validityDays": data["validityDays"],
-                "subscription.selectedFeatures": data.get("selectedFeatures", []),
-                "subscription.updatedAt": data["updatedAt"],
-                "updatedAt": data["updatedAt"]
-            }
-            profile_ref.update(subscription_update)
-            print(f"✅ User profile subscription synced after {action}: {data.get('adsUsed', 0)} ads used, {data['totalAds']} total")
-        except Exception as e:
-            print(f"⚠️ Warning: Could not sync subscription data to user profile after {action}: {e}")
-            # Don't fail the request if profile sync fails
+            logger.info("Plan upgrade completed: %s → %s", current_plan_name, plan_name)
+        logger.info("New period: %s to %s", data["subscriptionStartDate"][:10], data["subscriptionEndDate"][:10])
+        logger.info("Total ads: %s, Monthly limit: %s", data['totalAds'], data['max_ads_per_month'])
+        logger.info("User profile subscription synced after %s: %s ads used, %s total", action, monthly_ads_used(data), data['totalAds'])
         
         # Prepare response data
         response_data = {
@@ -1333,7 +4093,7 @@ def update_plan(
                 "subscriptionEndDate": data["subscriptionEndDate"],
                 "totalAds": data["totalAds"],
                 "max_ads_per_month": data["max_ads_per_month"],
-                "adsUsed": data["adsUsed"],
+                "adsUsed": monthly_ads_used(data),
                 "validityDays": data["validityDays"],
                 "selectedFeatures": data.get("selectedFeatures", [])
             },
@@ -1351,7 +4111,7 @@ def update_plan(
     except HTTPException:
         raise
     except Exception as e:
-        print(f"❌ Error in update_plan: {str(e)}")
+        logger.error("Error in update_plan: %s", e)
         raise HTTPException(status_code=500, detail=f"Failed to update plan: {str(e)}")
 
 
@@ -1360,11 +4120,14 @@ async def sync_subscription_data(user_id: str):
     """
     Manually sync subscription data from PlanSelectionDetails to userProfileDetails
     This is useful for fixing data inconsistency issues
+
+    Plan writes now update both documents in one batch, so this is only needed
+    for profiles written before that.
     """
     try:
         # Get data from PlanSelectionDetails (source of truth for backend)
         plan_ref = db.collection("PlanSelectionDetails").document(user_id)
-        plan_doc = plan_ref.get()
+        plan_doc = await fs_get(plan_ref)
         
         if not plan_doc.exists:
             raise HTTPException(status_code=404, detail="User plan not found")
@@ -1372,31 +4135,17 @@ async def sync_subscription_data(user_id: str):
         plan_data = plan_doc.to_dict()
         
         # Update userProfileDetails with current plan data
-        profile_ref = db.collection("userProfileDetails").document(user_id)
-        subscription_update = {
-            "subscription.planType": plan_data["planName"].replace("Incivus_", "").lower(),
-            "subscription.planName": plan_data["planName"],
-            "subscription.adQuota": plan_data["totalAds"],
-            "subscription.adsUsed": plan_data.get("adsUsed", 0),
-            "subscription.max_ads_per_month": plan_data.get("max_ads_per_month", 0),
-            "subscription.totalPrice": plan_data.get("totalPrice", 0),  # FIX: Copy total payment amount
-            "subscription.subscriptionStartDate": plan_data["subscriptionStartDate"],
-            "subscription.subscriptionEndDate": plan_data["subscriptionEndDate"],
-            "subscription.validityDays": plan_data["validityDays"],
-            "subscription.selectedFeatures": plan_data.get("selectedFeatures", []),
-            "subscription.paymentStatus": plan_data.get("paymentStatus", "completed"),
-            "subscription.updatedAt": datetime.utcnow().isoformat() + "Z",
-            "updatedAt": datetime.utcnow().isoformat() + "Z"
-        }
+        subscription_update = profile_subscription_updates(plan_data, datetime.utcnow().isoformat() + "Z")
+        subscription_update["subscription.paymentStatus"] = plan_data.get("paymentStatus", "completed")
         
-        profile_ref.update(subscription_update)
+        await write_plan_and_profile(user_id, profile_updates=subscription_update)
         
         return {
             "status": "success",
             "message": "Subscription data synced successfully",
             "synced_data": {
                 "planName": plan_data["planName"],
-                "adsUsed": plan_data.get("adsUsed", 0),
+                "adsUsed": monthly_ads_used(plan_data),
                 "totalAds": plan_data["totalAds"],
                 "max_ads_per_month": plan_data.get("max_ads_per_month", 0)
             }
@@ -1412,13 +4161,11 @@ async def get_plan_status(user_id: str):
     """
     try:
         # Get user's plan document
-        user_ref = db.collection("PlanSelectionDetails").document(user_id)
-        doc = user_ref.get()
+        data = await get_plan_data(user_id)
         
-        if not doc.exists:
+        if not data:
             raise HTTPException(status_code=404, detail="User plan not found")
         
-        data = doc.to_dict()
         current_date = datetime.utcnow()
         
         # Parse dates
@@ -1453,7 +4200,8 @@ async def get_plan_status(user_id: str):
                 "days_remaining": days_remaining,
                 "days_elapsed": days_elapsed,
                 "total_ads": data.get("totalAds", 0),
-                "ads_used": data.get("adsUsed", 0),
+                "ads_used": monthly_ads_used(data),
+                "usage_period": current_usage_period(current_date),
                 "max_ads_per_month": data.get("max_ads_per_month", 0),
                 "last_usage_date": data.get("lastUsageDate", "")
             },
@@ -1463,7 +4211,7 @@ async def get_plan_status(user_id: str):
     except HTTPException:
         raise
     except Exception as e:
-        print(f"❌ Error getting plan status: {str(e)}")
+        logger.error("Error getting plan status: %s", e)
         raise HTTPException(status_code=500, detail=f"Failed to get plan status: {str(e)}")
 
 
@@ -1478,7 +4226,7 @@ async def upload_additional_media(
     try:
         # Validate brand exists
         doc_ref = db.collection("brandData").document(brand_id)
-        doc = doc_ref.get()
+        doc = await fs_get(doc_ref, field_paths=["userId"])
         
         if not doc.exists:
             raise HTTPException(status_code=404, detail="Brand data not found")
@@ -1491,6 +4239,7 @@ async def upload_additional_media(
         MAX_FILE_SIZE = 50 * 1024 * 1024  # 50MB limit
         
         new_media_files = []
+        pending_files = []
         
         for file in files:
             # Validate file type based on mediaType
@@ -1508,144 +4257,248 @@ async def upload_additional_media(
             file_ext = os.path.splitext(file.filename)[1]
             media_id = str(uuid.uuid4())
             storage_filename = f"brands/{brand_id}/{mediaType}s/{media_id}{file_ext}"
-            
-            # Upload to GCS
-            blob = bucket.blob(storage_filename)
-            blob.upload_from_file(file.file, content_type=file.content_type)
-            #media_url = blob.generate_signed_url(expiration=3600 * 24 * 7)
-            media_url = blob.generate_signed_url(
-                version="v4",                # use v4 signed URLs
-                expiration=timedelta(days=7), # 7 days from now
-                method="GET"                  # HTTP method allowed
-            )
-            
+            pending_files.append((file, media_id, storage_filename))
+
+        # Upload to GCS in parallel; a failed upload rolls back the others
+        uploaded = await upload_files_parallel([
+            (storage_filename, file.file, file.content_type)
+            for file, _, storage_filename in pending_files
+        ])
+        for (file, media_id, _), (blob, media_url) in zip(pending_files, uploaded):
             new_media_files.append({
                 "fileId": media_id,
                 "filename": file.filename,
                 "contentType": file.content_type,
                 "fileSize": file.size,
                 "url": media_url,
-                "storagePath": storage_filename,
+                "storagePath": blob.name,
                 "mediaType": mediaType,
                 "metadata": metadata or "",
                 "uploadTimestamp": datetime.utcnow().isoformat()
             })
         
-        # Update brand data
-        existing_media = brand_data.get("mediaFiles", [])
-        updated_media = existing_media + new_media_files
-        
-        brand_data["mediaFiles"] = updated_media
-        brand_data["mediaCount"] = len(updated_media)
+        # Add one media record per file and bump mediaCount
+        try:
+            await save_brand_media(brand_id, brand_data.get("userId"), new_media_files)
+        except Exception:
+            await rollback_uploads([media["storagePath"] for media in new_media_files])
+            raise
         
-        doc_ref.set(brand_data)
+        doc = await fs_get(doc_ref, field_paths=["mediaCount"])
         
         return {
             "message": f"Additional {mediaType} files uploaded successfully",
             "brand_id": brand_id,
             "uploaded_files": new_media_files,
-            "total_media_count": len(updated_media)
+            "total_media_count": (doc.to_dict() or {}).get("mediaCount", 0)
         }
         
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
+# ===============================
+# Plan feature projection
+# ===============================
+# A plan's selectedFeatures decide which comprehensive-analysis result sections
+# a user sees. Each section's payload is stored once at write time as its own
+# field (feature_results.<section>), next to the rest of ai_analysis_results,
+# so a read drops feature_results and just puts back the sections its plan
+# unlocks. Every other field of the record is returned as stored. The
+# plan -> sections mapping is memoized, and both analysis read endpoints go
+# through project_analysis so they agree.
+# Analyses saved before projectionVersion was recorded carry their sections
+# inside ai_analysis_results and are filtered on read.
+
+ANALYSIS_PROJECTION_VERSION = 1
+
+FEATURE_RESULT_SECTIONS = {
+    "brand_compliance": "brand_compliance",
+    "channel_compliance": "channel_compliance",
+    "content_analysis": "content_analysis",
+    "metaphor_analysis": "metaphor_analysis",
+    "messaging_intent": "content_analysis",  # messaging intent maps to content analysis
+    "funnel_compatibility": "content_analysis",  # funnel compatibility maps to content analysis
+    "resonance_index": "metaphor_analysis",  # resonance index maps to metaphor analysis
+}
+
+
+@functools.lru_cache(maxsize=256)
+def plan_result_sections(selected_features: tuple) -> Optional[tuple]:
+    """Result sections unlocked by a plan's features, in plan order. None means no filtering."""
+    if not selected_features:
+        return None
+    sections = []
+    for feature in selected_features:
+        section = FEATURE_RESULT_SECTIONS.get(feature)
+        if section and section not in sections:
+            sections.append(section)
+    return tuple(sections)
+
+
+def _comprehensive_results(ai_analysis_results: Optional[dict]) -> Optional[dict]:
+    comp_analysis = (ai_analysis_results or {}).get("comprehensive-analysis")
+    if not isinstance(comp_analysis, dict) or not isinstance(comp_analysis.get("data"), dict):
+        return None
+    results = comp_analysis["data"].get("results")
+    return results if isinstance(results, dict) else None
+
+
+def _with_sections(ai_analysis_results: dict, sections: dict) -> dict:
+    comp_analysis = ai_analysis_results["comprehensive-analysis"]
+    return {
+        **ai_analysis_results,
+        "comprehensive-analysis": {**comp_analysis, "data": {**comp_analysis["data"], "results": sections}},
+    }
+
+
+def analysis_record_results(ai_analysis_results: dict) -> dict:
+    """
+    The results fields of an analysis record: ai_analysis_results with the
+    comprehensive-analysis sections moved out to feature_results.
+    """
+    results = _comprehensive_results(ai_analysis_results)
+    if results is None:
+        return {"ai_analysis_results": ai_analysis_results, "feature_sections": []}
+    comp_data = ai_analysis_results["comprehensive-analysis"]["data"]
+    stripped = {key: value for key, value in comp_data.items() if key != "results"}
+    return {
+        "ai_analysis_results": {
+            **ai_analysis_results,
+            "comprehensive-analysis": {**ai_analysis_results["comprehensive-analysis"], "data": stripped},
+        },
+        "feature_results": results,
+        "feature_sections": list(results),
+        "projectionVersion": ANALYSIS_PROJECTION_VERSION,
+    }
+
+
+def stored_analysis_results(data: dict) -> Optional[dict]:
+    """The full ai_analysis_results of a stored analysis, sections put back."""
+    results = data.get("ai_analysis_results")
+    if not results or data.get("projectionVersion") != ANALYSIS_PROJECTION_VERSION:
+        return results
+    sections = data.get("feature_results") or {}
+    return _with_sections(results, {section: sections[section] for section in data.get("feature_sections", []) if section in sections})
+
+
+def project_analysis(data: dict, selected_features: list) -> dict:
+    """
+    Restrict a stored analysis to the sections the plan unlocks (dropping
+    feature_results) and annotate it with the filtered_* fields. Section
+    payloads are placed, not copied.
+    """
+    allowed = plan_result_sections(tuple(selected_features or ()))
+    if data.pop("projectionVersion", None) == ANALYSIS_PROJECTION_VERSION:
+        sections = data.pop("feature_results", None) or {}
+        available = data.get("feature_sections", [])
+        visible = list(available) if allowed is None else [section for section in allowed if section in available]
+        data["ai_analysis_results"] = _with_sections(data["ai_analysis_results"], {section: sections[section] for section in visible})
+        has_results = True
+    else:
+        results = _comprehensive_results(data.get("ai_analysis_results"))
+        available = data.get("feature_sections")
+        if available is None:
+            available = list(results or {})
+        visible = list(available) if allowed is None else [section for section in allowed if section in available]
+        if results is not None and allowed is not None:
+            data["ai_analysis_results"] = _with_sections(data["ai_analysis_results"], {section: results[section] for section in visible})
+        has_results = results is not None
+
+    filtered_models = ["comprehensive-analysis"] if has_results else []
+    data["filtered_features"] = visible
+    data["total_filtered_features"] = len(visible)
+    data["filtered_models"] = filtered_models
+    data["total_filtered_models"] = len(filtered_models)
+    data["user_selected_features"] = selected_features
+    data["all_available_features"] = list(available)
+    return data
+
+
+# Analysis reads are paged newest first so a response stays bounded however
+# much history a user has. Timestamps are not unique, so the order (and the
+# nextCursor) is (timestamp, document ID); a cursor on the timestamp alone
+# would skip the rest of a group of analyses saved with the same timestamp.
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 50
+ANALYSIS_LIST_FIELDS = ["timestamp", "adTitle", "channels", "brandName", "messageIntent", "funnelStage", "mediaCategory"]
+
+
+def clamp_page_size(limit: int) -> int:
+    return max(1, min(limit or DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE))
+
+
+def encode_page_cursor(timestamp: str, document_id: str) -> str:
+    return base64.urlsafe_b64encode(json.dumps([timestamp, document_id]).encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def decode_page_cursor(cursor: str) -> tuple:
+    """(timestamp, document ID) of a nextCursor; a bare timestamp from an older client gives (timestamp, None)."""
+    try:
+        timestamp, document_id = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        return timestamp, document_id
+    except (ValueError, TypeError):
+        return cursor, None
+
+
+def paginate_by_timestamp(query, page_size: int, start_after: Optional[str] = None):
+    """Order a user_analysis query newest first (ties by document ID) and apply the page cursor."""
+    # Served by the (userId, timestamp desc, __name__ desc) index in firestore.indexes.json
+    query = query.order_by("timestamp", direction=firestore.Query.DESCENDING)
+    query = query.order_by(FieldPath.document_id(), direction=firestore.Query.DESCENDING)
+    if start_after:
+        timestamp, document_id = decode_page_cursor(start_after)
+        cursor = {"timestamp": timestamp}
+        if document_id:
+            cursor[FieldPath.document_id()] = document_id
+        query = query.start_after(cursor)
+    return query.limit(page_size)
+
+
+def next_page_cursor(docs: list, page_size: int) -> Optional[str]:
+    """Cursor for the following page, or None when this page was the last one."""
+    if len(docs) < page_size:
+        return None
+    return encode_page_cursor((docs[-1].to_dict() or {}).get("timestamp"), docs[-1].id)
+
+
 @app.get("/get-analysis-details/{user_id}")
-async def get_analysis_details(user_id: str):
+async def get_analysis_details(user_id: str, limit: int = DEFAULT_PAGE_SIZE, startAfter: Optional[str] = None):
+    """
+    Page through a user's analyses (newest first) with results filtered by plan.
+    Pass the returned nextCursor as startAfter to fetch the next page.
+    """
     try:
         # Step 1: Get selected features from PlanSelectionDetails
         try:
-            plans_selection = db.collection("PlanSelectionDetails").document(user_id)
-            get_plans = plans_selection.get()
-            
-            if get_plans.exists:
-                plan_data = get_plans.to_dict()
-                selected_features = plan_data.get("selectedFeatures", [])
-            else:
-                selected_features = []
+            plan_data = await get_plan_data(user_id)
+            selected_features = plan_data.get("selectedFeatures", []) if plan_data else []
         except Exception as e:
-            print(f"Error fetching selected features: {e}")
+            logger.error("Error fetching selected features: %s", e)
             selected_features = []
 
-        print(selected_features)
-        # Step 2: Get analysis documents for the user from user_analysis collection
-        docs = db.collection("user_analysis").where("userId", "==", user_id).stream()
+        logger.debug("Selected features: %s", selected_features)
+        # Step 2: Get one page of analysis documents for the user from user_analysis collection
+        page_size = clamp_page_size(limit)
+        query = db.collection("user_analysis").where("userId", "==", user_id)
+        docs = await fs_stream(paginate_by_timestamp(query, page_size, startAfter))
         
         analysis_details = []
 
         for doc in docs:
-            data = doc.to_dict()
-            
-            # Filter ai_analysis_results by selected_features
-            if "ai_analysis_results" in data and selected_features:
-                # Check if comprehensive-analysis exists and has data.results
-                if "comprehensive-analysis" in data["ai_analysis_results"]:
-                    comp_analysis = data["ai_analysis_results"]["comprehensive-analysis"]
-                    if "data" in comp_analysis and "results" in comp_analysis["data"]:
-                        original_features = comp_analysis["data"]["results"]
-                        
-                        # Map plan features to nested results features
-                        feature_mapping = {
-                            "brand_compliance": "brand_compliance",
-                            "channel_compliance": "channel_compliance", 
-                            "content_analysis": "content_analysis",
-                            "metaphor_analysis": "metaphor_analysis",
-                            "messaging_intent": "content_analysis",  # messaging intent maps to content analysis
-                            "funnel_compatibility": "content_analysis",  # funnel compatibility maps to content analysis
-                            "resonance_index": "metaphor_analysis"  # resonance index maps to metaphor analysis
-                        }
-                        
-                        # Create filtered results structure
-                        filtered_results = {}
-                        filtered_features = []
-                        
-                        # Filter the nested features based on user's plan
-                        for plan_feature in selected_features:
-                            if plan_feature in feature_mapping:
-                                nested_feature = feature_mapping[plan_feature]
-                                if nested_feature in original_features:
-                                    filtered_results[nested_feature] = original_features[nested_feature]
-                                    filtered_features.append(nested_feature)
-                        
-                        # Create filtered comprehensive analysis
-                        filtered_comp_analysis = comp_analysis.copy()
-                        filtered_comp_analysis["data"] = comp_analysis["data"].copy()
-                        filtered_comp_analysis["data"]["results"] = filtered_results
-                        
-                        # Update the analysis data
-                        data["ai_analysis_results"]["comprehensive-analysis"] = filtered_comp_analysis
-                        data["filtered_features"] = filtered_features
-                        data["total_filtered_features"] = len(filtered_features)
-                        data["filtered_models"] = ["comprehensive-analysis"]
-                        data["total_filtered_models"] = 1
-                        
-                        print(f"✅ Filtered features for analysis {doc.id}: {filtered_features}")
-                        print(f"🔍 User selected features: {selected_features}")
-                        print(f"🔍 Available features in results: {list(original_features.keys())}")
-                    else:
-                        data["filtered_features"] = []
-                        data["total_filtered_features"] = 0
-                        data["filtered_models"] = []
-                        data["total_filtered_models"] = 0
-                else:
-                    data["filtered_features"] = []
-                    data["total_filtered_features"] = 0
-                    data["filtered_models"] = []
-                    data["total_filtered_models"] = 0
-            
+            data = project_analysis(doc.to_dict(), selected_features)
             data["document_id"] = doc.id
-            data["user_selected_features"] = selected_features
             analysis_details.append(data)
 
-        if not analysis_details:
+        if not analysis_details and not startAfter:
             raise HTTPException(status_code=404, detail=f"No analysis details found for user: {user_id}")
         
         return {
             "user_id": user_id,
             "total_analyses": len(analysis_details),
             "user_selected_features": selected_features,
-            "analysis_details": analysis_details
+            "analysis_details": analysis_details,
+            "nextCursor": next_page_cursor(docs, page_size)
         }
 
     except Exception as e:
@@ -1653,11 +4506,17 @@ async def get_analysis_details(user_id: str):
 
  
 @app.get("/get-user-analysis-history/{user_id}")
-async def get_user_analysis_history(user_id: str):
-    """Get all analysis results for a specific user"""
+async def get_user_analysis_history(user_id: str, limit: int = DEFAULT_PAGE_SIZE, startAfter: Optional[str] = None):
+    """
+    Get a page of a user's analyses for list views (newest first).
+
+    Only summary fields are fetched from Firestore; full results are served by
+    /get-analysis-by-id/{artifact_id}. Pass nextCursor as startAfter for the next page.
+    """
     try:
-        # Query all documents for this user from user_analysis collection
-        docs = db.collection("user_analysis").where("userId", "==", user_id).stream()
+        page_size = clamp_page_size(limit)
+        query = db.collection("user_analysis").where("userId", "==", user_id).select(ANALYSIS_LIST_FIELDS)
+        docs = await fs_stream(paginate_by_timestamp(query, page_size, startAfter))
        
         analysis_history = []
         for doc in docs:
@@ -1669,20 +4528,20 @@ async def get_user_analysis_history(user_id: str):
                 "funnelStage": data.get("funnelStage"),  # funnel compatibility
                 "channels": data.get("channels"),  # channel compliance
                 "adTitle": data.get("adTitle"),  # Ad title for Libraries display
-                "total_models_analyzed": data.get("total_models_analyzed"),
-                "successful_models": data.get("successful_models"),
-                "ai_analysis_results": data.get("ai_analysis_results"),
-                "plan_usage_at_time": data.get("plan_usage_at_time", {})
+                "brandName": data.get("brandName"),
+                "mediaCategory": data.get("mediaCategory"),
+                "resultsUrl": f"/get-analysis-by-id/{doc.id}"
             })
        
         return {
             "user_id": user_id,
             "total_analyses": len(analysis_history),
-            "analysis_history": analysis_history
+            "analysis_history": analysis_history,
+            "nextCursor": next_page_cursor(docs, page_size)
         }
  
     except Exception as e:
-        print(f"Error fetching user analysis history: {str(e)}")
+        logger.error("Error fetching user analysis history: %s", e)
         raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
 
 
@@ -1691,14 +4550,14 @@ async def get_analysis_by_id(analysis_id: str):
     """Get a specific analysis result by analysis ID with feature filtering based on user's plan"""
     try:
         doc_ref = db.collection("user_analysis").document(analysis_id)
-        doc = doc_ref.get()
+        doc = await fs_get(doc_ref)
         
         if not doc.exists:
             raise HTTPException(status_code=404, detail=f"Analysis with ID '{analysis_id}' not found")
         
         analysis_data = doc.to_dict()
         analysis_data["document_id"] = doc.id
-        print(f"✅ Analysis data: {analysis_data}")
+        logger.debug("Analysis data: %s", analysis_data)
         
         # Get user ID from the analysis data
         user_id = analysis_data.get("userId")
@@ -1708,97 +4567,19 @@ async def get_analysis_by_id(analysis_id: str):
         # Get selected features from user's plan
         selected_features = []
         try:
-            plan_doc = db.collection("PlanSelectionDetails").document(user_id).get()
-            if plan_doc.exists:
-                plan_data = plan_doc.to_dict()
+            plan_data = await get_plan_data(user_id)
+            if plan_data:
                 selected_features = plan_data.get("selectedFeatures", [])
-                print(f"✅ Found selected features for user {user_id}: {selected_features}")
+                logger.info("Found selected features for user %s: %s", user_id, selected_features)
             else:
-                print(f"⚠️ No plan found for user {user_id}, showing all features")
+                logger.warning("No plan found for user %s, showing all features", user_id)
                 selected_features = []
         except Exception as e:
-            print(f"Warning: Could not get selected features for user {user_id}: {e}")
+            logger.warning("Could not get selected features for user %s: %s", user_id, e)
             selected_features = []
         
-        # Filter AI analysis results based on selected features
-        if "ai_analysis_results" in analysis_data and selected_features:
-            original_results = analysis_data["ai_analysis_results"]
-            
-            # Check if comprehensive-analysis exists and has data.results
-            if "comprehensive-analysis" in original_results:
-                comp_analysis = original_results["comprehensive-analysis"]
-                if "data" in comp_analysis and "results" in comp_analysis["data"]:
-                    original_features = comp_analysis["data"]["results"]
-                    
-                    # Create filtered results structure
-                    filtered_results = {}
-                    filtered_features = []
-                    
-                    # Map plan features to nested results features based on actual response structure
-                    feature_mapping = {
-                        "brand_compliance": "brand_compliance",
-                        "channel_compliance": "channel_compliance", 
-                        "messaging_intent": "content_analysis",  # messaging intent maps to content analysis
-                        "funnel_compatibility": "content_analysis",  # funnel compatibility maps to content analysis
-                        "resonance_index": "metaphor_analysis"  # resonance index maps to metaphor analysis
-                    }
-                    
-                    # Filter the nested features based on user's plan
-                    for plan_feature in selected_features:
-                        if plan_feature in feature_mapping:
-                            nested_feature = feature_mapping[plan_feature]
-                            if nested_feature in original_features:
-                                filtered_results[nested_feature] = original_features[nested_feature]
-                                filtered_features.append(nested_feature)
-                    
-                    # Create filtered comprehensive analysis
-                    filtered_comp_analysis = comp_analysis.copy()
-                    filtered_comp_analysis["data"] = comp_analysis["data"].copy()
-                    filtered_comp_analysis["data"]["results"] = filtered_results
-                    
-                    # Update the analysis data
-                    analysis_data["ai_analysis_results"]["comprehensive-analysis"] = filtered_comp_analysis
-                    analysis_data["filtered_features"] = filtered_features
-                    analysis_data["total_filtered_features"] = len(filtered_features)
-                    analysis_data["user_selected_features"] = selected_features
-                    analysis_data["all_available_features"] = list(original_features.keys())
-                    
-                    print(f"✅ Filtered nested features: {filtered_features} out of {list(original_features.keys())}")
-                    print(f"🔍 User selected features: {selected_features}")
-                    print(f"🔍 Available features in results: {list(original_features.keys())}")
-                    print(f"🔍 Feature mapping used: {feature_mapping}")
-                else:
-                    print(f"⚠️ No 'data.results' found in comprehensive-analysis")
-                    analysis_data["filtered_features"] = []
-                    analysis_data["total_filtered_features"] = 0
-                    analysis_data["user_selected_features"] = selected_features
-                    analysis_data["all_available_features"] = []
-            else:
-                print(f"⚠️ No 'comprehensive-analysis' found in ai_analysis_results")
-                analysis_data["filtered_features"] = []
-                analysis_data["total_filtered_features"] = 0
-                analysis_data["user_selected_features"] = selected_features
-                analysis_data["all_available_features"] = []
-        else:
-            # If no features selected or no filtering needed, show all results
-            if "ai_analysis_results" in analysis_data and "comprehensive-analysis" in analysis_data["ai_analysis_results"]:
-                comp_analysis = analysis_data["ai_analysis_results"]["comprehensive-analysis"]
-                if "data" in comp_analysis and "results" in comp_analysis["data"]:
-                    all_features = list(comp_analysis["data"]["results"].keys())
-                    analysis_data["filtered_features"] = all_features
-                    analysis_data["total_filtered_features"] = len(all_features)
-                    analysis_data["user_selected_features"] = selected_features
-                    analysis_data["all_available_features"] = all_features
-                else:
-                    analysis_data["filtered_features"] = []
-                    analysis_data["total_filtered_features"] = 0
-                    analysis_data["user_selected_features"] = selected_features
-                    analysis_data["all_available_features"] = []
-            else:
-                analysis_data["filtered_features"] = []
-                analysis_data["total_filtered_features"] = 0
-                analysis_data["user_selected_features"] = selected_features
-                analysis_data["all_available_features"] = []
+        project_analysis(analysis_data, selected_features)
+        logger.info("Filtered features: %s out of %s", analysis_data['filtered_features'], analysis_data['all_available_features'])
         
         return {
             "message": "Analysis retrieved successfully",
@@ -1808,7 +4589,7 @@ async def get_analysis_by_id(analysis_id: str):
     except HTTPException:
         raise
     except Exception as e:
-        print(f"Error retrieving analysis: {str(e)}")
+        logger.error("Error retrieving analysis: %s", e)
         raise HTTPException(status_code=500, detail=f"Failed to retrieve analysis: {str(e)}")
 
 
@@ -1817,21 +4598,22 @@ async def reset_monthly_usage(user_id: str):
     """Manually reset monthly usage for a user (for testing purposes)"""
     try:
         plan_ref = db.collection("PlanSelectionDetails").document(user_id)
-        plan_doc = plan_ref.get()
+        plan_doc = await fs_get(plan_ref)
         
         if not plan_doc.exists:
             raise HTTPException(status_code=404, detail="User plan not found")
         
-        plan_data = plan_doc.to_dict()
         current_date = datetime.utcnow()
         
         updates = {
+            usage_field(current_usage_period(current_date)): 0,
             "adsUsed": 0,
             "lastUsageDate": current_date.isoformat() + "Z",
             "updatedAt": current_date.isoformat() + "Z"
         }
         
-        plan_ref.update(updates)
+        await fs_update(plan_ref, updates)
+        invalidate_plan_cache(user_id)
         
         return {
             "message": "Monthly usage reset successfully",
@@ -1843,59 +4625,207 @@ async def reset_monthly_usage(user_id: str):
     except HTTPException:
         raise
     except Exception as e:
-        print(f"Error resetting monthly usage: {str(e)}")
+        logger.error("Error resetting monthly usage: %s", e)
         raise HTTPException(status_code=500, detail=f"Failed to reset monthly usage: {str(e)}")
 
 
+# Monthly reset sweep: only plans whose lastUsageDate predates the current month
+# are read, a page at a time with a bounded number of pages in flight. Each plan
+# is reset by its own update, conditioned on the document being unchanged since
+# it was read, so a reservation that lands meanwhile is never zeroed: the plan
+# is read again and left alone once it has been used this month. A plan that
+# cannot be reset is counted and left for the next run while the rest of the
+# sweep carries on. Progress is checkpointed per month in maintenance_jobs.
+RESET_BATCH_SIZE = 500
+RESET_PARALLEL_BATCHES = int(os.getenv("RESET_PARALLEL_BATCHES", "4"))
+RESET_ATTEMPTS = 3
+
+monthly_reset_task: Optional[asyncio.Task] = None
+
+
+def _monthly_reset_ref(period: str):
+    return db.collection("maintenance_jobs").document(f"monthly-usage-reset-{period}")
+
+
+async def _reset_plan_usage(snapshot, month_start: str, updates: dict) -> bool:
+    """Reset one plan unless it has been used since month_start. Returns True if it was reset."""
+    for _ in range(RESET_ATTEMPTS):
+        if not snapshot.exists or ((snapshot.to_dict() or {}).get("lastUsageDate") or "") >= month_start:
+            return False
+        try:
+            await fs_update(snapshot.reference, updates, option=db.write_option(last_update_time=snapshot.update_time))
+            return True
+        except (FailedPrecondition, NotFound):
+            # Written or deleted since it was read; look again
+            snapshot = await fs_get(snapshot.reference)
+    raise RuntimeError(f"plan {snapshot.id} kept changing during the reset")
+
+
+async def run_monthly_usage_reset() -> dict:
+    """
+    Reset adsUsed for every plan last used before the start of this month.
+
+    Reset documents get lastUsageDate = now, which takes them out of the query,
+    so a rerun after a crash, or after a run that could not reset some plans
+    ("incomplete"), picks up what is left; the checkpoint document carries the
+    counters across runs and records progress and throughput.
+    """
+    current_date = datetime.utcnow()
+    period = current_date.strftime("%Y-%m")
+    month_start = current_date.replace(day=1, hour=0, minute=0, second=0, microsecond=0).isoformat() + "Z"
+    now = current_date.isoformat() + "Z"
+    progress_ref = _monthly_reset_ref(period)
+
+    checkpoint_doc = await fs_get(progress_ref)
+    checkpoint = checkpoint_doc.to_dict() if checkpoint_doc.exists else {}
+    if checkpoint.get("status") == "done":
+        return checkpoint
+
+    progress = {
+        "period": period,
+        "status": "running",
+        "usersReset": checkpoint.get("usersReset", 0),
+        "usersSkipped": checkpoint.get("usersSkipped", 0),
+        "usersFailed": 0,  # this run; they stay in the query for the next one
+        "lastError": None,
+        "pagesProcessed": checkpoint.get("pagesProcessed", 0),
+        "resumed": bool(checkpoint),
+        "startedAt": checkpoint.get("startedAt", now),
+        "runStartedAt": now,
+    }
+    await fs_set(progress_ref, progress, merge=True)
+    logger.info("Monthly usage reset for %s %s", period, 'resumed' if checkpoint else 'started')
+
+    query = (
+        db.collection("PlanSelectionDetails")
+        .where("lastUsageDate", "<", month_start)
+        .order_by("lastUsageDate")
+    )
+    updates = {"adsUsed": 0, "lastUsageDate": now, "updatedAt": now}
+    started = time.perf_counter()
+    run_reset = 0
+    slots = asyncio.Semaphore(RESET_PARALLEL_BATCHES)
+
+    async def reset_page(page: list):
+        nonlocal run_reset
+        try:
+            outcomes = await asyncio.gather(
+                *(_reset_plan_usage(snapshot, month_start, updates) for snapshot in page), return_exceptions=True
+            )
+            for snapshot, outcome in zip(page, outcomes):
+                if isinstance(outcome, Exception):
+                    logger.warning("Monthly reset: could not reset plan %s: %s", snapshot.id, outcome)
+                    progress["usersFailed"] += 1
+                    progress["lastError"] = f"{snapshot.id}: {outcome}"
+                elif outcome:
+                    invalidate_plan_cache(snapshot.id)
+                    run_reset += 1
+                    progress["usersReset"] += 1
+                else:
+                    progress["usersSkipped"] += 1
+            progress["pagesProcessed"] += 1
+            elapsed = time.perf_counter() - started
+            progress["docsPerSecond"] = round(run_reset / elapsed, 1) if elapsed else None
+            progress["updatedAt"] = datetime.utcnow().isoformat() + "Z"
+            await fs_set(progress_ref, progress, merge=True)
+            logger.info(
+                "Monthly reset: %s users reset, %s failed (%s docs/s)",
+                progress['usersReset'], progress['usersFailed'], progress['docsPerSecond'],
+            )
+        finally:
+            slots.release()
+
+    pending = []
+    cursor = None
+    try:
+        while True:
+            page_query = query.limit(RESET_BATCH_SIZE)
+            if cursor is not None:
+                page_query = page_query.start_after(cursor)
+            page = await fs_stream(page_query)
+            if not page:
+                break
+            cursor = page[-1]
+            await slots.acquire()
+            pending.append(asyncio.create_task(reset_page(page)))
+            if len(page) < RESET_BATCH_SIZE:
+                break
+        await asyncio.gather(*pending)
+    except Exception as e:
+        await asyncio.gather(*pending, return_exceptions=True)
+        progress["status"] = "failed"
+        progress["error"] = str(e)
+        progress["updatedAt"] = datetime.utcnow().isoformat() + "Z"
+        await fs_set(progress_ref, progress, merge=True)
+        raise
+
+    elapsed = time.perf_counter() - started
+    progress["status"] = "incomplete" if progress["usersFailed"] else "done"
+    progress["elapsedSeconds"] = round(elapsed, 3)
+    progress["docsPerSecond"] = round(run_reset / elapsed, 1) if elapsed else None
+    progress["completedAt"] = datetime.utcnow().isoformat() + "Z"
+    progress.pop("error", None)
+    await fs_set(progress_ref, progress, merge=True)
+    return progress
+
+
 @app.post("/reset-all-monthly-usage")
-async def reset_all_monthly_usage():
-    """Reset monthly usage for all users (scheduled task)"""
+async def reset_all_monthly_usage(background: bool = False):
+    """
+    Reset monthly usage for all users (scheduled task).
+
+    Usage is counted per billing period, so a new month starts at zero without
+    this sweep; it only normalises the legacy adsUsed mirror.
+
+    With background=true the sweep runs after the response is sent; poll
+    /reset-all-monthly-usage/status for progress.
+    """
+    global monthly_reset_task
     try:
         current_date = datetime.utcnow()
-        reset_count = 0
-        
-        # Get all plan documents
-        docs = db.collection("PlanSelectionDetails").stream()
-        
-        for doc in docs:
-            plan_data = doc.to_dict()
-            last_usage_date = plan_data.get("lastUsageDate")
-            
-            # Check if reset is needed
-            if last_usage_date:
-                try:
-                    last_usage = datetime.fromisoformat(last_usage_date.replace("Z", ""))
-                    # Reset if it's a new month
-                    if (current_date.year != last_usage.year or current_date.month != last_usage.month):
-                        updates = {
-                            "adsUsed": 0,
-                            "lastUsageDate": current_date.isoformat() + "Z",
-                            "updatedAt": current_date.isoformat() + "Z"
-                        }
-                        doc.reference.update(updates)
-                        reset_count += 1
-                        print(f"🔄 Reset monthly usage for user: {doc.id}")
-                except Exception as e:
-                    print(f"Warning: Could not parse last usage date for user {doc.id}: {e}")
-                    continue
-        
+
+        if background:
+            if monthly_reset_task is None or monthly_reset_task.done():
+                monthly_reset_task = asyncio.create_task(run_monthly_usage_reset())
+            return {
+                "message": "Monthly usage reset started",
+                "reset_date": current_date.isoformat(),
+                "statusUrl": "/reset-all-monthly-usage/status"
+            }
+
+        progress = await run_monthly_usage_reset()
         return {
             "message": "Monthly usage reset completed",
             "reset_date": current_date.isoformat(),
-            "users_reset": reset_count
+            "users_reset": progress.get("usersReset", 0),
+            "users_failed": progress.get("usersFailed", 0),
+            "progress": progress
         }
         
     except Exception as e:
-        print(f"Error in monthly reset task: {str(e)}")
+        logger.error("Error in monthly reset task: %s", e)
         raise HTTPException(status_code=500, detail=f"Failed to reset monthly usage: {str(e)}")
 
+
+@app.get("/reset-all-monthly-usage/status")
+async def get_monthly_reset_status(period: Optional[str] = None):
+    """Progress of the monthly reset sweep for a period (YYYY-MM, defaults to the current month)."""
+    try:
+        period = period or datetime.utcnow().strftime("%Y-%m")
+        doc = await fs_get(_monthly_reset_ref(period))
+        if not doc.exists:
+            return {"period": period, "status": "not_started"}
+        return doc.to_dict()
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to get monthly reset status: {str(e)}")
+
 @app.get("/get-plan-selections/{user_id}")
 async def get_plan_selections(user_id: str):
     try:
-        docs = db.collection("PlanSelectionDetails").where("userId", "==", user_id).stream()
+        # Plan documents are keyed by userId, so this is the user's single plan
+        plan_data = await get_plan_data(user_id)
         plans: list[dict] = []
-        for doc in docs:
-            d = doc.to_dict() or {}
+        for d in [plan_data] if plan_data else []:
             plans.append({
                 "planId": d.get("planId"),
                 "planName": d.get("planName"),
@@ -1918,11 +4848,11 @@ async def get_plan_selections(user_id: str):
 async def get_user_files(user_id: str, fileType: Optional[str] = None, limit: int = 50):
     """Return user files for a user. Frontend should call this instead of Firestore directly."""
     try:
-        def query_collection(collection_name: str):
+        async def query_collection(collection_name: str):
             q = db.collection(collection_name).where("userId", "==", user_id)
             if fileType:
                 q = q.where("fileType", "==", fileType)
-            docs = list(q.stream())
+            docs = await fs_stream(q)
             files: list[dict] = []
             for d in docs:
                 data = d.to_dict() or {}
@@ -1937,9 +4867,9 @@ async def get_user_files(user_id: str, fileType: Optional[str] = None, limit: in
             files.sort(key=ts, reverse=True)
             return files
 
-        files = query_collection("userFiles")
+        files = await query_collection("userFiles")
         if not files:
-            files = query_collection("UserFiles")
+            files = await query_collection("UserFiles")
 
         if limit and limit > 0:
             files = files[:limit]
@@ -1953,15 +4883,15 @@ async def get_user_files(user_id: str, fileType: Optional[str] = None, limit: in
 async def get_user_file(file_id: str):
     """Return a single user file document by ID."""
     try:
-        def get_from(collection_name: str):
-            d = db.collection(collection_name).document(file_id).get()
+        async def get_from(collection_name: str):
+            d = await fs_get(db.collection(collection_name).document(file_id))
             if d.exists:
                 data = d.to_dict() or {}
                 data["id"] = d.id
                 return data
             return None
 
-        data = get_from("userFiles") or get_from("UserFiles")
+        data = await get_from("userFiles") or await get_from("UserFiles")
         if data is None:
             raise HTTPException(status_code=404, detail="File not found")
         return data
@@ -1999,7 +4929,7 @@ async def save_analysis_record(request: Request):
         }
 
         ref = db.collection("userFiles").document()
-        ref.set(doc)
+        await fs_set(ref, doc)
         doc_id = ref.id
         doc["id"] = doc_id
         return {"message": "Analysis record saved", "id": doc_id, "document": doc}
@@ -2034,14 +4964,8 @@ async def upload_analysis_pdf(
         storage_path = f"analysis-reports/{userId}/{ts}_{safe_name}"
 
         contents = await file.read()
-        blob = bucket.blob(storage_path)
-        blob.upload_from_string(contents, content_type="application/pdf")
-        #url = blob.generate_signed_url(expiration=3600 * 24 * 7)
-        url = blob.generate_signed_url(
-                version="v4",                # use v4 signed URLs
-                expiration=timedelta(days=7), # 7 days from now
-                method="GET"                  # HTTP method allowed
-            )
+        await gcs_upload_bytes(storage_path, contents, content_type="application/pdf")
+        url = await gcs_signed_url(storage_path)
 
         payload = {
             "userId": userId,
@@ -2058,14 +4982,14 @@ async def upload_analysis_pdf(
 
         doc_id = None
         if analysisId:
-            matches = list(db.collection("userFiles").where("userId", "==", userId).where("analysisId", "==", analysisId).limit(1).stream())
+            matches = await fs_stream(db.collection("userFiles").where("userId", "==", userId).where("analysisId", "==", analysisId).limit(1))
             if matches:
                 doc_ref = db.collection("userFiles").document(matches[0].id)
-                doc_ref.set(payload, merge=True)
+                await fs_set(doc_ref, payload, merge=True)
                 doc_id = matches[0].id
         if not doc_id:
             doc_ref = db.collection("userFiles").document()
-            doc_ref.set(payload)
+            await fs_set(doc_ref, payload)
             doc_id = doc_ref.id
 
         return {"message": "PDF uploaded", "id": doc_id, "url": url, "storagePath": storage_path}
@@ -2122,8 +5046,8 @@ async def create_std_plan_details():
         # Store each plan in the std_plan_details collection
         for plan in std_plans:
             plan_id = plan["planName"]
-            db.collection("std_plan_details").document(plan_id).set(plan)
-            print(f"✅ Created plan: {plan['planName']}")
+            await fs_set(db.collection("std_plan_details").document(plan_id), plan)
+            logger.info("Created plan: %s", plan['planName'])
         
         return {
             "message": "Standard plan details created successfully",
@@ -2132,9 +5056,19 @@ async def create_std_plan_details():
         }
         
     except Exception as e:
-        print(f"Error creating standard plan details: {str(e)}")
+        logger.error("Error creating standard plan details: %s", e)
         raise HTTPException(status_code=500, detail=f"Failed to create standard plan details: {str(e)}")
 
+async def release_analysis_media(analysis: dict):
+    """Drop an analysis record's reference to content-addressed media; other media is left as before."""
+    storage_path = analysis.get("storagePath") or ""
+    if storage_path.startswith(CAS_PREFIX):
+        try:
+            await gcs_release(storage_path)
+        except Exception as e:
+            logger.warning("Could not release media %s: %s", storage_path, e)
+
+
 @app.delete("/delete-user-file/{user_id}/{file_id}")
 async def delete_user_file(user_id: str, file_id: str):
     """
@@ -2144,7 +5078,7 @@ async def delete_user_file(user_id: str, file_id: str):
         # Query user_analysis collection for the file
         analysis_ref = db.collection("user_analysis")
         query = analysis_ref.where("userId", "==", user_id).where("artifact_id", "==", file_id)
-        docs = query.get()
+        docs = await fs_stream(query)
         
         if not docs:
             raise HTTPException(status_code=404, detail="File not found")
@@ -2152,7 +5086,8 @@ async def delete_user_file(user_id: str, file_id: str):
         # Delete all matching documents
         deleted_count = 0
         for doc in docs:
-            doc.reference.delete()
+            await fs_delete(doc.reference)
+            await release_analysis_media(doc.to_dict() or {})
             deleted_count += 1
         
         return {
@@ -2162,7 +5097,7 @@ async def delete_user_file(user_id: str, file_id: str):
         }
         
     except Exception as e:
-        print(f"❌ Error deleting user file: {e}")
+        logger.error("Error deleting user file: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.delete("/delete-file/{file_id}")
@@ -2174,7 +5109,7 @@ async def delete_file_by_id(file_id: str):
         # Query user_analysis collection for the file
         analysis_ref = db.collection("user_analysis")
         query = analysis_ref.where("artifact_id", "==", file_id)
-        docs = query.get()
+        docs = await fs_stream(query)
         
         if not docs:
             raise HTTPException(status_code=404, detail="File not found")
@@ -2182,7 +5117,8 @@ async def delete_file_by_id(file_id: str):
         # Delete all matching documents
         deleted_count = 0
         for doc in docs:
-            doc.reference.delete()
+            await fs_delete(doc.reference)
+            await release_analysis_media(doc.to_dict() or {})
             deleted_count += 1
         
         return {
@@ -2191,18 +5127,20 @@ async def delete_file_by_id(file_id: str):
         }
         
     except Exception as e:
-        print(f"❌ Error deleting file: {e}")
+        logger.error("Error deleting file: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/fix-plan-quota/{user_id}")
 async def fix_plan_quota(user_id: str):
     """
     Fix incorrect adQuota values in user profiles based on their actual plan type
+
+    Plan and profile are written together in one batch.
     """
     try:
         # Get user's current plan from PlanSelectionDetails
         plan_ref = db.collection("PlanSelectionDetails").document(user_id)
-        plan_doc = plan_ref.get()
+        plan_doc = await fs_get(plan_ref)
         
         if not plan_doc.exists:
             raise HTTPException(status_code=404, detail="User plan not found")
@@ -2216,23 +5154,24 @@ async def fix_plan_quota(user_id: str):
         
         correct_total_ads = PLAN_CONFIG[plan_name]["total_ads"]
         correct_max_ads_per_month = PLAN_CONFIG[plan_name]["max_ads_per_month"]
-        current_ads_used = plan_data.get("adsUsed", 0)
-        
-        # Update PlanSelectionDetails with correct values
-        plan_ref.update({
-            "totalAds": correct_total_ads,
-            "max_ads_per_month": correct_max_ads_per_month,
-            "updatedAt": datetime.utcnow().isoformat() + "Z"
-        })
+        current_ads_used = monthly_ads_used(plan_data)
         
-        # Update userProfileDetails with correct values
-        profile_ref = db.collection("userProfileDetails").document(user_id)
-        profile_ref.update({
-            "subscription.adQuota": correct_total_ads,
-            "subscription.max_ads_per_month": correct_max_ads_per_month,
-            "subscription.updatedAt": datetime.utcnow().isoformat() + "Z",
-            "updatedAt": datetime.utcnow().isoformat() + "Z"
-        })
+        # Update PlanSelectionDetails and userProfileDetails with correct values
+        updated_at = datetime.utcnow().isoformat() + "Z"
+        await write_plan_and_profile(
+            user_id,
+            {
+                "totalAds": correct_total_ads,
+                "max_ads_per_month": correct_max_ads_per_month,
+                "updatedAt": updated_at
+            },
+            {
+                "subscription.adQuota": correct_total_ads,
+                "subscription.max_ads_per_month": correct_max_ads_per_month,
+                "subscription.updatedAt": updated_at,
+                "updatedAt": updated_at
+            },
+        )
         
         return {
             "success": True,
@@ -2247,7 +5186,7 @@ async def fix_plan_quota(user_id: str):
         }
         
     except Exception as e:
-        print(f"❌ Error fixing plan quota: {e}")
+        logger.error("Error fixing plan quota: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
 
@@ -2259,13 +5198,14 @@ async def delete_user_subscription(user_id: str):
     try:
         # Delete from PlanSelectionDetails
         plan_ref = db.collection("PlanSelectionDetails").document(user_id)
-        if plan_ref.get().exists:
-            plan_ref.delete()
-            print(f"✅ Deleted PlanSelectionDetails for user {user_id}")
+        if (await fs_get(plan_ref)).exists:
+            await fs_delete(plan_ref)
+            invalidate_plan_cache(user_id)
+            logger.info("Deleted PlanSelectionDetails for user %s", user_id)
         
         # Delete subscription data from userProfileDetails
         profile_ref = db.collection("userProfileDetails").document(user_id)
-        profile_doc = profile_ref.get()
+        profile_doc = await fs_get(profile_ref)
         
         if profile_doc.exists:
             # Delete nested subscription fields first
@@ -2296,12 +5236,12 @@ async def delete_user_subscription(user_id: str):
                 update_data[field] = firestore.DELETE_FIELD
             
             if update_data:
-                profile_ref.update(update_data)
-                print(f"✅ Deleted subscription fields from userProfileDetails for user {user_id}")
+                await fs_update(profile_ref, update_data)
+                logger.info("Deleted subscription fields from userProfileDetails for user %s", user_id)
             
             # Then delete the main subscription object
-            profile_ref.update({"subscription": firestore.DELETE_FIELD})
-            print(f"✅ Deleted main subscription object for user {user_id}")
+            await fs_update(profile_ref, {"subscription": firestore.DELETE_FIELD})
+            logger.info("Deleted main subscription object for user %s", user_id)
         
         return {
             "success": True,
@@ -2310,7 +5250,7 @@ async def delete_user_subscription(user_id: str):
         }
         
     except Exception as e:
-        print(f"❌ Error deleting subscription data: {e}")
+        logger.error("Error deleting subscription data: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
 
@@ -2361,9 +5301,6 @@ async def create_fresh_subscription(
             "updatedAt": start_date.isoformat() + "Z"
         }
         
-        # Save to PlanSelectionDetails
-        db.collection("PlanSelectionDetails").document(user_id).set(plan_data)
-        
         # Create subscription data for userProfileDetails
         subscription_data = {
             "subscription": {
@@ -2389,10 +5326,10 @@ async def create_fresh_subscription(
             "updatedAt": start_date.isoformat() + "Z"
         }
         
-        # Update userProfileDetails
-        db.collection("userProfileDetails").document(user_id).update(subscription_data)
+        # Save PlanSelectionDetails and userProfileDetails together
+        await write_plan_and_profile(user_id, plan_data, subscription_data, replace_plan=True)
         
-        print(f"✅ Created fresh {plan_name} subscription for user {user_id}")
+        logger.info("Created fresh %s subscription for user %s", plan_name, user_id)
         
         return {
             "success": True,
@@ -2402,10 +5339,24 @@ async def create_fresh_subscription(
         }
         
     except Exception as e:
-        print(f"❌ Error creating fresh subscription: {e}")
+        logger.error("Error creating fresh subscription: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
 
+# Shutdown handlers run in registration order. Analysis workers are stopped
+# above while the model client and the video pool are still open, so a
+# running analysis is interrupted rather than failing on a closed client.
+# The handlers above still write to Firestore (e.g. failing interrupted
+# analyses), so the I/O executor is shut down last.
+app.on_event("shutdown")(stop_upstream_client)
+app.on_event("shutdown")(stop_video_process_pool)
+
+
+@app.on_event("shutdown")
+def shutdown_io_executor():
+    io_executor.shutdown(wait=False)
+
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8002)
@@ -0,0 +1,70 @@
+"""Seed data and an in-process client for driving testapp's HTTP endpoints."""
+import asyncio
+import contextlib
+import json
+
+import httpx
+
+import testapp
+
+
+def seed_user(db, user_id: str = "user-1", brand_id: str = "brand-1", total_ads: int = 10,
+              max_ads_per_month: int = 10, selected_features=None, logo: bool = True):
+    """A plan, profile and brand (with one GCS-stored logo) for user_id."""
+    plan = {
+        "userId": user_id, "planName": "Incivus_Pro", "max_ads_per_month": max_ads_per_month, "totalAds": total_ads,
+    }
+    if selected_features is not None:
+        plan["selectedFeatures"] = selected_features
+    db.collection("PlanSelectionDetails").document(user_id).set(plan)
+    db.collection("userProfileDetails").document(user_id).set({"userId": user_id, "subscription": {}})
+    db.collection("brandData").document(brand_id).set({"userId": user_id, "brandName": "Acme", "mediaCount": 1 if logo else 0})
+    if logo:
+        db.collection("brandData").document(brand_id).collection("media").document("logo-1").set({
+            "fileId": "logo-1", "filename": "logo.png", "contentType": "image/png", "fileSize": 3,
+            "storagePath": f"{user_id}/Acme/logos/logo-1.png", "mediaType": "logo",
+            "uploadTimestamp": "2026-01-01T00:00:00Z", "brandId": brand_id, "userId": user_id,
+        })
+
+
+class MockUpstream:
+    """Stands in for the model service; records the form fields of every call."""
+
+    def __init__(self, payload=None, delay: float = 0.0, status: int = 200):
+        self.payload = payload if payload is not None else {"data": {"results": {"score": 1}}}
+        self.delay = delay
+        self.status = status
+        self.calls = []
+
+    async def handler(self, request: httpx.Request) -> httpx.Response:
+        body = await request.aread()
+        self.calls.append((str(request.url), body))
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        return httpx.Response(self.status, json=self.payload)
+
+
+@contextlib.asynccontextmanager
+async def app_client(upstream: MockUpstream):
+    """httpx client for testapp.app, with upstream model calls answered by `upstream`."""
+    previous = testapp.upstream_client
+    testapp.upstream_client = httpx.AsyncClient(transport=httpx.MockTransport(upstream.handler))
+    try:
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=testapp.app), base_url="http://testapp") as client:
+            yield client
+    finally:
+        await testapp.upstream_client.aclose()
+        testapp.upstream_client = previous
+
+
+async def submit_analysis(client: httpx.AsyncClient, user_id: str = "user-1", brand_id: str = "brand-1",
+                          media: bytes = b"\x89PNG creative", timestamp: str = "2026-10-18T00:00:00Z", **fields) -> httpx.Response:
+    data = {
+        "userId": user_id, "brandId": brand_id, "timestamp": timestamp,
+        "messageIntent": "launch", "funnelStage": "awareness", "channels": json.dumps(["facebook"]),
+        "source": "test", "clientId": "test", "artifacts": "{}", "asyncMode": "false",
+        **fields,
+    }
+    return await client.post(
+        "/postAnalysisDetailsFormData", data=data, files={"mediaFile": ("ad.png", media, "image/png")},
+    )
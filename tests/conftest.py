@@ -0,0 +1,41 @@
+"""
+testapp imports its Firestore client and bucket from a deployment-specific
+config module. The tests register one backed by the fakes in fake_gcp before
+testapp is imported, and give every test a fresh, empty store.
+"""
+import os
+import sys
+import types
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+from fake_gcp import FakeBucket, FakeFirestore  # noqa: E402
+
+config = types.ModuleType("config")
+config.db = FakeFirestore()
+config.bucket = FakeBucket()
+config.API_URL = "http://upstream.test/"
+sys.modules.setdefault("config", config)
+
+import testapp  # noqa: E402
+
+
+def reset_caches():
+    """Forget everything testapp caches in process between tests."""
+    for cache in testapp.ttl_caches:
+        cache.clear()
+    testapp.plan_result_sections.cache_clear()
+
+
+@pytest.fixture
+def store(monkeypatch):
+    """A fresh fake Firestore and bucket, patched into testapp."""
+    db, bucket = FakeFirestore(), FakeBucket()
+    monkeypatch.setattr(testapp, "db", db)
+    monkeypatch.setattr(testapp, "bucket", bucket)
+    reset_caches()
+    yield db, bucket
+    reset_caches()
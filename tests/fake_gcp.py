@@ -0,0 +1,610 @@
+"""
+In-memory stand-ins for the Firestore client and GCS bucket that testapp
+imports from config.
+
+They cover the subset of the client APIs testapp uses. Transactions are
+optimistic: reads are versioned and _commit raises Aborted if anything read
+changed, so @firestore.transactional retries exactly as it does against the
+real service. read_latency / upload_latency widen race windows for the
+concurrency tests. FakeBucket.handle_upload_session answers GCS resumable
+upload requests when used as an httpx.MockTransport handler.
+"""
+import copy
+import itertools
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+
+import httpx
+from google.api_core.exceptions import Aborted, FailedPrecondition, NotFound, PreconditionFailed, ServiceUnavailable
+from google.cloud.firestore_v1 import transforms
+from google.cloud.firestore_v1.field_path import FieldPath
+
+_EPOCH = datetime(2026, 1, 1, tzinfo=timezone.utc)
+_RESUMABLE_PIECE = 256 * 1024  # GCS persists resumable uploads in whole pieces of this size
+_MISSING = object()
+
+
+def _split(path) -> list:
+    if isinstance(path, FieldPath):
+        return list(path.parts)
+    return list(FieldPath.from_string(path).parts)
+
+
+def _lookup(data: dict, parts: list):
+    for part in parts:
+        if not isinstance(data, dict) or part not in data:
+            return _MISSING
+        data = data[part]
+    return data
+
+
+def _apply(data: dict, parts: list, value):
+    """Write one field (resolving transforms) into a nested dict."""
+    parent = data
+    for part in parts[:-1]:
+        if not isinstance(parent.get(part), dict):
+            parent[part] = {}
+        parent = parent[part]
+    leaf = parts[-1]
+    current = parent.get(leaf, _MISSING)
+    if value is transforms.DELETE_FIELD:
+        parent.pop(leaf, None)
+    elif value is transforms.SERVER_TIMESTAMP:
+        parent[leaf] = datetime.now(timezone.utc)
+    elif isinstance(value, transforms.Increment):
+        base = current if isinstance(current, (int, float)) and current is not _MISSING else 0
+        parent[leaf] = base + value.value
+    elif isinstance(value, transforms.ArrayUnion):
+        items = list(current) if isinstance(current, list) else []
+        items.extend(v for v in value.values if v not in items)
+        parent[leaf] = items
+    elif isinstance(value, transforms.ArrayRemove):
+        items = list(current) if isinstance(current, list) else []
+        parent[leaf] = [v for v in items if v not in value.values]
+    elif isinstance(value, dict):
+        parent[leaf] = {}
+        for key, item in value.items():
+            _apply(parent[leaf], [key], item)
+    else:
+        parent[leaf] = copy.deepcopy(value)
+
+
+def _deep_merge(data: dict, updates: dict):
+    for key, value in updates.items():
+        if isinstance(value, dict) and value and isinstance(data.get(key), dict):
+            _deep_merge(data[key], value)
+        else:
+            _apply(data, [key], value)
+
+
+def _project(data: dict, field_paths) -> dict:
+    projected = {}
+    for path in field_paths:
+        parts = _split(path)
+        value = _lookup(data, parts)
+        if value is not _MISSING:
+            _apply(projected, parts, value)
+    return projected
+
+
+class FakeSnapshot:
+    def __init__(self, reference, data, update_time, create_time=None):
+        self.reference = reference
+        self.id = reference.id
+        self._data = data
+        self.exists = data is not None
+        self.update_time = update_time
+        self.create_time = create_time
+
+    def to_dict(self):
+        return copy.deepcopy(self._data) if self._data is not None else None
+
+    def get(self, field_path):
+        value = _lookup(self._data or {}, _split(field_path))
+        if value is _MISSING:
+            raise KeyError(field_path)
+        return copy.deepcopy(value)
+
+
+class FakeDocumentReference:
+    def __init__(self, db, path: str):
+        self._db = db
+        self.path = path
+        self.id = path.rsplit("/", 1)[-1]
+
+    def __eq__(self, other):
+        return isinstance(other, FakeDocumentReference) and other.path == self.path
+
+    def __hash__(self):
+        return hash(self.path)
+
+    @property
+    def parent(self):
+        return FakeCollectionReference(self._db, self.path.rsplit("/", 1)[0])
+
+    def collection(self, name: str):
+        return FakeCollectionReference(self._db, f"{self.path}/{name}")
+
+    def get(self, field_paths=None, transaction=None, **kwargs):
+        snapshot = self._db._read(self.path, transaction)
+        if field_paths is not None and snapshot.exists:
+            snapshot._data = _project(snapshot._data, field_paths)
+        return snapshot
+
+    def set(self, document_data: dict, merge=False):
+        return self._db._commit_writes([("set", self.path, document_data, merge, None)])
+
+    def create(self, document_data: dict):
+        return self._db._commit_writes([("create", self.path, document_data, False, None)])
+
+    def update(self, field_updates: dict, option=None):
+        return self._db._commit_writes([("update", self.path, field_updates, False, option)])
+
+    def delete(self, option=None):
+        return self._db._commit_writes([("delete", self.path, None, False, option)])
+
+
+class FakeQuery:
+    def __init__(self, db, parent: str, all_descendants: bool = False):
+        self._db = db
+        self._parent = parent
+        self._all_descendants = all_descendants
+        self._filters = []
+        self._orders = []
+        self._limit = None
+        self._start_after = None
+        self._select = None
+
+    def _copy(self, **changes):
+        query = copy.copy(self)
+        query._filters = list(self._filters)
+        query._orders = list(self._orders)
+        for key, value in changes.items():
+            setattr(query, key, value)
+        return query
+
+    def where(self, field_path=None, op_string=None, value=None, filter=None):
+        if filter is not None:
+            field_path, op_string, value = filter.field_path, filter.op_string, filter.value
+        query = self._copy()
+        query._filters.append((field_path, op_string, value))
+        return query
+
+    def order_by(self, field_path, direction="ASCENDING"):
+        query = self._copy()
+        query._orders.append((field_path, direction))
+        return query
+
+    def limit(self, count: int):
+        return self._copy(_limit=count)
+
+    def start_after(self, document_fields_or_snapshot):
+        return self._copy(_start_after=document_fields_or_snapshot)
+
+    def select(self, field_paths):
+        return self._copy(_select=list(field_paths))
+
+    def _field(self, snapshot, field_path):
+        if field_path == "__name__":
+            return snapshot.id
+        return _lookup(snapshot._data, _split(field_path))
+
+    def _matches(self, snapshot) -> bool:
+        for field_path, op, value in self._filters:
+            actual = self._field(snapshot, field_path)
+            if actual is _MISSING:
+                return False
+            if op == "==" and not actual == value:
+                return False
+            if op == "<" and not actual < value:
+                return False
+            if op == "<=" and not actual <= value:
+                return False
+            if op == ">" and not actual > value:
+                return False
+            if op == ">=" and not actual >= value:
+                return False
+            if op == "in" and actual not in value:
+                return False
+            if op == "array_contains" and value not in (actual or []):
+                return False
+        return True
+
+    def _sort_orders(self) -> list:
+        orders = list(self._orders)
+        if not any(field == "__name__" for field, _ in orders):
+            orders.append(("__name__", orders[-1][1] if orders else "ASCENDING"))
+        return orders
+
+    def _sort_key(self, snapshot, orders):
+        return tuple(self._field(snapshot, field) for field, _ in orders)
+
+    def _after_cursor(self, key, cursor, orders) -> bool:
+        for value, cursor_value, (_, direction) in zip(key, cursor, orders):
+            if value == cursor_value:
+                continue
+            greater = value > cursor_value
+            return greater if direction == "ASCENDING" else not greater
+        return False  # equal on every cursor field: the cursor row itself is excluded
+
+    def stream(self, transaction=None):
+        orders = self._sort_orders()
+        snapshots = [
+            s for s in self._db._scan(self._parent, self._all_descendants, transaction)
+            if self._matches(s) and all(self._field(s, field) is not _MISSING for field, _ in orders)
+        ]
+        for index in reversed(range(len(orders))):
+            field, direction = orders[index]
+            snapshots.sort(key=lambda s: self._field(s, field), reverse=direction == "DESCENDING")
+        if self._start_after is not None:
+            if isinstance(self._start_after, FakeSnapshot):
+                cursor = self._sort_key(self._start_after, orders)
+            else:
+                cursor = tuple(self._start_after[field] for field, _ in orders if field in self._start_after)
+            snapshots = [s for s in snapshots if self._after_cursor(self._sort_key(s, orders), cursor, orders)]
+        if self._limit is not None:
+            snapshots = snapshots[:self._limit]
+        if self._select is not None:
+            for snapshot in snapshots:
+                snapshot._data = _project(snapshot._data, self._select)
+        return iter(snapshots)
+
+    def get(self, transaction=None):
+        return list(self.stream(transaction=transaction))
+
+
+class FakeCollectionReference(FakeQuery):
+    def __init__(self, db, path: str):
+        super().__init__(db, path)
+        self.path = path
+        self.id = path.rsplit("/", 1)[-1]
+
+    @property
+    def parent(self):
+        return FakeDocumentReference(self._db, self.path.rsplit("/", 1)[0]) if "/" in self.path else None
+
+    def document(self, document_id=None):
+        return FakeDocumentReference(self._db, f"{self.path}/{document_id or uuid.uuid4().hex[:20]}")
+
+    def add(self, document_data: dict, document_id=None):
+        ref = self.document(document_id)
+        result = ref.create(document_data)
+        return result.update_time, ref
+
+
+class _WriteResult:
+    def __init__(self, update_time):
+        self.update_time = update_time
+
+
+class _LastUpdateOption:
+    def __init__(self, last_update_time):
+        self.last_update_time = last_update_time
+
+
+class FakeWriteBatch:
+    def __init__(self, db):
+        self._db = db
+        self._writes = []
+
+    def set(self, reference, document_data, merge=False):
+        self._writes.append(("set", reference.path, document_data, merge, None))
+
+    def create(self, reference, document_data):
+        self._writes.append(("create", reference.path, document_data, False, None))
+
+    def update(self, reference, field_updates, option=None):
+        self._writes.append(("update", reference.path, field_updates, False, option))
+
+    def delete(self, reference, option=None):
+        self._writes.append(("delete", reference.path, None, False, option))
+
+    def __len__(self):
+        return len(self._writes)
+
+    def commit(self):
+        writes, self._writes = self._writes, []
+        return [self._db._commit_writes(writes)] * len(writes)
+
+
+class FakeTransaction(FakeWriteBatch):
+    """The private surface @firestore.transactional drives, backed by version checks."""
+
+    _read_only = False
+
+    def __init__(self, db, max_attempts: int = 5):
+        super().__init__(db)
+        self._max_attempts = max_attempts
+        self._id = None
+        self._reads = {}
+        self.attempts = 0
+
+    @property
+    def in_progress(self):
+        return self._id is not None
+
+    def _clean_up(self):
+        self._writes = []
+        self._reads = {}
+        self._id = None
+
+    def _begin(self, retry_id=None):
+        self.attempts += 1
+        self._id = uuid.uuid4().bytes
+
+    def _commit(self):
+        writes, reads = self._writes, self._reads
+        self._clean_up()
+        return self._db._commit_writes(writes, reads)
+
+    def _rollback(self):
+        self._clean_up()
+
+    def get(self, ref_or_query, **kwargs):
+        if isinstance(ref_or_query, FakeDocumentReference):
+            return iter([ref_or_query.get(transaction=self, **kwargs)])
+        return ref_or_query.stream(transaction=self)
+
+
+class FakeFirestore:
+    def __init__(self, read_latency: float = 0.0, max_attempts: int = 5):
+        self.read_latency = read_latency
+        # Firestore makes contending transactions wait on locks; optimistic
+        # retries need more attempts to let every contender through
+        self.max_attempts = max_attempts
+        self._lock = threading.RLock()
+        self._docs = {}  # path -> (data, version, update_time, create_time)
+        self._clock = itertools.count(1)
+        self.aborted_commits = 0
+
+    def collection(self, name: str):
+        return FakeCollectionReference(self, name)
+
+    def collection_group(self, name: str):
+        query = FakeQuery(self, name, all_descendants=True)
+        return query
+
+    def document(self, path: str):
+        return FakeDocumentReference(self, path)
+
+    def batch(self):
+        return FakeWriteBatch(self)
+
+    def transaction(self, max_attempts=None, **kwargs):
+        return FakeTransaction(self, max_attempts=max_attempts or self.max_attempts)
+
+    def write_option(self, last_update_time=None, **kwargs):
+        return _LastUpdateOption(last_update_time)
+
+    # -- storage --
+
+    def _pause(self):
+        if self.read_latency:
+            time.sleep(self.read_latency)
+
+    def _read(self, path: str, transaction=None) -> FakeSnapshot:
+        with self._lock:
+            data, version, update_time, create_time = self._docs.get(path, (None, 0, None, None))
+            snapshot = FakeSnapshot(FakeDocumentReference(self, path), copy.deepcopy(data), update_time, create_time)
+        if transaction is not None:
+            transaction._reads.setdefault(path, version)
+        self._pause()  # the response's way back: others may write meanwhile
+        return snapshot
+
+    def _scan(self, parent: str, all_descendants: bool, transaction=None) -> list:
+        with self._lock:
+            snapshots = []
+            for path, (data, version, update_time, create_time) in self._docs.items():
+                collection, _ = path.rsplit("/", 1)
+                if all_descendants:
+                    if collection.rsplit("/", 1)[-1] != parent:
+                        continue
+                elif collection != parent:
+                    continue
+                if transaction is not None:
+                    transaction._reads.setdefault(path, version)
+                snapshots.append(FakeSnapshot(FakeDocumentReference(self, path), copy.deepcopy(data), update_time, create_time))
+        self._pause()
+        return snapshots
+
+    def _commit_writes(self, writes: list, reads: dict = None) -> _WriteResult:
+        with self._lock:
+            for path, version in (reads or {}).items():
+                if self._docs.get(path, (None, 0))[1] != version:
+                    self.aborted_commits += 1
+                    raise Aborted(f"Transaction lock timeout on {path}")
+            for op, path, data, merge, option in writes:
+                current = self._docs.get(path)
+                if op == "create" and current:
+                    raise FailedPrecondition(f"Document already exists: {path}")
+                if op == "update" and not current:
+                    raise NotFound(f"No document to update: {path}")
+                if option is not None and (not current or current[2] != option.last_update_time):
+                    raise FailedPrecondition(f"Document {path} was updated since last_update_time")
+            update_time = _EPOCH + timedelta(microseconds=next(self._clock))
+            staged = dict(self._docs)
+            for op, path, data, merge, option in writes:
+                current = staged.get(path)
+                existing = copy.deepcopy(current[0]) if current else {}
+                if op == "delete":
+                    staged.pop(path, None)
+                    continue
+                if op in ("set", "create") and not merge:
+                    document = {}
+                    _deep_merge(document, data)
+                elif op == "set" and merge is True:
+                    document = existing
+                    _deep_merge(document, data)
+                elif op == "set":
+                    document = existing
+                    for field in merge:
+                        parts = _split(field)
+                        value = _lookup(data, parts)
+                        if value is not _MISSING:
+                            _apply(document, parts, value)
+                else:
+                    document = existing
+                    for field, value in data.items():
+                        _apply(document, _split(field), value)
+                version = current[1] + 1 if current else 1
+                create_time = current[3] if current else update_time
+                staged[path] = (document, version, update_time, create_time)
+            self._docs = staged
+            return _WriteResult(update_time)
+
+    # -- test helpers --
+
+    def data(self, path: str):
+        """The stored document at path (a copy), or None."""
+        with self._lock:
+            entry = self._docs.get(path)
+            return copy.deepcopy(entry[0]) if entry else None
+
+    def paths(self, collection: str) -> list:
+        with self._lock:
+            return sorted(p for p in self._docs if p.rsplit("/", 1)[0] == collection)
+
+
+class FakeBlob:
+    def __init__(self, bucket, name: str):
+        self.bucket = bucket
+        self.name = name
+        self.generation = None
+        self.size = None
+        self.content_type = None
+
+    @property
+    def public_url(self):
+        return f"https://storage.example/{self.bucket.name}/{self.name}"
+
+    def _load(self, entry):
+        self.generation = entry["generation"]
+        self.size = len(entry["data"])
+        self.content_type = entry["content_type"]
+
+    def upload_from_string(self, data, content_type=None, if_generation_match=None, **kwargs):
+        if isinstance(data, str):
+            data = data.encode()
+        self._load(self.bucket._write(self.name, data, content_type, if_generation_match))
+
+    def upload_from_file(self, file_obj, content_type=None, if_generation_match=None, rewind=False, **kwargs):
+        if rewind:
+            file_obj.seek(0)
+        self.upload_from_string(file_obj.read(), content_type=content_type, if_generation_match=if_generation_match)
+
+    def create_resumable_upload_session(self, content_type=None, size=None, **kwargs):
+        return self.bucket._open_upload_session(self.name, content_type, size)
+
+    def download_to_file(self, file_obj, **kwargs):
+        file_obj.write(self.bucket._entry(self.name)["data"])
+
+    def download_as_bytes(self, **kwargs):
+        return self.bucket._entry(self.name)["data"]
+
+    def exists(self, **kwargs):
+        with self.bucket._lock:
+            return self.name in self.bucket.objects
+
+    def reload(self, **kwargs):
+        self._load(self.bucket._entry(self.name))
+
+    def delete(self, if_generation_match=None, **kwargs):
+        with self.bucket._lock:
+            entry = self.bucket.objects.get(self.name)
+            if entry is None:
+                raise NotFound(f"No such object: {self.name}")
+            if if_generation_match is not None and entry["generation"] != if_generation_match:
+                raise PreconditionFailed(f"Generation mismatch for {self.name}")
+            del self.bucket.objects[self.name]
+
+    def generate_signed_url(self, version="v4", expiration=None, method="GET", **kwargs):
+        self.bucket.signed_urls += 1
+        return f"https://signed.example/{self.name}?sig={self.bucket.signed_urls}"
+
+
+class FakeBucket:
+    def __init__(self, name: str = "test-bucket", upload_latency: float = 0.0):
+        self.name = name
+        self.upload_latency = upload_latency
+        self.objects = {}  # name -> {"data", "generation", "content_type"}
+        self.fail_uploads = 0  # the next N uploads raise ServiceUnavailable
+        self.interrupt_chunks = 0  # the next N resumable chunks keep one piece, then drop the connection
+        self.upload_sessions = {}  # session URL -> {"name", "content_type", "size", "data"}
+        self.uploads = 0
+        self.signed_urls = 0
+        self._lock = threading.RLock()
+        self._generations = itertools.count(1000)
+
+    def blob(self, name: str):
+        return FakeBlob(self, name)
+
+    def get_blob(self, name: str, **kwargs):
+        with self._lock:
+            entry = self.objects.get(name)
+            if entry is None:
+                return None
+            blob = FakeBlob(self, name)
+            blob._load(entry)
+            return blob
+
+    def rename_blob(self, blob, new_name: str, **kwargs):
+        with self._lock:
+            self.objects[new_name] = self.objects.pop(blob.name)
+            return self.get_blob(new_name)
+
+    def _open_upload_session(self, name: str, content_type, size: int) -> str:
+        url = f"https://storage.example/upload/{self.name}/{uuid.uuid4().hex}"
+        with self._lock:
+            self.upload_sessions[url] = {"name": name, "content_type": content_type, "size": size, "data": bytearray()}
+        return url
+
+    def expire_upload_session(self, url: str):
+        """Forget a resumable session, as GCS does a week after it was opened."""
+        with self._lock:
+            del self.upload_sessions[url]
+
+    async def handle_upload_session(self, request: httpx.Request) -> httpx.Response:
+        """PUT to a resumable session URL: a chunk ("bytes a-b/N") or a status query ("bytes */N")."""
+        body = await request.aread()
+        with self._lock:
+            session = self.upload_sessions.get(str(request.url))
+            if session is None:
+                return httpx.Response(404, text="No such upload session")
+            data = session["data"]
+            spec = request.headers["Content-Range"].split(" ", 1)[1].split("/", 1)[0]
+            if spec != "*" and int(spec.split("-", 1)[0]) == len(data) < session["size"]:
+                if self.interrupt_chunks and len(body) > _RESUMABLE_PIECE:
+                    self.interrupt_chunks -= 1
+                    data += body[:_RESUMABLE_PIECE]
+                    raise httpx.ReadError("Connection dropped mid-chunk", request=request)
+                data += body
+                if len(data) == session["size"]:
+                    self._write(session["name"], bytes(data), session["content_type"], None)
+            if len(data) == session["size"]:
+                return httpx.Response(200, json={"name": session["name"], "size": str(len(data))})
+            headers = {"Range": f"bytes=0-{len(data) - 1}"} if data else {}
+            return httpx.Response(308, headers=headers)
+
+    def _entry(self, name: str) -> dict:
+        with self._lock:
+            entry = self.objects.get(name)
+        if entry is None:
+            raise NotFound(f"No such object: {name}")
+        return entry
+
+    def _write(self, name: str, data: bytes, content_type, if_generation_match) -> dict:
+        if self.upload_latency:
+            time.sleep(self.upload_latency)
+        with self._lock:
+            if self.fail_uploads:
+                self.fail_uploads -= 1
+                raise ServiceUnavailable(f"Upload of {name} failed")
+            current = self.objects.get(name)
+            if if_generation_match is not None and (current["generation"] if current else 0) != if_generation_match:
+                raise PreconditionFailed(f"Generation mismatch for {name}")
+            self.uploads += 1
+            entry = {"data": bytes(data), "generation": next(self._generations), "content_type": content_type}
+            self.objects[name] = entry
+            return entry
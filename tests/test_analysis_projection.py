@@ -0,0 +1,137 @@
+import asyncio
+
+import testapp
+from app_client import MockUpstream, app_client, seed_user, submit_analysis
+
+SECTIONS = {
+    "brand_compliance": {"score": 81, "notes": "on brand"},
+    "channel_compliance": {"facebook": "ok"},
+    "content_analysis": {"intent": "launch"},
+    "metaphor_analysis": {"resonance": 0.7},
+}
+PAYLOAD = {"results": SECTIONS, "summary": "solid"}  # the model response; stored under data
+PLAN_FEATURES = ["resonance_index", "brand_compliance", "messaging_intent", "content_analysis"]
+
+
+def read_both(upstream, artifact_id: str) -> tuple:
+    async def scenario():
+        async with app_client(upstream) as client:
+            details = (await client.get("/get-analysis-details/user-1")).json()
+            by_id = (await client.get(f"/get-analysis-by-id/{artifact_id}")).json()
+        return details["analysis_details"][0], by_id["analysis"]
+
+    return asyncio.run(scenario())
+
+
+def comprehensive(analysis: dict) -> dict:
+    return analysis["ai_analysis_results"]["comprehensive-analysis"]["data"]
+
+
+def record_reads(monkeypatch) -> list:
+    """Field paths of every analysis document read by ID."""
+    fields_read = []
+    fs_get = testapp.fs_get
+
+    async def recording_get(doc_ref, field_paths=None):
+        if doc_ref.path.startswith("user_analysis/"):
+            fields_read.append(field_paths)
+        return await fs_get(doc_ref, field_paths=field_paths)
+
+    monkeypatch.setattr(testapp, "fs_get", recording_get)
+    return fields_read
+
+
+def test_sections_are_stored_per_feature(store):
+    db, _ = store
+    seed_user(db, selected_features=PLAN_FEATURES)
+    upstream = MockUpstream(PAYLOAD)
+
+    async def scenario():
+        async with app_client(upstream) as client:
+            return (await submit_analysis(client)).json()
+
+    response = asyncio.run(scenario())
+
+    stored = db.data(f"user_analysis/{response['artifactId']}")
+    assert stored["feature_results"] == SECTIONS
+    assert stored["feature_sections"] == list(SECTIONS)
+    assert stored["projectionVersion"] == testapp.ANALYSIS_PROJECTION_VERSION
+    assert "results" not in comprehensive(stored)
+    assert comprehensive(stored)["summary"] == "solid"
+    # The submitter still gets every section back
+    assert comprehensive(response)["results"] == SECTIONS
+
+
+def test_both_reads_return_only_the_plan_sections(store, monkeypatch):
+    db, _ = store
+    seed_user(db, selected_features=PLAN_FEATURES)
+    upstream = MockUpstream(PAYLOAD)
+
+    async def submit():
+        async with app_client(upstream) as client:
+            return (await submit_analysis(client)).json()["artifactId"]
+
+    artifact_id = asyncio.run(submit())
+    fields_read = record_reads(monkeypatch)
+    details, by_id = read_both(upstream, artifact_id)
+
+    expected = {"metaphor_analysis": SECTIONS["metaphor_analysis"], "brand_compliance": SECTIONS["brand_compliance"],
+                "content_analysis": SECTIONS["content_analysis"]}
+    for analysis in (details, by_id):
+        assert comprehensive(analysis)["results"] == expected
+        assert list(comprehensive(analysis)["results"]) == list(expected)
+        assert comprehensive(analysis)["summary"] == "solid"
+        assert analysis["filtered_features"] == list(expected)
+        assert analysis["all_available_features"] == list(SECTIONS)
+        assert "feature_results" not in analysis
+    assert {key: details[key] for key in by_id} == by_id
+    assert fields_read == [None]  # one read of the whole record by ID
+
+
+def test_fields_added_to_the_record_later_are_returned(store):
+    db, _ = store
+    seed_user(db, selected_features=PLAN_FEATURES)
+    upstream = MockUpstream(PAYLOAD)
+
+    async def submit():
+        async with app_client(upstream) as client:
+            return (await submit_analysis(client)).json()["artifactId"]
+
+    artifact_id = asyncio.run(submit())
+    db.collection("user_analysis").document(artifact_id).update({"reviewStatus": "approved"})
+    details, by_id = read_both(upstream, artifact_id)
+
+    assert details["reviewStatus"] == by_id["reviewStatus"] == "approved"
+
+
+def test_analyses_saved_before_the_per_feature_layout_read_the_same(store):
+    db, _ = store
+    seed_user(db, selected_features=PLAN_FEATURES)
+    db.collection("user_analysis").document("legacy").set({
+        "userId": "user-1", "artifact_id": "legacy", "timestamp": "2026-01-01T00:00:00Z",
+        "ai_analysis_results": {"comprehensive-analysis": {"success": True, "data": PAYLOAD}},
+    })
+
+    details, by_id = read_both(MockUpstream(), "legacy")
+
+    for analysis in (details, by_id):
+        assert list(comprehensive(analysis)["results"]) == ["metaphor_analysis", "brand_compliance", "content_analysis"]
+        assert analysis["all_available_features"] == list(SECTIONS)
+
+
+def test_cached_results_are_reassembled_in_full(store):
+    db, _ = store
+    seed_user(db, selected_features=PLAN_FEATURES)
+    upstream = MockUpstream(PAYLOAD)
+
+    async def scenario():
+        async with app_client(upstream) as client:
+            first = (await submit_analysis(client)).json()
+            second = (await submit_analysis(client)).json()
+        return first, second
+
+    first, second = asyncio.run(scenario())
+
+    assert second["cache"]["hit"] is True
+    assert second["ai_analysis_results"] == first["ai_analysis_results"]
+    assert comprehensive(second)["results"] == SECTIONS
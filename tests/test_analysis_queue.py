@@ -0,0 +1,113 @@
+import asyncio
+
+import testapp
+
+
+def seed_plan(db, user_id: str, total_ads: int = 10):
+    db.collection("PlanSelectionDetails").document(user_id).set({
+        "userId": user_id, "planName": "Incivus_Pro", "max_ads_per_month": 10, "totalAds": total_ads,
+    })
+
+
+async def queued_job(bucket, user_id: str, n: int) -> dict:
+    artifact_id = f"artifact-{n}"
+    storage_path = f"{user_id}/media/{artifact_id}.png"
+    bucket.blob(storage_path).upload_from_string(b"png", content_type="image/png")
+    return {
+        "userId": user_id,
+        "brandId": "brand-1",
+        "adTitle": f"Ad {n}",
+        "artifact_id": artifact_id,
+        "storage_path": storage_path,
+        "stage_timings": None,
+        "quota_reservation": await testapp.reserve_ad_quota(user_id, artifact_id),
+    }
+
+
+def test_shutdown_fails_running_and_queued_jobs_and_returns_their_quota(store, monkeypatch):
+    db, bucket = store
+    seed_plan(db, "user-1")
+    started = asyncio.Event()
+
+    async def never_finishes(job, media_file):
+        started.set()
+        await asyncio.Event().wait()
+
+    monkeypatch.setattr(testapp, "ANALYSIS_WORKERS", 1)
+    monkeypatch.setattr(testapp, "run_analysis_job", never_finishes)
+
+    async def scenario():
+        await testapp.start_analysis_workers()
+        for n in range(3):
+            await testapp.enqueue_analysis_job(await queued_job(bucket, "user-1", n))
+        await asyncio.wait_for(started.wait(), 5)
+        assert db.data("PlanSelectionDetails/user-1")["totalAds"] == 7
+        await testapp.stop_analysis_workers()
+
+    asyncio.run(scenario())
+
+    for n in range(3):
+        job = db.data(f"analysis_jobs/artifact-{n}")
+        assert job["status"] == "failed"
+        assert job["error"] == testapp.ANALYSIS_SHUTDOWN_ERROR
+    plan = db.data("PlanSelectionDetails/user-1")
+    assert plan["totalAds"] == 10
+    assert plan["adsUsed"] == 0
+    assert not plan.get("quotaReservations")
+    assert testapp.analysis_queue.empty()
+
+
+def test_shutdown_keeps_a_job_that_was_already_charged_done(store, monkeypatch):
+    db, bucket = store
+    seed_plan(db, "user-1")
+    stored = asyncio.Event()
+
+    async def stored_then_interrupted(job, media_file):
+        await testapp.commit_ad_quota(job["quota_reservation"])
+        stored.set()
+        await asyncio.Event().wait()
+
+    monkeypatch.setattr(testapp, "ANALYSIS_WORKERS", 1)
+    monkeypatch.setattr(testapp, "run_analysis_job", stored_then_interrupted)
+
+    async def scenario():
+        await testapp.start_analysis_workers()
+        await testapp.enqueue_analysis_job(await queued_job(bucket, "user-1", 0))
+        await asyncio.wait_for(stored.wait(), 5)
+        await testapp.stop_analysis_workers()
+
+    asyncio.run(scenario())
+
+    assert db.data("analysis_jobs/artifact-0")["status"] == "done"
+    assert db.data("PlanSelectionDetails/user-1")["totalAds"] == 9
+
+
+def test_job_turned_away_by_a_full_queue_is_failed_and_refunded(store, monkeypatch):
+    db, bucket = store
+    seed_plan(db, "user-1")
+    monkeypatch.setattr(testapp, "analysis_queue", None)
+
+    async def scenario():
+        testapp.analysis_queue = asyncio.Queue(maxsize=1)
+        jobs = [await queued_job(bucket, "user-1", n) for n in range(2)]
+        # Both pass the full() check before either is put on the queue
+        return await asyncio.gather(*(testapp.enqueue_analysis_job(job) for job in jobs), return_exceptions=True)
+
+    results = asyncio.run(scenario())
+
+    assert results[0] is None
+    assert isinstance(results[1], testapp.HTTPException) and results[1].status_code == 503
+    assert testapp.analysis_queue.qsize() == 1
+    assert db.data("analysis_jobs/artifact-0")["status"] == "queued"
+    rejected = db.data("analysis_jobs/artifact-1")
+    assert (rejected["status"], rejected["error"]) == ("failed", testapp.ANALYSIS_QUEUE_FULL_ERROR)
+    assert db.data("PlanSelectionDetails/user-1")["totalAds"] == 9
+
+
+def test_workers_stop_before_the_clients_they_use_are_closed():
+    order = [handler.__name__ for handler in testapp.app.router.on_shutdown]
+
+    workers = order.index("stop_analysis_workers")
+    assert workers < order.index("stop_upstream_client")
+    assert workers < order.index("stop_video_process_pool")
+    assert order[-1] == "shutdown_io_executor"
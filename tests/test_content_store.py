@@ -0,0 +1,109 @@
+import asyncio
+import hashlib
+import tempfile
+
+import pytest
+from google.api_core.exceptions import ServiceUnavailable
+
+import testapp
+from app_client import MockUpstream, app_client, seed_user, submit_analysis
+
+CONTENT = b"the same creative, uploaded again"
+PATH = testapp.CAS_PREFIX + hashlib.sha256(CONTENT).hexdigest()
+REF = "blobRefs/" + hashlib.sha256(CONTENT).hexdigest()
+
+
+def media_file(data: bytes = CONTENT):
+    file_obj = tempfile.TemporaryFile()
+    file_obj.write(data)
+    file_obj.seek(0)
+    return file_obj
+
+
+async def store_copies(count: int) -> list:
+    return await asyncio.gather(*(testapp.gcs_store_content_addressed(media_file(), "image/png") for _ in range(count)))
+
+
+def test_concurrent_stores_upload_once_and_release_deletes_after_the_last(store):
+    db, bucket = store
+    bucket.upload_latency = 0.01
+
+    blobs = asyncio.run(store_copies(5))
+
+    assert bucket.uploads == 1
+    assert {blob.name for blob in blobs} == {PATH}
+    ref = db.data(REF)
+    assert ref["refCount"] == 5
+    assert ref["generation"] == bucket.objects[PATH]["generation"]
+
+    async def release_all():
+        return [await testapp.gcs_release(PATH) for _ in range(5)]
+
+    assert asyncio.run(release_all()) == [False] * 4 + [True]
+    assert PATH not in bucket.objects
+    assert db.data(REF) is None
+
+
+def test_failed_first_upload_records_no_reference(store):
+    db, bucket = store
+    bucket.fail_uploads = 1
+
+    with pytest.raises(ServiceUnavailable):
+        asyncio.run(testapp.gcs_store_content_addressed(media_file(), "image/png"))
+    assert db.data(REF) is None
+
+    asyncio.run(testapp.gcs_store_content_addressed(media_file(), "image/png"))
+
+    assert db.data(REF)["refCount"] == 1
+    assert db.data(REF)["generation"] == bucket.objects[PATH]["generation"]
+
+
+def test_reference_left_without_an_object_is_not_deduplicated_against(store):
+    db, bucket = store
+    # Left by a process that counted its reference and died before uploading
+    db.document(REF).set({"refCount": 2, "storagePath": PATH, "generation": None})
+
+    asyncio.run(testapp.gcs_store_content_addressed(media_file(), "image/png"))
+
+    assert PATH in bucket.objects
+    assert db.data(REF)["refCount"] == 3
+    assert db.data(REF)["generation"] == bucket.objects[PATH]["generation"]
+
+
+def test_store_during_a_release_does_not_lose_the_object(store):
+    db, bucket = store
+    bucket.blob(PATH).upload_from_string(CONTENT)
+    released_generation = bucket.objects[PATH]["generation"]
+    # The last reference was dropped; the releaser has not deleted the object yet
+    db.document(REF).set({"refCount": 0, "storagePath": PATH, "generation": released_generation})
+
+    asyncio.run(testapp.gcs_store_content_addressed(media_file(), "image/png"))
+    stalled_release = asyncio.run(testapp._finish_blob_release(PATH, testapp._blob_ref(REF.split("/")[1]), released_generation))
+
+    assert stalled_release is False
+    assert bucket.objects[PATH]["generation"] != released_generation
+    assert db.data(REF)["refCount"] == 1
+    assert db.data(REF)["generation"] == bucket.objects[PATH]["generation"]
+
+
+def test_failed_analysis_releases_its_media_reference(store, monkeypatch):
+    db, bucket = store
+    seed_user(db, logo=False)
+    monkeypatch.setattr(testapp, "CAS_ENABLED", True)
+
+    async def submit(status: int):
+        async with app_client(MockUpstream(status=status)) as client:
+            return await submit_analysis(client, media=CONTENT, bypassCache="true")
+
+    failed = asyncio.run(submit(500))
+    assert failed.status_code == 500
+    assert bucket.get_blob(PATH) is None
+    assert db.data(REF) is None
+
+    stored = asyncio.run(submit(200))
+    failed_again = asyncio.run(submit(500))
+
+    assert (stored.status_code, failed_again.status_code) == (200, 500)
+    assert db.data(REF)["refCount"] == 1  # only the stored analysis refers to it
+    assert bucket.get_blob(PATH) is not None
+    assert db.data("PlanSelectionDetails/user-1")["totalAds"] == 9
@@ -0,0 +1,32 @@
+"""The queries that need more than Firestore's automatic indexes have them in firestore.indexes.json."""
+import json
+import os
+
+import pytest
+
+INDEX_CONFIG = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "firestore.indexes.json")
+
+
+@pytest.fixture(scope="module")
+def index_config():
+    with open(INDEX_CONFIG) as f:
+        return json.load(f)
+
+
+def test_brand_media_collection_group_query_is_indexed(index_config):
+    # load_user_brand_media: collection_group("media").where("userId", "==", ...)
+    override = next(o for o in index_config["fieldOverrides"] if (o["collectionGroup"], o["fieldPath"]) == ("media", "userId"))
+
+    assert {"order": "ASCENDING", "queryScope": "COLLECTION_GROUP"} in override["indexes"]
+    # An override replaces the automatic indexes, so the collection-scope ones are kept
+    assert {"order": "ASCENDING", "queryScope": "COLLECTION"} in override["indexes"]
+
+
+def test_analysis_history_pages_are_indexed(index_config):
+    # paginate_by_timestamp on user_analysis.where("userId", "==", ...)
+    fields = [
+        [(f["fieldPath"], f["order"]) for f in index["fields"]]
+        for index in index_config["indexes"] if index["collectionGroup"] == "user_analysis"
+    ]
+
+    assert [("userId", "ASCENDING"), ("timestamp", "DESCENDING"), ("__name__", "DESCENDING")] in fields
@@ -0,0 +1,67 @@
+import asyncio
+import tempfile
+
+import pytest
+
+Image = pytest.importorskip("PIL.Image")
+
+import testapp  # noqa: E402
+
+
+@pytest.fixture
+def preprocessing(monkeypatch):
+    monkeypatch.setattr(testapp, "IMAGE_PREPROCESS_ENABLED", True)
+    monkeypatch.setattr(testapp, "IMAGE_MAX_DIMENSION", 256)
+    monkeypatch.setattr(testapp, "image_preprocess_stats", dict.fromkeys(testapp.image_preprocess_stats, 0))
+
+
+def png_file(size: tuple, mode: str = "RGB"):
+    image = Image.effect_noise(size, 64).convert(mode)
+    file_obj = tempfile.TemporaryFile()
+    image.save(file_obj, format="PNG")
+    file_obj.seek(0)
+    return file_obj
+
+
+def test_large_image_is_downsized_and_reencoded(preprocessing):
+    original = png_file((1200, 600))
+
+    media = asyncio.run(testapp.preprocess_image(original, "creative.png", "image/png"))
+
+    assert media["file"] is not original
+    assert media["filename"] == "creative.jpg"
+    assert media["content_type"] == "image/jpeg"
+    assert media["preprocessing"]["originalDimensions"] == [1200, 600]
+    assert media["preprocessing"]["dimensions"] == [256, 128]
+    assert media["preprocessing"]["bytesAfter"] < media["preprocessing"]["bytesBefore"]
+    with Image.open(media["file"]) as sent:
+        assert sent.size == (256, 128)
+    assert testapp.image_preprocess_stats["processed"] == 1
+
+
+def test_small_image_is_sent_as_is(preprocessing):
+    original = png_file((200, 100))
+
+    media = asyncio.run(testapp.preprocess_image(original, "creative.png", "image/png"))
+
+    assert media == {"file": original, "filename": "creative.png", "content_type": "image/png", "preprocessing": None}
+    assert testapp.image_preprocess_stats["skipped"] == 1
+
+
+def test_stage_off_or_other_media_keeps_the_original(preprocessing, monkeypatch):
+    original = png_file((1200, 600))
+
+    video = asyncio.run(testapp.preprocess_image(original, "creative.mp4", "video/mp4"))
+    monkeypatch.setattr(testapp, "IMAGE_PREPROCESS_ENABLED", False)
+    disabled = asyncio.run(testapp.preprocess_image(original, "creative.png", "image/png"))
+
+    assert video["file"] is original and video["preprocessing"] is None
+    assert disabled["file"] is original and disabled["preprocessing"] is None
+    assert testapp.image_preprocess_variant("image/png") == ""
+
+
+def test_result_cache_variant_follows_the_settings(preprocessing, monkeypatch):
+    assert testapp.image_preprocess_variant("image/png") == f"img256q{testapp.IMAGE_JPEG_QUALITY}"
+    assert testapp.image_preprocess_variant("video/mp4") == ""
+    monkeypatch.setattr(testapp, "IMAGE_MAX_DIMENSION", 512)
+    assert testapp.image_preprocess_variant("image/png") == f"img512q{testapp.IMAGE_JPEG_QUALITY}"
@@ -0,0 +1,96 @@
+"""
+Firestore/GCS calls run on the I/O executor, not on the event loop. The fake
+store's reads are held on a gate that only a coroutine on the loop can open:
+if a handler called the client inline, the loop would be stuck inside the read
+and the gate would time out instead.
+"""
+import asyncio
+import os
+import sys
+import threading
+
+import httpx
+
+import testapp
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmarks"))
+
+import bench_concurrency  # noqa: E402
+
+GATE_TIMEOUT = 5.0
+
+
+class GatedReads:
+    """Replaces FakeFirestore._pause: every read blocks until `gate` is set."""
+
+    def __init__(self):
+        self.gate = threading.Event()
+        self.lock = threading.Lock()
+        self.active = 0
+        self.peak = 0
+        self.opened = []
+
+    def __call__(self):
+        with self.lock:
+            self.active += 1
+            self.peak = max(self.peak, self.active)
+        try:
+            self.opened.append(self.gate.wait(GATE_TIMEOUT))
+        finally:
+            with self.lock:
+                self.active -= 1
+
+    async def wait_for_active(self, count: int):
+        """Yield to the loop until `count` reads are blocked at the gate."""
+        for _ in range(int(GATE_TIMEOUT / 0.01)):
+            if self.active >= count:
+                return True
+            await asyncio.sleep(0.01)
+        return False
+
+
+async def get_profiles(user_ids, reads: GatedReads):
+    transport = httpx.ASGITransport(app=testapp.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        requests = asyncio.gather(*(client.get(f"/get-user-profile/{user_id}") for user_id in user_ids))
+        blocked = await reads.wait_for_active(len(user_ids))
+        reads.gate.set()
+        return blocked, await requests
+
+
+def test_event_loop_keeps_running_while_a_read_blocks(store, monkeypatch):
+    db, _ = store
+    db.collection("userProfileDetails").document("reader").set({"userId": "reader"})
+    reads = GatedReads()
+    monkeypatch.setattr(db, "_pause", reads)
+
+    blocked, responses = asyncio.run(get_profiles(["reader"], reads))
+
+    assert blocked
+    assert reads.opened == [True]  # opened from the loop, not by the timeout
+    assert [response.status_code for response in responses] == [200]
+
+
+def test_reads_from_concurrent_requests_overlap(store, monkeypatch):
+    db, _ = store
+    user_ids = [f"user-{n}" for n in range(4)]
+    for user_id in user_ids:
+        db.collection("userProfileDetails").document(user_id).set({"userId": user_id})
+    reads = GatedReads()
+    monkeypatch.setattr(db, "_pause", reads)
+
+    blocked, responses = asyncio.run(get_profiles(user_ids, reads))
+
+    assert blocked
+    assert reads.peak == len(user_ids)
+    assert all(reads.opened)
+    assert [response.json()["userId"] for response in responses] == user_ids
+
+
+def test_analyses_wait_on_upstream_together(store):
+    result = asyncio.run(bench_concurrency.run_benchmark(
+        analyses=4, gets=4, get_concurrency=2, upstream_seconds=0.2, io_latency=0.0,
+    ))
+
+    assert result["analysis_statuses"] == {"200": 4}
+    assert result["peak_upstream_in_flight"] > 1
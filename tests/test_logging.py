@@ -0,0 +1,75 @@
+import io
+import json
+import threading
+
+import pytest
+
+import testapp
+
+
+class ThreadRecordingFormatter(testapp.JsonLogFormatter):
+    """Records which threads produced output lines."""
+
+    def __init__(self):
+        super().__init__()
+        self.threads = []
+
+    def format(self, record):
+        self.threads.append(threading.current_thread())
+        return super().format(record)
+
+
+def only_app_handler(monkeypatch):
+    """pytest adds its capture handlers to every logger for the test call; leave only the app's."""
+    monkeypatch.setattr(testapp.logger, "handlers", [testapp._log_queue_handler])
+
+
+@pytest.fixture
+def log_output(monkeypatch):
+    """JSON log lines written by the listener; call it to flush the queue first."""
+    stream = io.StringIO()
+    monkeypatch.setattr(testapp._log_output, "stream", stream)
+    formatter = ThreadRecordingFormatter()
+    monkeypatch.setattr(testapp._log_output, "formatter", formatter)
+
+    def flush():
+        testapp.log_listener.stop()  # drains the queue
+        testapp.log_listener.start()
+        return [json.loads(line) for line in stream.getvalue().splitlines()]
+
+    flush.formatter = formatter
+    return flush
+
+
+def test_lines_are_formatted_on_the_listener_thread(log_output, monkeypatch):
+    only_app_handler(monkeypatch)
+
+    testapp.logger.warning("analysis %s stored", "a-1")
+    lines = log_output()
+
+    assert lines[-1]["message"] == "analysis a-1 stored"
+    assert log_output.formatter.threads
+    assert threading.main_thread() not in log_output.formatter.threads
+
+
+def test_message_is_fixed_when_logged(log_output, monkeypatch):
+    only_app_handler(monkeypatch)
+    analysis_data = {"status": "received"}
+
+    testapp.logger.warning("Analysis data: %s", analysis_data)
+    analysis_data["status"] = "projected"
+    lines = log_output()
+
+    assert lines[-1]["message"] == "Analysis data: {'status': 'received'}"
+
+
+def test_exceptions_are_logged_with_their_traceback(log_output, monkeypatch):
+    only_app_handler(monkeypatch)
+    try:
+        raise ValueError("upstream said no")
+    except ValueError:
+        testapp.logger.warning("Analysis failed", exc_info=True)
+    entry = log_output()[-1]
+
+    assert entry["message"] == "Analysis failed"
+    assert "ValueError: upstream said no" in entry["exc_info"]
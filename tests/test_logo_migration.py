@@ -0,0 +1,50 @@
+import asyncio
+import base64
+
+import testapp
+
+LOGOS = [
+    {"logoFilename": f"logo-{n}.png", "logoContentType": "image/png", "logoBase64": base64.b64encode(b"png-%d" % n).decode()}
+    for n in range(3)
+]
+
+
+def seed_brands(db, count: int = 3):
+    for n in range(count):
+        db.collection("brandData").document(f"brand-{n}").set({
+            "userId": "user-1", "brandName": f"Acme {n}", "brandId": f"brand-{n}", "logos": LOGOS,
+        })
+
+
+def test_running_the_migration_twice_moves_each_logo_once(store):
+    db, bucket = store
+    seed_brands(db)
+
+    first = asyncio.run(testapp.run_logo_migration())
+    second = asyncio.run(testapp.run_logo_migration())
+
+    assert (first["brandsMigrated"], first["logosMigrated"]) == (3, 9)
+    assert (second["brandsMigrated"], second["logosMigrated"]) == (0, 0)
+    for n in range(3):
+        brand = db.data(f"brandData/brand-{n}")
+        assert "logos" not in brand
+        assert brand["mediaCount"] == 3
+        assert len(db.paths(f"brandData/brand-{n}/media")) == 3
+
+
+def test_overlapping_migrations_of_one_brand_count_its_logos_once(store):
+    db, bucket = store
+    seed_brands(db, count=1)
+    bucket.upload_latency = 0.01
+    snapshot = db.collection("brandData").document("brand-0").get()
+
+    async def overlap():
+        return await asyncio.gather(testapp.migrate_brand_logos(snapshot), testapp.migrate_brand_logos(snapshot))
+
+    moved = asyncio.run(overlap())
+
+    assert sorted(moved) == [0, 3]
+    brand = db.data("brandData/brand-0")
+    assert brand["mediaCount"] == 3
+    assert "logos" not in brand
+    assert len(db.paths("brandData/brand-0/media")) == 3
@@ -0,0 +1,67 @@
+import asyncio
+import os
+import tempfile
+
+import pytest
+
+import testapp
+from app_client import MockUpstream, app_client, seed_user, submit_analysis
+
+MEDIA = bytes(range(256)) * 40  # 10 KiB, distinct bytes at every offset within 256
+
+
+@pytest.fixture
+def spooled_media():
+    """An upload as Starlette hands it over: spooled to disk, positioned at its end."""
+    media_file = tempfile.SpooledTemporaryFile(max_size=1024)
+    media_file.write(MEDIA)
+    yield media_file
+    media_file.close()
+
+
+def test_reader_serves_ranges_from_any_offset(spooled_media):
+    with testapp._open_media_reader(spooled_media) as reader:
+        reader.seek(1000)
+        assert reader.read(300) == MEDIA[1000:1300]
+        reader.seek(-100, os.SEEK_END)
+        assert reader.read() == MEDIA[-100:]
+        assert reader.read(10) == b""
+        reader.seek(5)
+        reader.seek(20, os.SEEK_CUR)
+        assert reader.read(3) == MEDIA[25:28]
+        reader.seek(len(MEDIA) + 50)
+        assert reader.read(10) == b""
+
+
+def test_readers_of_one_upload_keep_their_own_positions(spooled_media, monkeypatch):
+    monkeypatch.setattr(testapp, "MEDIA_CHUNK_SIZE", 512)
+    first, second = testapp._open_media_reader(spooled_media), testapp._open_media_reader(spooled_media)
+    with first, second:
+        chunks_first, chunks_second = [], []
+        while True:
+            a, b = first.read(700), second.read(300)
+            chunks_first.append(a)
+            chunks_second.append(b)
+            if not a and not b:
+                break
+
+    assert b"".join(chunks_first) == MEDIA
+    assert b"".join(chunks_second) == MEDIA
+    assert spooled_media.tell() == len(MEDIA)  # the upload's own position is left alone
+
+
+def test_upload_is_stored_and_sent_upstream_whole(store, monkeypatch):
+    db, bucket = store
+    seed_user(db)
+    monkeypatch.setattr(testapp, "MEDIA_CHUNK_SIZE", 512)
+    upstream = MockUpstream()
+
+    async def run():
+        async with app_client(upstream) as client:
+            return await submit_analysis(client, media=MEDIA, bypassCache="true")
+
+    response = asyncio.run(run())
+
+    assert response.status_code == 200
+    assert [MEDIA in body for _, body in upstream.calls] == [True]
+    assert MEDIA in [entry["data"] for entry in bucket.objects.values()]
@@ -0,0 +1,86 @@
+import asyncio
+
+import pytest
+
+import testapp
+from app_client import MockUpstream, app_client
+
+
+@pytest.fixture
+def firestore_ops(monkeypatch):
+    """Firestore operation counts recorded during the test, by (route, op)."""
+    counts = {}
+    monkeypatch.setattr(testapp, "firestore_op_counts", counts)
+    return counts
+
+
+@testapp.fs_transactional
+def bump_in_transaction(transaction, doc_ref, interfere: list):
+    snapshot = testapp.tx_get(transaction, doc_ref)
+    if interfere:
+        doc_ref.set({"n": interfere.pop()})  # a concurrent writer: this attempt must retry
+    transaction.update(doc_ref, {"n": snapshot.get("n") + 1})
+
+
+def test_access_layer_counts_documents_by_route(store, firestore_ops):
+    db, _ = store
+    doc_ref = db.collection("counters").document("c")
+
+    async def run():
+        token = testapp.metrics_route.set("/test")
+        try:
+            await testapp.fs_set(doc_ref, {"n": 0})
+            await testapp.fs_get(doc_ref)
+            await testapp.fs_stream(db.collection("empty"))
+            batch = db.batch()
+            batch.set(db.collection("counters").document("a"), {"n": 1})
+            batch.set(db.collection("counters").document("b"), {"n": 1})
+            await testapp.fs_commit(batch)
+            await testapp.fs_delete(db.collection("counters").document("a"))
+            await testapp.run_io(lambda: bump_in_transaction(db.transaction(), doc_ref, [10]))
+        finally:
+            testapp.metrics_route.reset(token)
+
+    asyncio.run(run())
+
+    # reads: get, empty query (billed once), two transaction attempts; writes: set, batch of two, one commit
+    assert firestore_ops == {("/test", "reads"): 4, ("/test", "writes"): 4, ("/test", "deletes"): 1}
+    assert doc_ref.get().to_dict() == {"n": 11}
+
+
+def test_requests_are_exported_with_their_route(store, firestore_ops):
+    db, _ = store
+    db.collection("userProfileDetails").document("u").set({"userId": "u"})
+
+    async def run():
+        async with app_client(MockUpstream()) as client:
+            await client.get("/get-user-profile/u")
+            return (await client.get("/metrics")).text
+
+    metrics = asyncio.run(run())
+
+    assert 'incivus_firestore_documents_total{route="/get-user-profile/{user_id}",op="reads"} 1' in metrics
+
+
+def test_feature_stats_are_only_served_by_metrics(store):
+    async def run():
+        async with app_client(MockUpstream()) as client:
+            old_routes = [
+                (await client.get(f"/{name}-metrics")).status_code
+                for name in ("content-store", "upstream-pool", "image-preprocess", "video-keyframe", "analysis-stage")
+            ]
+            return old_routes, (await client.get("/metrics")).text
+
+    old_routes, metrics = asyncio.run(run())
+
+    assert old_routes == [404] * 5
+    for line in (
+        'incivus_feature_enabled{feature="content_store"} ',
+        "incivus_upstream_client_open 1",
+        "incivus_upstream_pool_limit_max_per_host ",
+        "incivus_content_store_uploads ",
+        "incivus_image_preprocess_bytes_before ",
+        "incivus_video_keyframes_extracted ",
+        "incivus_analysis_timing_sampled ",
+    ):
+        assert line in metrics
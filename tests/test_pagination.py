@@ -0,0 +1,56 @@
+import asyncio
+
+import httpx
+
+import testapp
+
+
+def seed_analyses(db, timestamps: dict):
+    for doc_id, timestamp in timestamps.items():
+        db.collection("user_analysis").document(doc_id).set({
+            "userId": "user-1", "timestamp": timestamp, "adTitle": doc_id, "ai_analysis_results": {},
+        })
+
+
+def walk(path: str, limit: int, start_after=None) -> list:
+    async def scenario():
+        pages = []
+        cursor = start_after
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=testapp.app), base_url="http://testapp") as client:
+            while True:
+                params = {"limit": limit, **({"startAfter": cursor} if cursor else {})}
+                body = (await client.get(path, params=params)).json()
+                pages.append([a["artifact_id"] for a in body["analysis_history"]])
+                cursor = body["nextCursor"]
+                if not cursor:
+                    return pages
+
+    return asyncio.run(scenario())
+
+
+def test_pages_do_not_skip_analyses_with_the_same_timestamp(store):
+    db, _ = store
+    tied = "2026-10-18T12:00:00Z"
+    seed_analyses(db, {
+        "a-newest": "2026-10-18T13:00:00Z",
+        **{f"tie-{n}": tied for n in range(5)},
+        "z-oldest": "2026-10-18T11:00:00Z",
+    })
+
+    pages = walk("/get-user-analysis-history/user-1", limit=2)
+
+    seen = [doc_id for page in pages for doc_id in page]
+    assert seen == ["a-newest", "tie-4", "tie-3", "tie-2", "tie-1", "tie-0", "z-oldest"]
+    assert all(len(page) <= 2 for page in pages)
+
+
+def test_cursor_round_trip_and_legacy_timestamp_cursor():
+    assert testapp.decode_page_cursor(testapp.encode_page_cursor("2026-10-18T12:00:00Z", "tie-3")) == ("2026-10-18T12:00:00Z", "tie-3")
+    assert testapp.decode_page_cursor("2026-10-18T12:00:00Z") == ("2026-10-18T12:00:00Z", None)
+
+
+def test_legacy_timestamp_cursor_still_pages_on_the_timestamp(store):
+    db, _ = store
+    seed_analyses(db, {"new": "2026-10-18T13:00:00Z", "old": "2026-10-18T11:00:00Z"})
+
+    assert walk("/get-user-analysis-history/user-1", limit=5, start_after="2026-10-18T12:00:00Z") == [["old"]]
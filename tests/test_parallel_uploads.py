@@ -0,0 +1,87 @@
+import asyncio
+
+import pytest
+
+import testapp
+from app_client import MockUpstream, app_client, seed_user
+
+FILES = [(f"logo-{n}.png", f"logo {n}".encode(), "image/png") for n in range(4)]
+
+
+async def upload_media(files):
+    async with app_client(MockUpstream()) as client:
+        return await client.post(
+            "/upload-additional-media/brand-1",
+            data={"mediaType": "logo"},
+            files=[("files", file) for file in files],
+        )
+
+
+def media_records(db) -> list:
+    return list(db.collection("brandData").document("brand-1").collection("media").stream())
+
+
+@pytest.fixture
+def brand(store):
+    db, bucket = store
+    seed_user(db, logo=False)
+    return db, bucket
+
+
+def test_files_are_returned_in_the_order_they_were_sent(brand, monkeypatch):
+    db, bucket = brand
+    store_upload = testapp.gcs_store_upload
+
+    async def last_sent_finishes_first(storage_path, file_obj, content_type=None):
+        position = [data for _, data, _ in FILES].index(file_obj.read())
+        file_obj.seek(0)
+        await asyncio.sleep(0.01 * (len(FILES) - position))
+        return await store_upload(storage_path, file_obj, content_type=content_type)
+
+    monkeypatch.setattr(testapp, "gcs_store_upload", last_sent_finishes_first)
+
+    response = asyncio.run(upload_media(FILES))
+
+    assert response.status_code == 200
+    uploaded = response.json()["uploaded_files"]
+    assert [media["filename"] for media in uploaded] == [name for name, _, _ in FILES]
+    assert [bucket.objects[media["storagePath"]]["data"] for media in uploaded] == [data for _, data, _ in FILES]
+    assert len(media_records(db)) == len(FILES)
+
+
+def test_failed_upload_rolls_back_the_files_already_stored(brand):
+    db, bucket = brand
+    bucket.upload_latency, bucket.fail_uploads = 0.01, 1
+
+    response = asyncio.run(upload_media(FILES))
+
+    assert response.status_code == 500
+    assert bucket.uploads == len(FILES) - 1
+    assert bucket.objects == {}
+    assert media_records(db) == []
+    assert db.data("brandData/brand-1").get("mediaCount") == 0
+
+
+def test_failed_record_write_rolls_back_every_upload(brand, monkeypatch):
+    db, bucket = brand
+
+    async def failing_save(*args, **kwargs):
+        raise RuntimeError("commit failed")
+
+    monkeypatch.setattr(testapp, "save_brand_media", failing_save)
+
+    response = asyncio.run(upload_media(FILES))
+
+    assert response.status_code == 500
+    assert bucket.uploads == len(FILES)
+    assert bucket.objects == {}
+
+
+def test_invalid_file_is_rejected_before_anything_is_uploaded(brand):
+    db, bucket = brand
+
+    response = asyncio.run(upload_media(FILES[:2] + [("notes.txt", b"text", "text/plain")]))
+
+    assert response.status_code != 200
+    assert bucket.uploads == 0
+    assert media_records(db) == []
@@ -0,0 +1,243 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+from fastapi import HTTPException
+from google.api_core.exceptions import ServiceUnavailable
+
+import testapp
+
+PERIOD = testapp.current_usage_period()
+
+
+def seed_plan(db, **fields):
+    plan = {
+        "userId": "user-1", "planName": "Incivus_Pro", "max_ads_per_month": 11, "totalAds": 20,
+        "subscriptionStartDate": "2026-01-01T00:00:00Z", "subscriptionEndDate": "2099-01-01T00:00:00Z",
+        "validityDays": 365, "totalPrice": 400, "selectedFeatures": ["brand_compliance"],
+        **fields,
+    }
+    db.collection("PlanSelectionDetails").document("user-1").set(plan)
+    db.collection("userProfileDetails").document("user-1").set({"userId": "user-1", "subscription": {}})
+
+
+async def reserve_all(count: int) -> list:
+    outcomes = await asyncio.gather(
+        *(testapp.reserve_ad_quota("user-1", f"r{n}") for n in range(count)), return_exceptions=True
+    )
+    return outcomes
+
+
+def iso(moment: datetime) -> str:
+    return moment.isoformat() + "Z"
+
+
+def test_parallel_submissions_never_exceed_the_monthly_limit(store):
+    db, _ = store
+    db.read_latency, db.max_attempts = 0.002, 100
+    seed_plan(db, max_ads_per_month=4, totalAds=20)
+
+    outcomes = asyncio.run(reserve_all(12))
+
+    granted = [o for o in outcomes if isinstance(o, dict)]
+    denied = [o for o in outcomes if isinstance(o, HTTPException)]
+    assert db.aborted_commits > 0, "the reservations never raced"
+    assert len(granted) == 4
+    assert len(denied) == 8 and {e.status_code for e in denied} == {429}
+    plan = db.data("PlanSelectionDetails/user-1")
+    assert plan["usage"][PERIOD] == 4
+    assert plan["totalAds"] == 16
+    assert sorted(plan["quotaReservations"]) == sorted(r["id"] for r in granted)
+
+
+def test_plan_topup_does_not_clobber_concurrent_reservations(store):
+    db, _ = store
+    db.read_latency, db.max_attempts = 0.002, 100
+    seed_plan(db, totalAds=20)
+
+    async def scenario():
+        reservations = asyncio.gather(*(testapp.reserve_ad_quota("user-1", f"r{n}") for n in range(6)))
+        topup = testapp.update_plan(user_id="user-1", plan_name="Incivus_Pro", action="topup", features=None, total_ads=10)
+        return await asyncio.gather(reservations, topup)
+
+    reservations, response = asyncio.run(scenario())
+
+    plan = db.data("PlanSelectionDetails/user-1")
+    assert plan["totalAds"] == 20 - 6 + 10
+    assert plan["usage"][PERIOD] == 6
+    assert len(plan["quotaReservations"]) == 6
+    assert plan["totalPrice"] == 800
+    profile = db.data("userProfileDetails/user-1")["subscription"]
+    assert profile["planName"] == "Incivus_Pro"
+    assert response["status"] == "success"
+
+
+def test_plan_topup_only_writes_the_plan_fields_it_changes(store):
+    db, _ = store
+    seed_plan(db, usage={PERIOD: 3}, adsUsed=3, quotaReservations={"open": iso(datetime.utcnow())})
+
+    asyncio.run(testapp.update_plan(user_id="user-1", plan_name="Incivus_Pro", action="topup", features="brand_compliance,content_analysis", total_ads=5))
+
+    plan = db.data("PlanSelectionDetails/user-1")
+    assert plan["totalAds"] == 25
+    assert plan["usage"] == {PERIOD: 3}
+    assert list(plan["quotaReservations"]) == ["open"]
+    assert plan["selectedFeatures"] == ["brand_compliance", "content_analysis"]
+
+
+def test_stale_reservation_is_handed_back_by_the_next_reservation(store):
+    db, _ = store
+    stale = iso(datetime.utcnow() - timedelta(seconds=testapp.QUOTA_RESERVATION_TTL_SECONDS + 60))
+    seed_plan(db, max_ads_per_month=1, totalAds=0, usage={PERIOD: 1}, adsUsed=1, quotaReservations={"crashed": stale})
+
+    reservation = asyncio.run(testapp.reserve_ad_quota("user-1", "fresh"))
+
+    assert reservation["adsUsed"] == 1
+    plan = db.data("PlanSelectionDetails/user-1")
+    assert plan["usage"][PERIOD] == 1
+    assert plan["totalAds"] == 0
+    assert list(plan["quotaReservations"]) == ["fresh"]
+
+
+def test_stale_reservation_is_handed_back_even_when_the_reservation_is_denied(store):
+    db, _ = store
+    stale = iso(datetime.utcnow() - timedelta(seconds=testapp.QUOTA_RESERVATION_TTL_SECONDS + 60))
+    recent = iso(datetime.utcnow())
+    seed_plan(db, max_ads_per_month=2, totalAds=5, usage={PERIOD: 3}, adsUsed=3,
+              quotaReservations={"crashed": stale, "running": recent})
+
+    with pytest.raises(HTTPException) as denied:
+        asyncio.run(testapp.reserve_ad_quota("user-1", "fresh"))
+
+    assert denied.value.status_code == 429
+    plan = db.data("PlanSelectionDetails/user-1")
+    assert plan["usage"][PERIOD] == 2
+    assert plan["adsUsed"] == 2
+    assert plan["totalAds"] == 6
+    assert list(plan["quotaReservations"]) == ["running"]
+
+
+def last_month() -> str:
+    return iso(datetime.utcnow().replace(day=1) - timedelta(days=3))
+
+
+def test_monthly_reset_keeps_a_reservation_made_after_the_sweep_read_the_plan(store, monkeypatch):
+    db, _ = store
+    seed_plan(db, adsUsed=7, lastUsageDate=last_month())
+    read_page = testapp.fs_stream
+
+    async def reserve_after_read(query):
+        page = await read_page(query)
+        if page:
+            await testapp.reserve_ad_quota("user-1", "during-reset")
+        return page
+
+    monkeypatch.setattr(testapp, "fs_stream", reserve_after_read)
+
+    progress = asyncio.run(testapp.run_monthly_usage_reset())
+
+    plan = db.data("PlanSelectionDetails/user-1")
+    assert plan["adsUsed"] == 1
+    assert plan["usage"][PERIOD] == 1
+    assert list(plan["quotaReservations"]) == ["during-reset"]
+    assert (progress["usersReset"], progress["usersSkipped"], progress["status"]) == (0, 1, "done")
+
+
+def test_monthly_reset_carries_on_past_a_plan_it_cannot_reset(store, monkeypatch):
+    db, _ = store
+    for user_id in ("user-a", "user-b", "user-c"):
+        db.collection("PlanSelectionDetails").document(user_id).set({"userId": user_id, "adsUsed": 4, "lastUsageDate": last_month()})
+    monkeypatch.setattr(testapp, "RESET_BATCH_SIZE", 1)
+    update = testapp.fs_update
+
+    async def failing_update(doc_ref, updates, option=None):
+        if doc_ref.id == "user-a":
+            raise ServiceUnavailable("unavailable")
+        return await update(doc_ref, updates, option=option)
+
+    monkeypatch.setattr(testapp, "fs_update", failing_update)
+    first = asyncio.run(testapp.run_monthly_usage_reset())
+
+    assert (first["status"], first["usersReset"], first["usersFailed"]) == ("incomplete", 2, 1)
+    assert first["lastError"].startswith("user-a: ")
+    assert [db.data(f"PlanSelectionDetails/{u}")["adsUsed"] for u in ("user-a", "user-b", "user-c")] == [4, 0, 0]
+
+    monkeypatch.setattr(testapp, "fs_update", update)
+    second = asyncio.run(testapp.run_monthly_usage_reset())
+
+    assert (second["status"], second["usersReset"], second["usersFailed"], second["lastError"]) == ("done", 3, 0, None)
+    assert db.data("PlanSelectionDetails/user-a")["adsUsed"] == 0
+
+
+class Clock(datetime):
+    """testapp's datetime, with utcnow() pinned to `Clock.now`."""
+
+    now = datetime(2026, 10, 31, 23, 58)
+
+    @classmethod
+    def utcnow(cls):
+        return cls.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    monkeypatch.setattr(testapp, "datetime", Clock)
+    monkeypatch.setattr(Clock, "now", Clock.now)
+    return Clock
+
+
+def test_usage_rolls_over_at_the_month_boundary_without_a_reset(store, clock):
+    db, _ = store
+    seed_plan(db, max_ads_per_month=2, totalAds=20)
+    asyncio.run(reserve_all(2))
+    with pytest.raises(HTTPException) as denied:
+        asyncio.run(testapp.reserve_ad_quota("user-1", "october-3"))
+    assert denied.value.status_code == 429
+
+    clock.now = datetime(2026, 11, 1, 0, 1)
+    reservation = asyncio.run(testapp.reserve_ad_quota("user-1", "november-1"))
+    status = asyncio.run(testapp.get_plan_status("user-1"))["plan_status"]
+
+    assert (reservation["period"], reservation["adsUsed"]) == ("2026-11", 1)
+    plan = db.data("PlanSelectionDetails/user-1")
+    assert plan["usage"] == {"2026-10": 2, "2026-11": 1}
+    assert plan["adsUsed"] == 1
+    assert plan["totalAds"] == 17
+    assert (status["usage_period"], status["ads_used"]) == ("2026-11", 1)
+
+
+def test_legacy_usage_counts_only_in_the_month_it_was_recorded(store, clock):
+    db, _ = store
+    seed_plan(db, adsUsed=5, lastUsageDate="2026-10-20T09:00:00Z")
+
+    assert asyncio.run(testapp.get_plan_status("user-1"))["plan_status"]["ads_used"] == 5
+    clock.now = datetime(2026, 11, 1, 0, 1)
+    testapp.invalidate_plan_cache("user-1")
+    assert asyncio.run(testapp.get_plan_status("user-1"))["plan_status"]["ads_used"] == 0
+
+
+def test_unit_released_after_the_rollover_goes_back_to_its_own_month(store, clock):
+    db, _ = store
+    seed_plan(db, totalAds=20)
+    october = asyncio.run(testapp.reserve_ad_quota("user-1", "october"))
+
+    clock.now = datetime(2026, 11, 1, 0, 1)
+    asyncio.run(testapp.reserve_ad_quota("user-1", "november"))
+    asyncio.run(testapp.release_ad_quota(october))
+
+    plan = db.data("PlanSelectionDetails/user-1")
+    assert plan["usage"] == {"2026-10": 0, "2026-11": 1}
+    assert plan["adsUsed"] == 1
+    assert plan["totalAds"] == 19
+    assert list(plan["quotaReservations"]) == ["november"]
+
+
+def test_manual_reset_only_clears_the_current_period(store, clock):
+    db, _ = store
+    seed_plan(db, usage={"2026-09": 4, "2026-10": 3}, adsUsed=3, lastUsageDate="2026-10-30T10:00:00Z")
+
+    asyncio.run(testapp.reset_monthly_usage("user-1"))
+
+    plan = db.data("PlanSelectionDetails/user-1")
+    assert plan["usage"] == {"2026-09": 4, "2026-10": 0}
+    assert plan["adsUsed"] == 0
@@ -0,0 +1,61 @@
+import asyncio
+
+import testapp
+from app_client import MockUpstream, app_client, seed_user, submit_analysis
+
+FORM = {"ad_description": "launch", "user_ad_type": "awareness", "brand_colors": "#000", "tone_of_voice": "calm", "platforms": "Facebook"}
+
+
+def test_key_ignores_the_logo_signature():
+    first = testapp.result_cache_key("user-1", "digest", {**FORM, "logo_url": "https://signed/logo.png?sig=1"}, "comprehensive", "", "logos/logo.png")
+    resigned = testapp.result_cache_key("user-1", "digest", {**FORM, "logo_url": "https://signed/logo.png?sig=2"}, "comprehensive", "", "logos/logo.png")
+    other_logo = testapp.result_cache_key("user-1", "digest", {**FORM, "logo_url": "https://signed/logo.png?sig=1"}, "comprehensive", "", "logos/other.png")
+    no_logo = testapp.result_cache_key("user-1", "digest", FORM, "comprehensive")
+
+    assert first == resigned
+    assert first != other_logo
+    assert first != no_logo
+
+
+def test_key_is_per_user():
+    assert testapp.result_cache_key("user-1", "digest", FORM, "comprehensive") != testapp.result_cache_key("user-2", "digest", FORM, "comprehensive")
+
+
+def test_another_users_identical_submission_is_analysed_afresh(store):
+    db, _ = store
+    seed_user(db, "user-1", "brand-1", logo=False)
+    seed_user(db, "user-2", "brand-2", logo=False)
+    upstream = MockUpstream()
+
+    async def scenario():
+        async with app_client(upstream) as client:
+            first = await submit_analysis(client, "user-1", "brand-1")
+            second = await submit_analysis(client, "user-2", "brand-2")
+        return first.json(), second.json()
+
+    first, second = asyncio.run(scenario())
+
+    assert second["cache"]["hit"] is False
+    assert len(upstream.calls) == 2
+    assert db.data(f"user_analysis/{second['artifactId']}")["userId"] == "user-2"
+
+
+def test_resubmission_hits_the_cache_after_the_logo_is_resigned(store):
+    db, bucket = store
+    seed_user(db)
+    upstream = MockUpstream()
+
+    async def scenario():
+        async with app_client(upstream) as client:
+            first = await submit_analysis(client)
+            # Another process, or the same one after the URL expired, signs the logo afresh
+            testapp.signed_url_cache.clear()
+            second = await submit_analysis(client)
+        return first.json(), second.json()
+
+    first, second = asyncio.run(scenario())
+
+    assert first["logoInfo"]["logoUrl"] != second["logoInfo"]["logoUrl"]
+    assert first["cache"]["hit"] is False
+    assert second["cache"] == {"hit": True, "sourceArtifactId": first["artifactId"]}
+    assert len(upstream.calls) == 1
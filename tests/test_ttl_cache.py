@@ -0,0 +1,100 @@
+import asyncio
+import threading
+
+import httpx
+import pytest
+
+import testapp
+from testapp import CACHE_MISS, TTLCache
+
+
+@pytest.fixture(autouse=True)
+def unregistered(monkeypatch):
+    """Keep the caches made here out of the app's /metrics registry."""
+    monkeypatch.setattr(testapp, "ttl_caches", list(testapp.ttl_caches))
+
+
+def test_entries_expire_and_the_least_recently_used_is_evicted(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(testapp.time, "monotonic", lambda: now[0])
+    cache = TTLCache("test_lru", max_entries=2, ttl_seconds=10)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1
+    cache.put("c", 3)  # evicts b, the least recently used
+
+    assert cache.get("b") is CACHE_MISS
+    now[0] += 11
+    assert cache.get("a") is CACHE_MISS
+    assert cache.peek("a") == 1
+    assert {k: cache.stats[k] for k in ("hits", "misses", "expired", "evictions")} == {
+        "hits": 1, "misses": 2, "expired": 1, "evictions": 1,
+    }
+
+
+def test_a_fill_that_overlapped_an_invalidation_is_discarded():
+    cache = TTLCache("test_fill", max_entries=10, ttl_seconds=60)
+    stale = cache.begin_fill("k")
+    cache.invalidate("k")  # the document was written while the fill was reading
+    fresh = cache.begin_fill("k")
+
+    assert cache.put("k", "old", fill=stale) is False
+    assert cache.get("k") is CACHE_MISS
+    assert cache.put("k", "new", fill=fresh) is True
+    assert cache.get("k") == "new"
+    assert cache.stats["discarded_fills"] == 1
+
+
+def test_cache_is_consistent_under_threads():
+    cache = TTLCache("test_threads", max_entries=50, ttl_seconds=60)
+
+    def churn(n):
+        for i in range(2000):
+            key = (n + i) % 80
+            cache.put(key, i)
+            cache.get(key)
+            if i % 7 == 0:
+                cache.invalidate(key)
+
+    threads = [threading.Thread(target=churn, args=(n,)) for n in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(cache) <= 50
+    assert cache.stats["fills"] == 8 * 2000
+
+
+def test_plan_reads_are_cached_until_the_plan_is_written(store):
+    db, _ = store
+    db.collection("PlanSelectionDetails").document("user-1").set({"planName": "Incivus_Lite"})
+
+    async def scenario():
+        first = await testapp.get_plan_data("user-1")
+        db.collection("PlanSelectionDetails").document("user-1").set({"planName": "Incivus_Pro"})
+        cached = await testapp.get_plan_data("user-1")
+        testapp.invalidate_plan_cache("user-1")
+        return first, cached, await testapp.get_plan_data("user-1")
+
+    first, cached, reread = asyncio.run(scenario())
+
+    assert first["planName"] == cached["planName"] == "Incivus_Lite"
+    assert reread["planName"] == "Incivus_Pro"
+
+
+def test_caches_are_exported_on_metrics_only(store):
+    async def scenario():
+        await testapp.get_plan_data("nobody")
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=testapp.app), base_url="http://testapp") as client:
+            metrics = (await client.get("/metrics")).text
+            old_routes = [(await client.get(f"/{name}-cache-metrics")).status_code for name in ("plan", "brand", "result", "signed-url")]
+        return metrics, old_routes
+
+    metrics, old_routes = asyncio.run(scenario())
+
+    for name in ("plan", "brand", "result_index", "signed_url"):
+        assert f'incivus_cache_misses{{cache="{name}"}}' in metrics
+        assert f'incivus_cache_entries{{cache="{name}"}}' in metrics
+    assert 'incivus_cache_stale_reads{cache="plan"}' in metrics
+    assert old_routes == [404] * 4
@@ -0,0 +1,129 @@
+import asyncio
+import contextlib
+
+import httpx
+import pytest
+
+import testapp
+from app_client import MockUpstream, app_client, seed_user, submit_analysis
+
+PIECE = testapp.UPLOAD_CHUNK_GRANULARITY
+MEDIA = bytes(range(256)) * (PIECE * 3 // 256) + b"tail"
+
+
+@pytest.fixture
+def storage(store, monkeypatch):
+    """testapp's resumable-upload client, talking to the fake bucket."""
+    db, bucket = store
+    monkeypatch.setattr(testapp, "gcs_session_client", httpx.AsyncClient(transport=httpx.MockTransport(bucket.handle_upload_session)))
+    return db, bucket
+
+
+@contextlib.asynccontextmanager
+async def session_client(upstream=None):
+    async with app_client(upstream or MockUpstream()) as client:
+        yield client
+
+
+async def open_session(client, size: int = len(MEDIA)) -> dict:
+    response = await client.post(
+        "/upload-sessions", json={"userId": "user-1", "filename": "ad.mp4", "contentType": "video/mp4", "totalSize": size},
+    )
+    assert response.status_code == 200
+    return response.json()
+
+
+async def put_chunk(client, session_id: str, start: int, end: int) -> httpx.Response:
+    return await client.put(
+        f"/upload-sessions/{session_id}",
+        content=MEDIA[start:end],
+        headers={"Content-Range": f"bytes {start}-{end - 1}/{len(MEDIA)}"},
+    )
+
+
+def test_interrupted_chunk_resumes_from_what_storage_kept(storage):
+    db, bucket = storage
+    bucket.interrupt_chunks = 1
+
+    async def run():
+        async with session_client() as client:
+            session_id = (await open_session(client))["sessionId"]
+            interrupted = (await put_chunk(client, session_id, 0, 2 * PIECE)).json()
+            status = (await client.get(f"/upload-sessions/{session_id}")).json()
+            early_finalize = await client.post(f"/upload-sessions/{session_id}/finalize")
+            replayed = await put_chunk(client, session_id, 0, 2 * PIECE)
+            resumed = [
+                (await put_chunk(client, session_id, start, end)).json()
+                for start, end in ((PIECE, 3 * PIECE), (3 * PIECE, len(MEDIA)))
+            ]
+            finalized = (await client.post(f"/upload-sessions/{session_id}/finalize")).json()
+            return interrupted, status, early_finalize, replayed, resumed, finalized
+
+    interrupted, status, early_finalize, replayed, resumed, finalized = asyncio.run(run())
+
+    assert (interrupted["nextOffset"], interrupted["complete"]) == (PIECE, False)
+    assert status["nextOffset"] == PIECE
+    assert early_finalize.status_code == 409
+    assert early_finalize.json()["detail"]["nextOffset"] == PIECE
+    assert replayed.status_code == 409
+    assert replayed.json()["detail"]["nextOffset"] == PIECE
+    assert [(chunk["nextOffset"], chunk["complete"]) for chunk in resumed] == [(3 * PIECE, False), (len(MEDIA), True)]
+    assert finalized["status"] == "finalized"
+    assert [entry["data"] for entry in bucket.objects.values()] == [MEDIA]
+
+
+def test_finalized_upload_is_analysed_once(storage):
+    db, bucket = storage
+    seed_user(db)
+    upstream = MockUpstream()
+
+    async def run():
+        async with session_client(upstream) as client:
+            session_id = (await open_session(client))["sessionId"]
+            await put_chunk(client, session_id, 0, len(MEDIA))
+            await client.post(f"/upload-sessions/{session_id}/finalize")
+            first = await submit_analysis(client, uploadSessionId=session_id, bypassCache="true")
+            second = await submit_analysis(client, uploadSessionId=session_id, bypassCache="true")
+            return first, second
+
+    first, second = asyncio.run(run())
+
+    assert first.status_code == 200
+    assert second.status_code == 409
+    assert [MEDIA in body for _, body in upstream.calls] == [True]
+
+
+def test_session_past_its_expiry_is_refused(storage):
+    db, bucket = storage
+
+    async def run():
+        async with session_client() as client:
+            session = await open_session(client)
+            await put_chunk(client, session["sessionId"], 0, PIECE)
+            db.document(f"upload_sessions/{session['sessionId']}").update({"expiresAt": "2026-01-01T00:00:00Z"})
+            return [
+                await put_chunk(client, session["sessionId"], PIECE, 2 * PIECE),
+                await client.get(f"/upload-sessions/{session['sessionId']}"),
+                await client.post(f"/upload-sessions/{session['sessionId']}/finalize"),
+            ]
+
+    responses = asyncio.run(run())
+
+    assert [response.status_code for response in responses] == [410, 410, 410]
+    assert responses[0].json()["detail"] == testapp.UPLOAD_SESSION_EXPIRED
+
+
+def test_session_storage_has_forgotten_is_reported_expired(storage):
+    db, bucket = storage
+
+    async def run():
+        async with session_client() as client:
+            session_id = (await open_session(client))["sessionId"]
+            await put_chunk(client, session_id, 0, PIECE)
+            bucket.expire_upload_session(db.data(f"upload_sessions/{session_id}")["gcsSessionUrl"])
+            return await put_chunk(client, session_id, PIECE, 2 * PIECE), await client.get(f"/upload-sessions/{session_id}")
+
+    chunk, status = asyncio.run(run())
+
+    assert (chunk.status_code, status.status_code) == (410, 410)
+    assert bucket.objects == {}
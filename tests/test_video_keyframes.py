@@ -0,0 +1,97 @@
+import asyncio
+import io
+import json
+import multiprocessing
+import os
+import subprocess
+import sys
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+
+import pytest
+
+import testapp
+import video_keyframes
+
+HEAVY_MODULES = ("testapp", "config", "fastapi", "httpx", "google.cloud.firestore")
+
+
+def test_pool_workers_import_the_extractors_without_the_app():
+    probe = f"import sys, video_keyframes; print([m for m in {HEAVY_MODULES!r} if m in sys.modules])"
+    result = subprocess.run([sys.executable, "-c", probe], cwd=os.path.dirname(os.path.abspath(video_keyframes.__file__)),
+                            capture_output=True, text=True, check=True)
+
+    assert result.stdout.strip() == "[]"
+
+
+def test_registered_extractors_live_in_the_light_module():
+    for extractor in testapp.VIDEO_FRAME_EXTRACTORS.values():
+        assert extractor.__module__ == "video_keyframes"
+
+
+@pytest.fixture
+def clip(tmp_path):
+    """A two-second 160x120 clip whose frames can be told apart by brightness."""
+    cv2 = pytest.importorskip("cv2")
+    numpy = pytest.importorskip("numpy")
+    path = str(tmp_path / "clip.avi")
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*"MJPG"), 10, (160, 120))
+    for n in range(20):
+        writer.write(numpy.full((120, 160, 3), n * 12, dtype=numpy.uint8))
+    writer.release()
+    return path
+
+
+@pytest.fixture
+def spawn_pool():
+    pool = ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn"))
+    yield pool
+    pool.shutdown()
+
+
+def test_spawned_worker_extracts_a_bundle_in_the_documented_format(clip, spawn_pool):
+    bundle, metadata = spawn_pool.submit(video_keyframes.extract_keyframes_opencv, clip, 4, 80, 80).result(timeout=60)
+
+    assert video_keyframes.check_bundle(bundle) == metadata
+    assert metadata["format"] == video_keyframes.BUNDLE_FORMAT
+    assert (metadata["width"], metadata["height"], metadata["frameCount"]) == (160, 120, 20)
+    assert metadata["durationSeconds"] == 2.0
+    assert [frame["frame"] for frame in metadata["frames"]] == [2, 7, 12, 17]
+    assert [frame["timestamp"] for frame in metadata["frames"]] == [0.2, 0.7, 1.2, 1.7]
+    with zipfile.ZipFile(io.BytesIO(bundle)) as archive:
+        first = archive.read("frame_000.jpg")
+    assert first.startswith(b"\xff\xd8")  # JPEG, downsized to 80x60
+    assert len(first) < 160 * 120
+
+
+def test_bundle_that_breaks_the_format_is_rejected():
+    bundle = io.BytesIO()
+    with zipfile.ZipFile(bundle, "w") as archive:
+        archive.writestr("metadata.json", json.dumps({"format": "keyframes-zip/0", "frames": []}))
+
+    with pytest.raises(ValueError):
+        video_keyframes.check_bundle(bundle.getvalue())
+
+
+def test_stage_sends_the_bundle_only_to_models_that_accept_it(store, clip, spawn_pool, monkeypatch):
+    db, bucket = store
+    monkeypatch.setattr(testapp, "VIDEO_KEYFRAMES_ENABLED", True)
+    monkeypatch.setattr(testapp, "VIDEO_FRAME_MAX_DIMENSION", 80)
+    monkeypatch.setattr(testapp, "video_process_pool", spawn_pool)
+
+    def extract():
+        with open(clip, "rb") as media_file:
+            media = asyncio.run(testapp.extract_video_keyframes(media_file, "clip.avi", "video/avi", "digest"))
+            return media, media["file"] is media_file
+
+    monkeypatch.setattr(testapp, "UPSTREAM_FRAME_BUNDLE_FORMATS", set())
+    original, sent_whole = extract()
+    monkeypatch.setattr(testapp, "UPSTREAM_FRAME_BUNDLE_FORMATS", {video_keyframes.BUNDLE_FORMAT})
+    media, _ = extract()
+
+    assert sent_whole and original["preprocessing"] is None
+    assert media["content_type"] == "application/zip"
+    assert media["form_fields"]["bundle_format"] == video_keyframes.BUNDLE_FORMAT
+    assert media["form_fields"]["video_resolution"] == "160x120"
+    assert video_keyframes.check_bundle(media["file"].read())["frameCount"] == 20
+    assert bucket.get_blob(media["preprocessing"]["bundleStoragePath"]) is not None
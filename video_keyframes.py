@@ -0,0 +1,102 @@
+"""
+Video keyframe extractors. They run in the video process pool, whose spawned
+workers import this module to unpickle them, so it must stay cheap to import:
+no app, clients or config, only what the extractors need.
+
+An extractor is fn(path, frame_count, max_dimension, jpeg_quality) ->
+(bundle_bytes, metadata dict); see the video keyframes section of testapp.
+
+Bundle format BUNDLE_FORMAT, which the models must declare they accept
+(UPSTREAM_FRAME_BUNDLE_FORMATS) before any bundle is sent to them: a zip
+holding frame_000.jpg, frame_001.jpg, ... and metadata.json with
+    format          BUNDLE_FORMAT
+    durationSeconds float or null
+    width, height   source resolution in pixels
+    fps             float or null
+    frameCount      frames in the source video
+    frames          [{"file", "frame", "timestamp"}] in playback order,
+                    timestamp in seconds (null when fps is unknown)
+check_bundle() enforces it on whatever an extractor returns.
+"""
+import io
+import json
+import zipfile
+
+try:
+    import cv2
+except ImportError:  # OpenCV is optional; videos are sent whole without it
+    cv2 = None
+
+BUNDLE_VERSION = 1
+BUNDLE_FORMAT = f"keyframes-zip/{BUNDLE_VERSION}"
+METADATA_FIELDS = ("format", "durationSeconds", "width", "height", "fps", "frameCount", "frames")
+
+
+def check_bundle(bundle: bytes) -> dict:
+    """Metadata of a bundle in BUNDLE_FORMAT; ValueError if it is not one."""
+    try:
+        with zipfile.ZipFile(io.BytesIO(bundle)) as archive:
+            names = set(archive.namelist())
+            metadata = json.loads(archive.read("metadata.json"))
+    except (zipfile.BadZipFile, KeyError, ValueError) as e:
+        raise ValueError(f"Not a keyframe bundle: {e}")
+    missing = [field for field in METADATA_FIELDS if field not in metadata]
+    if missing:
+        raise ValueError(f"Keyframe bundle metadata lacks {', '.join(missing)}")
+    if metadata["format"] != BUNDLE_FORMAT:
+        raise ValueError(f"Keyframe bundle is {metadata['format']}, expected {BUNDLE_FORMAT}")
+    frames = metadata["frames"]
+    if not frames:
+        raise ValueError("Keyframe bundle has no frames")
+    for n, frame in enumerate(frames):
+        if frame.get("file") != f"frame_{n:03d}.jpg" or frame["file"] not in names:
+            raise ValueError(f"Keyframe bundle frame {n} is missing or misnamed")
+    return metadata
+
+
+def extract_keyframes_opencv(path: str, frame_count: int, max_dimension: int, jpeg_quality: int) -> tuple:
+    """Evenly spaced frames decoded with OpenCV."""
+    capture = cv2.VideoCapture(path)
+    if not capture.isOpened():
+        raise ValueError("OpenCV could not open the video")
+    try:
+        fps = capture.get(cv2.CAP_PROP_FPS) or 0
+        total_frames = int(capture.get(cv2.CAP_PROP_FRAME_COUNT) or 0)
+        width = int(capture.get(cv2.CAP_PROP_FRAME_WIDTH))
+        height = int(capture.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        duration = total_frames / fps if fps else None
+        # Sample the middle of frame_count equal segments
+        positions = sorted({int((i + 0.5) * total_frames / frame_count) for i in range(frame_count)}) if total_frames else [0]
+        scale = min(1.0, max_dimension / max(width, height)) if width and height else 1.0
+
+        frames = []
+        bundle = io.BytesIO()
+        with zipfile.ZipFile(bundle, "w", zipfile.ZIP_STORED) as archive:
+            for position in positions:
+                capture.set(cv2.CAP_PROP_POS_FRAMES, position)
+                ok, frame = capture.read()
+                if not ok:
+                    continue
+                if scale < 1.0:
+                    frame = cv2.resize(frame, (int(width * scale), int(height * scale)), interpolation=cv2.INTER_AREA)
+                ok, encoded = cv2.imencode(".jpg", frame, [cv2.IMWRITE_JPEG_QUALITY, jpeg_quality])
+                if not ok:
+                    continue
+                name = f"frame_{len(frames):03d}.jpg"
+                archive.writestr(name, encoded.tobytes())
+                frames.append({"file": name, "frame": position, "timestamp": round(position / fps, 3) if fps else None})
+            if not frames:
+                raise ValueError("No frames could be decoded")
+            metadata = {
+                "format": BUNDLE_FORMAT,
+                "durationSeconds": round(duration, 3) if duration else None,
+                "width": width,
+                "height": height,
+                "fps": round(fps, 3) if fps else None,
+                "frameCount": total_frames,
+                "frames": frames,
+            }
+            archive.writestr("metadata.json", json.dumps(metadata))
+        return bundle.getvalue(), metadata
+    finally:
+        capture.release()